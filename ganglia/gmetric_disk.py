@@ -3,11 +3,13 @@
 # FILENAME: gmetric_disk.py
 # PROJECT: gmetric For Disk IO 
 # DESCRIPTION: Pulls disk IO stats and publishes them to Ganglia as
-#       Gmetrics.
+#       Gmetrics. Runs as a small daemon with collector plug-ins, so
+#       network, memory and load stats share the same sampling and
+#       emission pipeline as the disk stats.
 #
 # REQUIRES:
 #       gmetric
-#       pminfo
+#       Linux /proc/diskstats (default) or pminfo (PCP backend)
 #
 ########################################################################################
 # (C)2010 DigiTar, All Rights Reserved
@@ -39,52 +41,955 @@
 ########################################################################################
 
 
-import os, re, time
+import os, re, sys, time, subprocess, io, socket, struct, threading, Queue
+from array import array
 
-### Set Sampling Interval (in secs)
+### Set Sampling Interval (in secs, fractions allowed)
 interval = 1
 
+### Set Collectors
+###   Maps each enabled collector plug-in to its own sampling interval (in secs). Every collector runs
+###   in its own worker thread, so a slow one only delays itself; all of them share one tick scheduler,
+###   one counter registry and one Ganglia emitter. Modules listed in collectorModules are imported
+###   at startup and may add plug-ins with registerCollector().
+###   Add "zfs": 5 on ZFS on Linux hosts for per-pool and per-dataset IO.
+collectorIntervals = {"disk": interval, "netdev": 5, "meminfo": 15, "loadavg": 15}
+collectorModules = []
+collectWait = 0.5		# Fraction of a tick to wait for this tick's collectors before sending
+
+### Set Collector Backend
+###   "diskstats" - Reads /proc/diskstats in-process (Linux 2.6+). No subprocess per tick.
+###   "pcp"       - Pulls the counters from pminfo (requires Performance Co-Pilot).
+collectorBackend = "diskstats"
+
+### Set /proc/diskstats Config Parameters
+fnDiskstats = "/proc/diskstats"
+dirSysBlock = "/sys/block"		# Only whole disks listed here are reported (partitions are skipped)
+reDiskstatsSkip = re.compile(r'^(ram|loop|fd|sr)\d+$')	# Pseudo devices never reported
+
+### Set /proc/net/dev Config Parameters
+fnNetDev = "/proc/net/dev"
+reNetDevSkip = re.compile(r'^lo$')	# Interfaces never reported
+### NOTE: "field" is the counter's position after the "<interface>:" prefix of /proc/net/dev.
+netDevMetrics = { "field": [0, 1, 2, 3, 8, 9, 10, 11], \
+		  "name": ["net_rxbytes", "net_rxpkts", "net_rxerrs", "net_rxdrops", "net_txbytes", "net_txpkts", "net_txerrs", "net_txdrops"], \
+		  "unit": ["bytes/s", "packets/s", "errors/s", "drops/s", "bytes/s", "packets/s", "errors/s", "drops/s"], \
+		  "type": ["float", "float", "float", "float", "float", "float", "float", "float"], \
+		  "absthreshold": [0, 0, 0, 0, 0, 0, 0, 0], \
+		  "relthreshold": [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]}
+
+### Set /proc/meminfo Config Parameters (fields missing on older kernels are skipped)
+fnMemInfo = "/proc/meminfo"
+memInfoMetrics = { "field": ["MemFree", "MemAvailable", "Buffers", "Cached", "Dirty", "Writeback", "SwapFree"], \
+		   "name": ["meminfo_free", "meminfo_available", "meminfo_buffers", "meminfo_cached", "meminfo_dirty", "meminfo_writeback", "meminfo_swapfree"], \
+		   "unit": ["KB", "KB", "KB", "KB", "KB", "KB", "KB"], \
+		   "type": ["uint32", "uint32", "uint32", "uint32", "uint32", "uint32", "uint32"], \
+		   "absthreshold": [0, 0, 0, 0, 0, 0, 0], \
+		   "relthreshold": [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]}
+
+### Set /proc/loadavg Config Parameters
+fnLoadAvg = "/proc/loadavg"
+loadAvgMetrics = { "name": ["loadavg_1min", "loadavg_5min", "loadavg_15min", "loadavg_running", "loadavg_procs"], \
+		   "unit": ["", "", "", "processes", "processes"], \
+		   "type": ["float", "float", "float", "uint32", "uint32"], \
+		   "absthreshold": [0, 0, 0, 0, 0], \
+		   "relthreshold": [0.0, 0.0, 0.0, 0.0, 0.0]}
+
+### Set ZFS kstat Config Parameters (ZFS on Linux)
+###   Pools are read from <dirZfsKstat>/<pool>/io, datasets from <dirZfsKstat>/<pool>/objset-*.
+###   The directory is only re-listed every zfsRescanInterval secs (or when a kstat vanishes).
+dirZfsKstat = "/proc/spl/kstat/zfs"
+zfsRescanInterval = 60
+zfsPoolMetrics = { "field": ["reads", "writes", "nread", "nwritten"], \
+		   "name": ["zfs_pool_reads", "zfs_pool_writes", "zfs_pool_readbytes", "zfs_pool_writebytes"], \
+		   "unit": ["ops/s", "ops/s", "bytes/s", "bytes/s"], \
+		   "type": ["float", "float", "float", "float"], \
+		   "absthreshold": [0, 0, 0, 0], \
+		   "relthreshold": [0.0, 0.0, 0.0, 0.0]}
+zfsDatasetMetrics = { "field": ["reads", "writes", "nread", "nwritten"], \
+		      "name": ["zfs_ds_reads", "zfs_ds_writes", "zfs_ds_readbytes", "zfs_ds_writebytes"], \
+		      "unit": ["ops/s", "ops/s", "bytes/s", "bytes/s"], \
+		      "type": ["float", "float", "float", "float"], \
+		      "absthreshold": [0, 0, 0, 0], \
+		      "relthreshold": [0.0, 0.0, 0.0, 0.0]}
+
 ### Set PCP Config Parameters
 cmdPminfo = "/usr/bin/pminfo -f "
 reDiskIO = re.compile(r'"(\w+)"] value (\d+)\n')	# RegEx To Compute Value
 
 ### Set Ganglia Config Parameters
+###   gangliaEmitter "xdr" encodes Ganglia 3.1+ gmetric packets and sends them over one UDP socket.
+###   gangliaEmitter "gmetric" spawns cmdGmetric once per metric (legacy behaviour).
+gangliaEmitter = "xdr"
 gangliaMetricType = "uint32"
+gangliaHost = "239.2.11.71"		# gmond udp_recv_channel (multicast group or unicast host)
 gangliaMcastPort = "8649"
-### NOTE: To add a new PCP disk metric, add the appropriate entry to each dictionary item of gangliaMetrics
+gangliaMcastTTL = 1
+gangliaMetadataInterval = 60		# Re-send metric metadata every N secs (gmond drops unknown metrics)
+gangliaSlope = "both"
+
+### Set Send Policy
+###   A value is only sent when it changed by more than both of its metric's thresholds ("absthreshold"
+###   in metric units, "relthreshold" as a fraction of the last value sent) or when sendHeartbeat secs
+###   have passed since the metric was last sent. 0 for sendHeartbeat sends every value.
+###   gmond's tmax/dmax follow the heartbeat so suppressed metrics are neither flagged stale nor expired.
+sendHeartbeat = 60
+gangliaTmax = sendHeartbeat or 60
+gangliaDmax = (sendHeartbeat or 60) * 4		# Metrics of removed devices expire after 4 missed heartbeats
+### NOTE: To add a new disk metric, add the appropriate entry to each dictionary item of gangliaMetrics
 ###       Each "vertical" column of the dictionary is a different metric entry group.
+###       "diskstatsfield" is the whitespace-separated column of /proc/diskstats holding the same
+###       counter as "pcpmetric" (0 = major, 1 = minor, 2 = device name, 3 = reads completed...).
 gangliaMetrics = { "pcpmetric": ["disk.dev.read", "disk.dev.write", "disk.dev.blkread", "disk.dev.blkwrite"], \
+		   "diskstatsfield": [3, 7, 5, 9], \
 		   "name": ["diskio_readbytes", "diskio_writebytes", "diskio_readblks", "diskio_writeblks"], \
 		   "unit": ["Kbytes/s", "Kbytes/s", "Blocks/s", "Blocks/s"], \
-	   	   "type": ["uint32", "uint32", "uint32", "uint32"]}
+	   	   "type": ["uint32", "uint32", "uint32", "uint32"], \
+		   "absthreshold": [0, 0, 0, 0], \
+		   "relthreshold": [0.0, 0.0, 0.0, 0.0]}
+### Extra per-device counters sampled in the same pass, only used to derive gangliaDerivedMetrics:
+###   milliseconds spent reading, milliseconds spent writing, io_ticks (ms busy), time_in_queue (weighted ms).
+diskExtraCounters = { "pcpmetric": ["disk.dev.read_rawactive", "disk.dev.write_rawactive", "disk.dev.avactive", "disk.dev.aveq"], \
+		      "diskstatsfield": [6, 10, 12, 13]}
+### Metrics derived from the counter rates of all devices at once (see deriveDiskMetrics()).
+gangliaDerivedMetrics = { "name": ["diskio_iops", "diskio_await", "diskio_avgqu", "diskio_util"], \
+			  "unit": ["ops/s", "ms", "requests", "%"], \
+			  "type": ["float", "float", "float", "float"], \
+			  "absthreshold": [0.5, 0.5, 0.05, 0.5], \
+			  "relthreshold": [0.0, 0.0, 0.0, 0.0]}
 cmdGmetric = "/usr/bin/gmetric"
+### Scheduler self-monitoring metrics, published every selfMetricsInterval secs.
+###   loop_ms is the longest tick work time in the window, jitter_ms the latest wake-up lateness,
+###   overruns/skipped_ticks are running totals of ticks that ran past their deadline/were dropped,
+###   sends/sends_suppressed running totals of values the send policy passed/held back.
+selfMetricsInterval = 15
+selfMetrics = { "name": ["gmetric_disk_loop_ms", "gmetric_disk_jitter_ms", "gmetric_disk_overruns", "gmetric_disk_skipped_ticks", \
+			 "gmetric_disk_sends", "gmetric_disk_sends_suppressed"], \
+		"unit": ["ms", "ms", "overruns", "ticks", "values", "values"], \
+		"type": ["float", "float", "uint32", "uint32", "uint32", "uint32"]}
+### Per-collector self-monitoring metrics (suffixed with the collector name): the last collect() run
+### time and a running total of runs skipped because the previous one had not finished yet.
+collectorSelfMetrics = { "name": ["gmetric_disk_collect_ms", "gmetric_disk_collect_skipped"], \
+			 "unit": ["ms", "runs"], \
+			 "type": ["float", "uint32"]}
+counterTypecode = array("L").itemsize >= 8 and "L" or "d"	# Array type able to hold a 64-bit counter
+gangliaSlopes = {"zero": 0, "positive": 1, "negative": 2, "both": 3}
 
-### Zero Sample Lists
-### NOTE: Make sure each sample array has as many (device) sub-arrays as there are pcpmetrics being sampled
-### NOTE: Sub-arrays are artificially sized at 4 disk devices...if you have more disk devices than 4, increase this size.
-lastSample = [[0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]
-currSample = [[0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]
-
-### Read PCP Metrics
-while(1):
-	# Interate Through Each PCP Disk IO Metric Desired
-	for x in range(0, len(gangliaMetrics["pcpmetric"])):
-		pminfoInput, pminfoOutput = os.popen2(cmdPminfo + gangliaMetrics["pcpmetric"][x], 't')
-		deviceLines = pminfoOutput.readlines()
-		pminfoInput.close()
-		pminfoOutput.close()
+
+### Monotonic Clock (immune to NTP steps; time.monotonic() only exists on Python 3.3+)
+try:
+	monotonic = time.monotonic
+except AttributeError:
+	try:
+		import ctypes, ctypes.util
+		
+		class _timespec(ctypes.Structure):
+			_fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
 		
-		# Output Metric Data For Each Device Returned By The PCP Metric
-		deviceIndex = 2		# Skip the first two lines in the buffer
-		while(deviceIndex < len(deviceLines)):
-			result = reDiskIO.search(deviceLines[deviceIndex])
-			if(result):
-				currSample[x][deviceIndex] = int(result.group(2))
-				cmdExec = cmdGmetric + " --name=" + gangliaMetrics["name"][x] + "_" + \
-						   result.group(1) + " --value=" + str((currSample[x][deviceIndex] - lastSample[x][deviceIndex])) + \
-						   " --type=" + gangliaMetrics["type"][x] + " --units=\"" + gangliaMetrics["unit"][x] + "\"" +  \
-						   " --mcast_port=" + gangliaMcastPort
-				gmetricResult = os.system(cmdExec)
-			lastSample[x][deviceIndex] = currSample[x][deviceIndex]
-			deviceIndex = deviceIndex + 1
-	time.sleep(interval)
\ No newline at end of file
+		_clock_gettime = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"),
+					     use_errno=True).clock_gettime
+		_clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+		
+		def monotonic():
+			"""Seconds from CLOCK_MONOTONIC (1 on Linux)."""
+			ts = _timespec()
+			if _clock_gettime(1, ctypes.byref(ts)) != 0:
+				raise OSError(ctypes.get_errno(), "clock_gettime(CLOCK_MONOTONIC) failed")
+			return ts.tv_sec + ts.tv_nsec * 1e-9
+	except (ImportError, OSError, AttributeError, TypeError):
+		monotonic = time.time
+
+
+class ProcFile:
+	"""A /proc file held open between ticks and re-read into a reused buffer after a seek."""
+	
+	def __init__(self, path):
+		self.f = io.FileIO(path, "r")
+		self.buf = bytearray(16384)
+	
+	def read(self):
+		"""Reads the whole file into the buffer, growing it if needed, and returns its contents."""
+		self.f.seek(0)
+		size = 0
+		while True:
+			count = self.f.readinto(memoryview(self.buf)[size:])
+			if not count:
+				return str(self.buf[:size])
+			size = size + count
+			if size == len(self.buf):
+				self.buf.extend(bytearray(len(self.buf)))
+
+
+class DiskstatsSampler:
+	"""Samples every gangliaMetrics counter for all disks from one read of /proc/diskstats."""
+	
+	def __init__(self, path, fields):
+		self.fields = fields
+		self.proc = ProcFile(path)
+		self.wholeDisks = {}
+	
+	def isWholeDisk(self, device):
+		"""Partitions and pseudo devices are skipped. Lookups are cached per device name."""
+		if device not in self.wholeDisks:
+			if reDiskstatsSkip.match(device):
+				self.wholeDisks[device] = False
+			elif os.path.isdir(dirSysBlock):
+				self.wholeDisks[device] = os.path.exists(os.path.join(dirSysBlock, device.replace("/", "!")))
+			else:
+				self.wholeDisks[device] = True
+		return self.wholeDisks[device]
+	
+	def sample(self):
+		"""Returns a list of (device, [counter, ...]) with counters ordered like self.fields."""
+		samples = []
+		for line in self.proc.read().splitlines():
+			columns = line.split()
+			if len(columns) < 14 or not self.isWholeDisk(columns[2]):
+				continue
+			samples.append((columns[2], [int(columns[field]) for field in self.fields]))
+		return samples
+
+
+class PcpSampler:
+	"""Samples every gangliaMetrics counter for all disks with a single pminfo invocation."""
+	
+	def __init__(self, command, metrics):
+		self.command = command.split() + list(metrics)
+		self.metrics = list(metrics)
+	
+	def sample(self):
+		"""Returns a list of (device, [counter, ...]) with counters ordered like self.metrics."""
+		pminfo = subprocess.Popen(self.command, stdout=subprocess.PIPE, close_fds=True)
+		output = pminfo.communicate()[0]
+		devices = {}
+		samples = []
+		column = None
+		for line in output.splitlines(True):
+			if line.strip() in self.metrics:
+				column = self.metrics.index(line.strip())
+				continue
+			result = reDiskIO.search(line)
+			if result and column != None:
+				if result.group(1) not in devices:
+					devices[result.group(1)] = [0] * len(self.metrics)
+					samples.append((result.group(1), devices[result.group(1)]))
+				devices[result.group(1)][column] = int(result.group(2))
+		return samples
+
+
+def createSampler(backend):
+	"""Builds the configured collector backend."""
+	if backend == "diskstats":
+		return DiskstatsSampler(fnDiskstats, gangliaMetrics["diskstatsfield"] + diskExtraCounters["diskstatsfield"])
+	elif backend == "pcp":
+		return PcpSampler(cmdPminfo, gangliaMetrics["pcpmetric"] + diskExtraCounters["pcpmetric"])
+	raise ValueError("Unknown collector backend '%s'." % backend)
+
+
+def counterDelta(curr, last):
+	"""Difference between two samples of a kernel counter, allowing for 32/64-bit wraps.
+	
+	A wrap is only assumed when the last sample was in the top half of the counter's range
+	and the new one is in the bottom half. Returns None for any other backwards step
+	(device re-added, driver reloaded), so the device is re-baselined.
+	"""
+	if curr >= last:
+		return curr - last
+	if 2147483648 <= last < 4294967296 and curr < 2147483648:
+		return curr + 4294967296 - last
+	if last >= 9223372036854775808 and curr < 9223372036854775808:
+		return curr + 18446744073709551616 - last
+	return None
+
+
+class DeviceRegistry:
+	"""Tracks the previous counters of every device, keyed by device name.
+	
+	Counters live column-wise in compact arrays (one per metric) indexed by a slot number
+	assigned to each device. Devices that stop reporting free their slot for reuse, so the
+	columns stay dense on hosts where multipath/dm/nvme devices come and go.
+	"""
+	
+	def __init__(self, columns):
+		self.slots = {}		# device name -> slot
+		self.names = []		# slot -> device name (None when free)
+		self.free = []
+		self.counters = [array(counterTypecode) for x in range(columns)]
+		self.stamps = array("d")	# Monotonic time each slot was last sampled
+		self.ticks = array("L")		# Tick each slot was last sampled in
+		self.tick = 0
+		self.departed = []	# Devices released since the last departures() call
+	
+	def allocate(self, device):
+		"""Assigns a slot to a newly seen device."""
+		if self.free:
+			slot = self.free.pop()
+			self.names[slot] = device
+		else:
+			slot = len(self.names)
+			self.names.append(device)
+			for column in self.counters:
+				column.append(0)
+			self.stamps.append(0.0)
+			self.ticks.append(0)
+		self.slots[device] = slot
+		return slot
+	
+	def release(self, slot):
+		del self.slots[self.names[slot]]
+		self.departed.append(self.names[slot])
+		self.names[slot] = None
+		self.free.append(slot)
+	
+	def departures(self):
+		"""Returns (and forgets) the devices that disappeared since the last call."""
+		departed = self.departed
+		self.departed = []
+		return departed
+	
+	def update(self, samples, now):
+		"""Stores one tick of (device, [counter, ...]) samples taken at monotonic time now.
+		
+		Returns (devices, rates): the devices that already had a previous sample, and one
+		array of per-second rates per counter column aligned with devices. New devices only
+		establish a baseline.
+		"""
+		self.tick = self.tick + 1
+		counters = self.counters
+		columns = range(len(counters))
+		devices = []
+		rates = [array("d") for x in columns]
+		for device, values in samples:
+			slot = self.slots.get(device)
+			if slot == None:
+				slot = self.allocate(device)
+			elif self.ticks[slot] == self.tick:
+				continue	# Duplicate device line
+			else:
+				elapsed = now - self.stamps[slot]
+				deltas = [counterDelta(values[x], counters[x][slot]) for x in columns]
+				if elapsed > 0 and None not in deltas:
+					devices.append(device)
+					for x in columns:
+						rates[x].append(deltas[x] / elapsed)
+			for x in columns:
+				counters[x][slot] = values[x]
+			self.stamps[slot] = now
+			self.ticks[slot] = self.tick
+		
+		# Forget devices that disappeared so a re-added device starts from a fresh baseline
+		if len(self.slots) > len(samples):
+			for slot in range(len(self.names)):
+				if self.names[slot] != None and self.ticks[slot] != self.tick:
+					self.release(slot)
+		return devices, rates
+
+
+class Registry:
+	"""Holds the DeviceRegistry of every collector, keyed by table name."""
+	
+	def __init__(self):
+		self.tables = {}
+		self.lock = threading.Lock()
+	
+	def table(self, name, columns):
+		"""Returns the named DeviceRegistry, creating it with the given number of counter columns."""
+		self.lock.acquire()
+		try:
+			if name not in self.tables:
+				self.tables[name] = DeviceRegistry(columns)
+			return self.tables[name]
+		finally:
+			self.lock.release()
+
+
+def deriveDiskMetrics(rates):
+	"""Computes gangliaDerivedMetrics for every device at once from the registry's rate columns.
+	
+	IOPS is reads/s + writes/s, await the ms spent per completed request, avgqu the average
+	number of requests in flight (time_in_queue ms per second) and util the share of
+	wall time the device was busy (io_ticks ms per second).
+	"""
+	counters = gangliaMetrics["pcpmetric"] + diskExtraCounters["pcpmetric"]
+	iops = map(float.__add__, rates[counters.index("disk.dev.read")], rates[counters.index("disk.dev.write")])
+	busy = map(float.__add__, rates[counters.index("disk.dev.read_rawactive")],
+		   rates[counters.index("disk.dev.write_rawactive")])
+	waits = [ops and ms / ops or 0.0 for ms, ops in zip(busy, iops)]
+	avgqu = [ms / 1000.0 for ms in rates[counters.index("disk.dev.aveq")]]
+	util = [min(ms / 10.0, 100.0) for ms in rates[counters.index("disk.dev.avactive")]]
+	return [iops, waits, avgqu, util]
+
+
+def tableMetrics(metrics, columns, instances):
+	"""Expands a metric table into (name, value, type, unit, absThreshold, relThreshold) tuples.
+	
+	columns[x][y] holds the value of metric x for instances[y]. An empty instance name
+	publishes the bare metric name.
+	"""
+	results = []
+	for x in range(0, len(metrics["name"])):
+		for y in range(0, len(instances)):
+			name = instances[y] and metrics["name"][x] + "_" + instances[y] or metrics["name"][x]
+			results.append((name, columns[x][y], metrics["type"][x], metrics["unit"][x],
+					metrics["absthreshold"][x], metrics["relthreshold"][x]))
+	return results
+
+
+def tableNames(metrics, instances):
+	"""Returns the metric names tableMetrics() publishes for the given instances."""
+	return [instance and name + "_" + instance or name for name in metrics["name"] for instance in instances]
+
+
+class Collector:
+	"""Base class of collector plug-ins.
+	
+	Subclasses set name (the collectorIntervals key) and group (the Ganglia metric group)
+	and implement collect(), which returns a list of tableMetrics()-style tuples. collect()
+	runs in the collector's own worker thread; state shared with other collectors should
+	only be reached through the registry. Collectors with per-device tables also override
+	departed() so the emitter can drop its state for devices that went away.
+	"""
+	
+	name = None
+	group = None
+	
+	def __init__(self, interval, registry):
+		self.interval = float(interval)
+		self.registry = registry
+	
+	def collect(self):
+		raise NotImplementedError
+	
+	def departed(self):
+		"""Returns the names of metrics whose device left the registry since the last call."""
+		return []
+
+
+collectorPlugins = {}
+
+def registerCollector(collector):
+	"""Makes a Collector subclass available under its name in collectorIntervals."""
+	collectorPlugins[collector.name] = collector
+	return collector
+
+
+class DiskCollector(Collector):
+	"""Disk IO rates and derived latency/queue/utilization metrics for every disk."""
+	
+	name = "disk"
+	group = "disk"
+	
+	def __init__(self, interval, registry):
+		Collector.__init__(self, interval, registry)
+		self.sampler = createSampler(collectorBackend)
+		self.devices = registry.table("disk", len(gangliaMetrics["name"]) + len(diskExtraCounters["pcpmetric"]))
+	
+	def collect(self):
+		devices, rates = self.devices.update(self.sampler.sample(), monotonic())
+		devices = [device.replace("/", "_") for device in devices]
+		return tableMetrics(gangliaMetrics, rates, devices) + \
+		       tableMetrics(gangliaDerivedMetrics, deriveDiskMetrics(rates), devices)
+	
+	def departed(self):
+		devices = [device.replace("/", "_") for device in self.devices.departures()]
+		return tableNames(gangliaMetrics, devices) + tableNames(gangliaDerivedMetrics, devices)
+
+
+class NetDevCollector(Collector):
+	"""Per-interface traffic, error and drop rates from /proc/net/dev."""
+	
+	name = "netdev"
+	group = "network"
+	
+	def __init__(self, interval, registry):
+		Collector.__init__(self, interval, registry)
+		self.proc = ProcFile(fnNetDev)
+		self.interfaces = registry.table("netdev", len(netDevMetrics["field"]))
+	
+	def collect(self):
+		samples = []
+		for line in self.proc.read().splitlines()[2:]:	# Skip the two header lines
+			interface, counters = line.split(":", 1)
+			interface = interface.strip()
+			if reNetDevSkip.match(interface):
+				continue
+			counters = counters.split()
+			samples.append((interface, [int(counters[field]) for field in netDevMetrics["field"]]))
+		interfaces, rates = self.interfaces.update(samples, monotonic())
+		return tableMetrics(netDevMetrics, rates, interfaces)
+	
+	def departed(self):
+		return tableNames(netDevMetrics, self.interfaces.departures())
+
+
+class MemInfoCollector(Collector):
+	"""Memory gauges from /proc/meminfo."""
+	
+	name = "meminfo"
+	group = "memory"
+	
+	def __init__(self, interval, registry):
+		Collector.__init__(self, interval, registry)
+		self.proc = ProcFile(fnMemInfo)
+	
+	def collect(self):
+		fields = {}
+		for line in self.proc.read().splitlines():
+			columns = line.split()
+			if len(columns) >= 2:
+				fields[columns[0].rstrip(":")] = columns[1]
+		results = []
+		for metric in tableMetrics(memInfoMetrics, [[field] for field in memInfoMetrics["field"]], [""]):
+			if metric[1] in fields:
+				results.append((metric[0], int(fields[metric[1]])) + metric[2:])
+		return results
+
+
+class LoadAvgCollector(Collector):
+	"""Load averages and process counts from /proc/loadavg."""
+	
+	name = "loadavg"
+	group = "load"
+	
+	def __init__(self, interval, registry):
+		Collector.__init__(self, interval, registry)
+		self.proc = ProcFile(fnLoadAvg)
+	
+	def collect(self):
+		columns = self.proc.read().split()
+		running, procs = columns[3].split("/")
+		values = [float(columns[0]), float(columns[1]), float(columns[2]), int(running), int(procs)]
+		return tableMetrics(loadAvgMetrics, [[value] for value in values], [""])
+
+
+class ZfsIoKstat:
+	"""A pool's io kstat: a header line of field names followed by one line of values.
+	
+	The column of each wanted field is cached from the header; later reads only compare
+	the header line and split the value line.
+	"""
+	
+	def __init__(self, path, pool, fields):
+		self.proc = ProcFile(path)
+		self.pool = pool
+		self.fields = fields
+		self.header = None
+		self.columns = None
+	
+	def sample(self):
+		"""Returns (pool, [counter, ...]) with counters ordered like self.fields."""
+		lines = self.proc.read().split("\n", 3)
+		if lines[1] != self.header:
+			names = lines[1].split()
+			self.columns = [names.index(field) for field in self.fields]
+			self.header = lines[1]
+		values = lines[2].split()
+		return (self.pool, [int(values[column]) for column in self.columns])
+
+
+class ZfsObjsetKstat:
+	"""A dataset's objset-* kstat: "name type data" lines, one per statistic.
+	
+	The line holding the dataset name and each wanted field is cached on the first read;
+	later reads only split those lines, re-parsing the whole file if the layout moved.
+	The name is read every time, so a zfs rename shows up on the next tick.
+	"""
+	
+	def __init__(self, path, fields):
+		self.proc = ProcFile(path)
+		self.fields = fields
+		self.lines = None
+	
+	def parse(self, lines):
+		"""Locates the dataset name and the wanted fields."""
+		positions = {}
+		for index in range(2, len(lines)):
+			columns = lines[index].split()
+			if len(columns) >= 3:
+				positions[columns[0]] = index
+		self.lines = [positions[field] for field in ["dataset_name"] + self.fields]
+	
+	def sample(self):
+		"""Returns (dataset, [counter, ...]) with counters ordered like self.fields."""
+		lines = self.proc.read().splitlines()
+		if self.lines == None:
+			self.parse(lines)
+		values = []
+		for x, field in enumerate(["dataset_name"] + self.fields):
+			columns = lines[self.lines[x]].split() if self.lines[x] < len(lines) else ()
+			if len(columns) < 3 or columns[0] != field:
+				self.parse(lines)
+				return self.sample()
+			values.append(columns[2])
+		return (values[0], [int(value) for value in values[1:]])
+
+
+class ZfsCollector(Collector):
+	"""Per-pool and per-dataset read/write ops and bytes from the ZFS on Linux kstats."""
+	
+	name = "zfs"
+	group = "zfs"
+	
+	def __init__(self, interval, registry, root=None):
+		Collector.__init__(self, interval, registry)
+		self.root = root or dirZfsKstat
+		self.pools = registry.table("zfs_pool", len(zfsPoolMetrics["field"]))
+		self.datasets = registry.table("zfs_dataset", len(zfsDatasetMetrics["field"]))
+		self.kstats = {}	# path -> ZfsIoKstat/ZfsObjsetKstat
+		self.lastScan = None
+	
+	def scan(self):
+		"""Opens kstats of newly created pools/datasets and forgets the ones that are gone."""
+		found = {}
+		for pool in os.listdir(self.root):
+			poolDir = os.path.join(self.root, pool)
+			if not os.path.isdir(poolDir):
+				continue
+			for entry in os.listdir(poolDir):
+				if entry == "io" or entry.startswith("objset-"):
+					path = os.path.join(poolDir, entry)
+					found[path] = self.kstats.get(path)
+					if found[path] == None:
+						try:
+							if entry == "io":
+								found[path] = ZfsIoKstat(path, pool, zfsPoolMetrics["field"])
+							else:
+								found[path] = ZfsObjsetKstat(path, zfsDatasetMetrics["field"])
+						except (IOError, OSError):
+							del found[path]
+		self.kstats = found
+		self.lastScan = monotonic()
+	
+	def collect(self):
+		if self.lastScan == None or monotonic() - self.lastScan >= zfsRescanInterval:
+			self.scan()
+		pools = []
+		datasets = []
+		vanished = False
+		for kstat in self.kstats.values():
+			try:
+				sample = kstat.sample()
+			except (IOError, OSError, IndexError, ValueError, KeyError):
+				vanished = True
+				continue
+			if isinstance(kstat, ZfsIoKstat):
+				pools.append(sample)
+			else:
+				datasets.append(sample)
+		if vanished:
+			self.lastScan = None	# Pick up renamed/destroyed pools and datasets next tick
+		now = monotonic()
+		pools, poolRates = self.pools.update(pools, now)
+		datasets, datasetRates = self.datasets.update(datasets, now)
+		return tableMetrics(zfsPoolMetrics, poolRates, pools) + \
+		       tableMetrics(zfsDatasetMetrics, datasetRates, [dataset.replace("/", "_") for dataset in datasets])
+	
+	def departed(self):
+		return tableNames(zfsPoolMetrics, self.pools.departures()) + \
+		       tableNames(zfsDatasetMetrics, [dataset.replace("/", "_") for dataset in self.datasets.departures()])
+
+
+for collector in (DiskCollector, NetDevCollector, MemInfoCollector, LoadAvgCollector, ZfsCollector):
+	registerCollector(collector)
+
+
+class CollectorWorker(threading.Thread):
+	"""Runs one collector whenever the scheduler triggers it and posts its metrics to a shared queue."""
+	
+	def __init__(self, collector, results):
+		threading.Thread.__init__(self, name="collector-" + collector.name)
+		self.setDaemon(True)
+		self.collector = collector
+		self.results = results
+		self.wake = threading.Event()
+		self.busy = False
+		self.due = None		# Next deadline this collector should run at
+		self.duration = 0.0	# Run time of the last collect()
+		self.skipped = 0
+		self.errors = 0
+	
+	def trigger(self):
+		"""Starts a collect() run unless the previous one is still going (counted as skipped)."""
+		if self.busy:
+			self.skipped = self.skipped + 1
+			return False
+		self.busy = True
+		self.wake.set()
+		return True
+	
+	def run(self):
+		while True:
+			self.wake.wait()
+			self.wake.clear()
+			started = monotonic()
+			try:
+				metrics = self.collector.collect()
+			except Exception, e:
+				self.errors = self.errors + 1
+				sys.stderr.write("Collector '%s' failed: %s\n" % (self.collector.name, str(e)))
+				metrics = []
+			self.duration = monotonic() - started
+			self.busy = False
+			self.results.put((self.collector, metrics, self.collector.departed()))
+
+
+class TickScheduler:
+	"""Fires ticks on fixed monotonic deadlines (start + n * interval).
+	
+	Work done inside a tick does not stretch the period. A tick whose work runs past the
+	next deadline counts as an overrun; deadlines already missed by then are skipped (and
+	counted) instead of being fired late in a burst.
+	"""
+	
+	def __init__(self, interval, clock=monotonic, sleep=time.sleep):
+		self.interval = float(interval)
+		self.clock = clock
+		self.sleep = sleep
+		self.deadline = clock() - self.interval		# First wait() fires immediately
+		self.started = None
+		self.ticks = 0
+		self.overruns = 0
+		self.skipped = 0
+		self.latency = 0.0	# Work time of the previous tick
+		self.maxLatency = 0.0	# Longest work time since the last stats() call
+		self.jitter = 0.0	# How late the current tick woke up
+	
+	def wait(self):
+		"""Sleeps until the next deadline and returns it."""
+		now = self.clock()
+		if self.started != None:
+			self.latency = now - self.started
+			self.maxLatency = max(self.maxLatency, self.latency)
+		self.deadline = self.deadline + self.interval
+		if now > self.deadline and self.ticks:
+			self.overruns = self.overruns + 1
+			missed = int((now - self.deadline) / self.interval)
+			self.skipped = self.skipped + missed
+			self.deadline = self.deadline + missed * self.interval
+		while now < self.deadline:
+			self.sleep(self.deadline - now)
+			now = self.clock()
+		self.jitter = now - self.deadline
+		self.started = now
+		self.ticks = self.ticks + 1
+		return self.deadline
+	
+	def stats(self):
+		"""Returns values for selfMetrics and starts a new max-latency window."""
+		values = [self.maxLatency * 1000.0, self.jitter * 1000.0, self.overruns, self.skipped]
+		self.maxLatency = 0.0
+		return values
+
+
+def formatValue(type, value):
+	"""Renders a metric value for the given gmetric type."""
+	if type in ("float", "double"):
+		return "%.2f" % value
+	return str(int(value + 0.5))
+
+
+class SendPolicy:
+	"""Decides which values are worth sending: changed beyond the thresholds, or heartbeat due."""
+	
+	def __init__(self, heartbeat):
+		self.heartbeat = heartbeat
+		self.last = {}		# name -> [last value sent, time sent]
+		self.sent = 0
+		self.suppressed = 0
+	
+	def forget(self, name):
+		"""Drops what was recorded for a metric that is no longer published."""
+		if name in self.last:
+			del self.last[name]
+	
+	def admit(self, name, value, now, absThreshold=0, relThreshold=0.0):
+		"""Returns True (and records the send) if value should go out now."""
+		last = self.last.get(name)
+		if last == None:
+			self.last[name] = [value, now]
+		else:
+			if self.heartbeat and now - last[1] < self.heartbeat:
+				change = abs(value - last[0])
+				if change <= absThreshold or change <= relThreshold * abs(last[0]):
+					self.suppressed = self.suppressed + 1
+					return False
+			last[0] = value
+			last[1] = now
+		self.sent = self.sent + 1
+		return True
+
+
+class Emitter:
+	"""Formats values and runs them through the send policy before a concrete emitter queues them."""
+	
+	def __init__(self):
+		self.policy = SendPolicy(sendHeartbeat)
+	
+	def add(self, name, value, type, unit, now, absThreshold=0, relThreshold=0.0, group=""):
+		"""Queues one metric value for the next flush() unless the send policy suppresses it."""
+		text = formatValue(type, value)
+		if self.policy.admit(name, float(text), now, absThreshold, relThreshold):
+			self.queue(name, text, type, unit, now, group)
+	
+	def forget(self, names):
+		"""Drops the per-metric state of metrics whose device went away."""
+		for name in names:
+			self.policy.forget(name)
+
+
+def xdrString(value):
+	"""XDR encodes a string: big-endian length, then the bytes padded to a 4-byte boundary."""
+	return struct.pack(">I", len(value)) + value + "\0" * ((4 - len(value) % 4) % 4)
+
+
+class XdrEmitter(Emitter):
+	"""Publishes metrics to gmond as Ganglia 3.1+ XDR packets over one persistent UDP socket.
+	
+	Values queued with add() during a tick go out back-to-back on flush(). Each metric's
+	metadata packet is pre-encoded once and re-sent only every gangliaMetadataInterval secs.
+	"""
+	
+	def __init__(self, host, port, ttl=1, hostname=None):
+		Emitter.__init__(self)
+		self.address = (host, int(port))
+		self.hostname = hostname or socket.gethostname()
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		if re.match(r'^2(2[4-9]|3\d)\.', host):	# Multicast group
+			self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+		self.metrics = {}	# name -> [metadata packet, value packet prefix, last metadata send]
+		self.batch = []
+		self.packetsSent = 0
+		self.sendErrors = 0
+	
+	def encodeMetadata(self, name, type, unit, group):
+		"""Builds the gmetadata_full (128) packet announcing a metric to gmond."""
+		packet = struct.pack(">i", 128) + xdrString(self.hostname) + xdrString(name) + \
+			 struct.pack(">i", 0) + xdrString(type) + xdrString(name) + xdrString(unit) + \
+			 struct.pack(">iII", gangliaSlopes[gangliaSlope], gangliaTmax, gangliaDmax)
+		if group:
+			packet = packet + struct.pack(">i", 1) + xdrString("GROUP") + xdrString(group)
+		else:
+			packet = packet + struct.pack(">i", 0)
+		return packet
+	
+	def queue(self, name, text, type, unit, now, group):
+		"""Queues one formatted value (and its metadata when due) for the next flush()."""
+		metric = self.metrics.get(name)
+		if metric == None:
+			metric = [self.encodeMetadata(name, type, unit, group),
+				  struct.pack(">i", 133) + xdrString(self.hostname) + xdrString(name) + \
+				  struct.pack(">i", 0) + xdrString("%s"),
+				  None]
+			self.metrics[name] = metric
+		if metric[2] == None or now - metric[2] >= gangliaMetadataInterval:
+			self.batch.append(metric[0])
+			metric[2] = now
+		self.batch.append(metric[1] + xdrString(text))
+	
+	def forget(self, names):
+		Emitter.forget(self, names)
+		for name in names:
+			if name in self.metrics:
+				del self.metrics[name]
+	
+	def flush(self):
+		"""Sends every queued packet back-to-back."""
+		sendto = self.sock.sendto
+		for packet in self.batch:
+			try:
+				sendto(packet, self.address)
+				self.packetsSent = self.packetsSent + 1
+			except socket.error:
+				self.sendErrors = self.sendErrors + 1
+		del self.batch[:]
+
+
+class GmetricEmitter(Emitter):
+	"""Publishes metrics by spawning cmdGmetric once per value."""
+	
+	def __init__(self, port):
+		Emitter.__init__(self)
+		self.port = port
+		self.batch = []
+	
+	def queue(self, name, text, type, unit, now, group):
+		self.batch.append(cmdGmetric + " --name=" + name + " --value=" + text + \
+				  " --type=" + type + " --units=\"" + unit + "\"" + \
+				  (group and " --group=" + group or "") + \
+				  " --tmax=" + str(gangliaTmax) + " --dmax=" + str(gangliaDmax) + \
+				  " --mcast_port=" + self.port)
+	
+	def flush(self):
+		for cmdExec in self.batch:
+			gmetricResult = os.system(cmdExec)
+		del self.batch[:]
+
+
+def createEmitter(emitter):
+	"""Builds the configured Ganglia emitter."""
+	if emitter == "xdr":
+		return XdrEmitter(gangliaHost, gangliaMcastPort, gangliaMcastTTL)
+	elif emitter == "gmetric":
+		return GmetricEmitter(gangliaMcastPort)
+	raise ValueError("Unknown Ganglia emitter '%s'." % emitter)
+
+
+def createCollectors(registry):
+	"""Imports plug-in modules and builds every collector enabled in collectorIntervals."""
+	for module in collectorModules:
+		__import__(module)
+	collectors = []
+	for name, collectInterval in sorted(collectorIntervals.items()):
+		if name not in collectorPlugins:
+			raise ValueError("Unknown collector '%s'." % name)
+		collectors.append(collectorPlugins[name](collectInterval, registry))
+	return collectors
+
+
+def runDaemon():
+	"""Main loop: triggers due collectors each tick and sends whatever they returned."""
+	emitter = createEmitter(gangliaEmitter)
+	results = Queue.Queue()
+	workers = []
+	for collector in createCollectors(Registry()):
+		workers.append(CollectorWorker(collector, results))
+		workers[-1].start()
+	scheduler = TickScheduler(min([interval] + [worker.collector.interval for worker in workers]))
+	lastSelfMetrics = None
+	while(1):
+		now = scheduler.wait()
+		# Wake Every Collector Whose Own Interval Has Elapsed
+		triggered = []
+		for worker in workers:
+			if worker.due == None or now >= worker.due - scheduler.interval / 2:
+				if worker.trigger():
+					triggered.append(worker)
+				worker.due = (worker.due or now) + worker.collector.interval
+				while worker.due <= now:
+					worker.due = worker.due + worker.collector.interval
+		# Queue Collected Metric Data, Waiting Briefly For This Tick's Collectors
+		waitUntil = now + scheduler.interval * collectWait
+		while [worker for worker in triggered if worker.busy] or not results.empty():
+			try:
+				collector, metrics, departed = results.get(True, max(0.0, waitUntil - monotonic()))
+			except Queue.Empty:
+				break
+			for name, value, type, unit, absThreshold, relThreshold in metrics:
+				emitter.add(name, value, type, unit, now, absThreshold, relThreshold, collector.group)
+			emitter.forget(departed)
+		# Queue Scheduler Self-Monitoring Data
+		if lastSelfMetrics == None or now - lastSelfMetrics >= selfMetricsInterval:
+			stats = scheduler.stats() + [emitter.policy.sent, emitter.policy.suppressed]
+			for x in range(0, len(selfMetrics["name"])):
+				emitter.add(selfMetrics["name"][x], stats[x], selfMetrics["type"][x], selfMetrics["unit"][x], now)
+			for worker in workers:
+				stats = [worker.duration * 1000.0, worker.skipped]
+				for x in range(0, len(collectorSelfMetrics["name"])):
+					emitter.add(collectorSelfMetrics["name"][x] + "_" + worker.collector.name, stats[x],
+						    collectorSelfMetrics["type"][x], collectorSelfMetrics["unit"][x], now)
+			lastSelfMetrics = now
+		emitter.flush()
+
+
+if __name__ == "__main__":
+	runDaemon()
@@ -0,0 +1,245 @@
+#!/usr/bin/python
+####################################################################
+# FILENAME: gmetric_disk_bench.py
+# PROJECT: gmetric For Disk IO
+# DESCRIPTION: Benchmarks the gmetric_disk.py sampling, delta and emit
+#       stages against synthetic /proc/diskstats and pminfo fixtures
+#       for any number of devices, sending to a local UDP sink.
+#       Reports per-tick CPU time, net object allocations and packet
+#       rates so collector regressions show up before deployment.
+#
+########################################################################################
+# (C)2010 DigiTar, All Rights Reserved
+# Distributed under the BSD License
+#
+# Redistribution and use in source and binary forms, with or without modification,
+#    are permitted provided that the following conditions are met:
+#
+#        * Redistributions of source code must retain the above copyright notice,
+#          this list of conditions and the following disclaimer.
+#        * Redistributions in binary form must reproduce the above copyright notice,
+#          this list of conditions and the following disclaimer in the documentation
+#          and/or other materials provided with the distribution.
+#        * Neither the name of DigiTar nor the names of its contributors may be
+#          used to endorse or promote products derived from this software without
+#          specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+#
+########################################################################################
+
+import os, sys, gc, time, socket, shutil, tempfile, resource
+from multiprocessing import Process, Pipe
+from optparse import OptionParser
+
+import gmetric_disk
+
+
+### Validate Commandline Arguments
+opt_parser = OptionParser(usage="%prog [--devices 1,10,100,1000,2000] [--ticks 20] [--backend diskstats,pcp]")
+
+opt_parser.add_option("-d", "--devices", dest="devices", default="1,10,100,1000,2000",
+                      help="Comma separated device counts to benchmark. (Default: 1,10,100,1000,2000)")
+opt_parser.add_option("-t", "--ticks", dest="ticks", type="int", default=20,
+                      help="Ticks to time per device count, after one baseline tick. (Default: 20)")
+opt_parser.add_option("-b", "--backend", dest="backends", default="diskstats,pcp",
+                      help="Comma separated collector backends to benchmark. (Default: diskstats,pcp)")
+opt_parser.add_option("-p", "--policy", action="store_true", dest="policy", default=False,
+                      help="Apply the configured send policy instead of sending every value.")
+
+
+## Fixture functions
+def device_names(count):
+    """Synthetic whole-disk names: sda..sdzz style disks, then NVMe namespaces."""
+    names = []
+    for x in range(count):
+        if x % 2 == 0:
+            index = x / 2
+            name = ""
+            while True:
+                name = chr(ord("a") + index % 26) + name
+                index = index / 26 - 1
+                if index < 0:
+                    break
+            names.append("sd" + name)
+        else:
+            names.append("nvme%dn1" % (x / 2))
+    return names
+
+def write_diskstats(path, names, tick):
+    """Writes a /proc/diskstats image whose counters advance differently for every device."""
+    lines = []
+    for x in range(len(names)):
+        step = tick * (x % 7 + 1)
+        lines.append("   8 %7d %s %d %d %d %d %d %d %d %d 0 %d %d 0 0 0 0" % \
+                     (x, names[x], 100 * step, step, 800 * step, 3 * step,
+                      50 * step, 2 * step, 400 * step, 2 * step, 4 * step, 6 * step))
+    f = open(path, "w")
+    f.write("\n".join(lines) + "\n")
+    f.close()
+
+def write_pminfo(path, names, tick, metrics):
+    """Writes `pminfo -f` style output for the given metrics."""
+    output = []
+    for y in range(len(metrics)):
+        output.append("\n" + metrics[y])
+        for x in range(len(names)):
+            output.append('    inst [%d or "%s"] value %d' % (x, names[x], tick * (x % 7 + 1) * (y + 1)))
+    f = open(path, "w")
+    f.write("\n".join(output) + "\n")
+    f.close()
+
+
+## UDP sink
+def udp_sink(sock, conn):
+    """Counts packets until told to stop over conn, then reports the count back."""
+    sock.settimeout(0.05)
+    packets = 0
+    while not conn.poll():
+        try:
+            while True:
+                sock.recv(65535)
+                packets = packets + 1
+        except socket.timeout:
+            pass
+    conn.recv()
+    conn.send(packets)
+
+
+## Benchmark
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def bench(backend, count, ticks, policy, workdir, port):
+    """Drives sample -> delta -> emit for one backend/device count. Returns a result dict."""
+    names = device_names(count)
+    metrics = gmetric_disk.gangliaMetrics["pcpmetric"] + gmetric_disk.diskExtraCounters["pcpmetric"]
+    fixture = os.path.join(workdir, "fixture")
+    if backend == "diskstats":
+        write_diskstats(fixture, names, 1)
+        sampler = gmetric_disk.DiskstatsSampler(fixture, gmetric_disk.gangliaMetrics["diskstatsfield"] + \
+                                                gmetric_disk.diskExtraCounters["diskstatsfield"])
+    else:
+        write_pminfo(fixture, names, 1, metrics)
+        pminfo = os.path.join(workdir, "pminfo")
+        f = open(pminfo, "w")
+        f.write("#!/bin/sh\ncat %s\n" % fixture)
+        f.close()
+        os.chmod(pminfo, 0755)
+        sampler = gmetric_disk.PcpSampler(pminfo, metrics)
+    registry = gmetric_disk.DeviceRegistry(len(metrics))
+    emitter = gmetric_disk.XdrEmitter("127.0.0.1", port)
+    if not policy:
+        emitter.policy.heartbeat = 0
+
+    stages = {"sample": 0.0, "delta": 0.0, "emit": 0.0}
+    cpu = []
+    objects = []
+    for tick in range(1, ticks + 2):
+        # Fixture rewrites are not part of the measured work
+        if backend == "diskstats":
+            write_diskstats(fixture, names, tick)
+        else:
+            write_pminfo(fixture, names, tick, metrics)
+        if tick == 2:
+            packetsBefore = emitter.packetsSent
+        gc.collect()
+        gc.disable()
+        gcBefore = gc.get_count()[0]
+        cpuBefore = cpu_time()
+
+        t0 = gmetric_disk.monotonic()
+        samples = sampler.sample()
+        t1 = gmetric_disk.monotonic()
+        devices, rates = registry.update(samples, t1)
+        t2 = gmetric_disk.monotonic()
+        for metric in gmetric_disk.tableMetrics(gmetric_disk.gangliaMetrics, rates, devices) + \
+                      gmetric_disk.tableMetrics(gmetric_disk.gangliaDerivedMetrics,
+                                                gmetric_disk.deriveDiskMetrics(rates), devices):
+            emitter.add(metric[0], metric[1], metric[2], metric[3], t2, metric[4], metric[5], "disk")
+        emitter.flush()
+        t3 = gmetric_disk.monotonic()
+
+        cpuAfter = cpu_time()
+        gcAfter = gc.get_count()[0]
+        gc.enable()
+        if tick >= 2:
+            stages["sample"] = stages["sample"] + (t1 - t0)
+            stages["delta"] = stages["delta"] + (t2 - t1)
+            stages["emit"] = stages["emit"] + (t3 - t2)
+            cpu.append(cpuAfter - cpuBefore)
+            objects.append(gcAfter - gcBefore)
+    busy = stages["sample"] + stages["delta"] + stages["emit"]
+    return {"backend": backend,
+            "devices": count,
+            "cpu_ms": sum(cpu) / len(cpu) * 1000.0,
+            "cpu_max_ms": max(cpu) * 1000.0,
+            "sample_ms": stages["sample"] / ticks * 1000.0,
+            "delta_ms": stages["delta"] / ticks * 1000.0,
+            "emit_ms": stages["emit"] / ticks * 1000.0,
+            "objects": sum(objects) / len(objects),
+            "sent": emitter.packetsSent - packetsBefore,
+            "packets": (emitter.packetsSent - packetsBefore) / ticks,
+            "packets_per_sec": busy and (emitter.packetsSent - packetsBefore) / busy or 0,
+            "send_errors": emitter.sendErrors}
+
+
+## Main
+if __name__ == "__main__":
+    args = opt_parser.parse_args()[0]
+    try:
+        counts = [int(count) for count in args.devices.split(",")]
+    except ValueError, e:
+        print "Device counts (--devices) must be comma separated integers. Please see --help for more details."
+        sys.exit(-1)
+    backends = args.backends.split(",")
+    for backend in backends:
+        if backend not in ("diskstats", "pcp"):
+            print "Unknown backend '%s'. Please see --help for more details." % backend
+            sys.exit(-1)
+    if args.ticks < 1:
+        print "Tick count (--ticks) must be at least 1. Please see --help for more details."
+        sys.exit(-1)
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    sink.bind(("127.0.0.1", 0))
+    sink_conn, bench_conn = Pipe()
+    sink_proc = Process(target=udp_sink, args=(sink, sink_conn))
+    sink_proc.start()
+
+    workdir = tempfile.mkdtemp(prefix="gmetric_disk_bench.")
+    gmetric_disk.dirSysBlock = os.path.join(workdir, "no-sys-block")	# Treat every fixture device as a disk
+    sent = 0
+    print "%-9s %7s %9s %9s %9s %9s %9s %9s %9s %11s" % \
+          ("backend", "devices", "cpu_ms", "cpu_max", "sample_ms", "delta_ms", "emit_ms",
+           "objects", "pkts/tick", "pkts/sec")
+    try:
+        for backend in backends:
+            for count in counts:
+                result = bench(backend, count, args.ticks, args.policy, workdir, sink.getsockname()[1])
+                sent = sent + result["sent"]
+                print "%-9s %7d %9.3f %9.3f %9.3f %9.3f %9.3f %9d %9d %11.0f" % \
+                      (result["backend"], result["devices"], result["cpu_ms"], result["cpu_max_ms"],
+                       result["sample_ms"], result["delta_ms"], result["emit_ms"], result["objects"],
+                       result["packets"], result["packets_per_sec"])
+                if result["send_errors"]:
+                    print "\t%d send errors." % result["send_errors"]
+    finally:
+        shutil.rmtree(workdir, True)
+        time.sleep(0.2)
+        bench_conn.send("stop")
+        received = bench_conn.recv()
+        sink_proc.join()
+    print "\nUDP sink received %d packets (%d sent, metadata included)." % (received, sent)
+    print "objects = net GC-tracked objects allocated per tick (gc disabled during the tick)."
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+####################################################################
+# FILENAME: test_gmetric_disk.py
+# PROJECT: gmetric For Disk IO
+# DESCRIPTION: Unit tests for gmetric_disk.py's counter handling, kstat
+#	parsing and emitter state:
+#
+#	python -m unittest discover -s ganglia -p "test_*.py"
+#
+########################################################################################
+
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import gmetric_disk
+
+
+class CounterDeltaTest(unittest.TestCase):
+
+	def test_forward(self):
+		self.assertEqual(gmetric_disk.counterDelta(1500, 1000), 500)
+
+	def test_32bit_wrap(self):
+		self.assertEqual(gmetric_disk.counterDelta(10, 4294967290), 16)
+
+	def test_64bit_wrap(self):
+		self.assertEqual(gmetric_disk.counterDelta(10, 18446744073709551610), 16)
+
+	def test_reset(self):
+		self.assertEqual(gmetric_disk.counterDelta(5, 1000000), None)
+		self.assertEqual(gmetric_disk.counterDelta(5, 5000000000), None)
+
+	def test_reset_rebaselines_device(self):
+		registry = gmetric_disk.DeviceRegistry(1)
+		registry.update([("sda", [1000000])], 1.0)
+		devices, rates = registry.update([("sda", [5])], 2.0)
+		self.assertEqual(devices, [])
+		devices, rates = registry.update([("sda", [105])], 3.0)
+		self.assertEqual((devices, list(rates[0])), (["sda"], [100.0]))
+
+
+class ZfsObjsetKstatTest(unittest.TestCase):
+
+	def setUp(self):
+		self.workdir = tempfile.mkdtemp(prefix="test_gmetric_disk.")
+		self.path = os.path.join(self.workdir, "objset-0x36")
+
+	def tearDown(self):
+		shutil.rmtree(self.workdir, True)
+
+	def writeKstat(self, dataset, writes):
+		f = open(self.path, "w")
+		f.write("36 1 0x01 7 2160 5017983292 70892717036\n"
+			"name                            type data\n"
+			"dataset_name                    7    %s\n"
+			"writes                          4    %d\n"
+			"nwritten                        4    %d\n" % (dataset, writes, writes * 4096))
+		f.close()
+
+	def test_rename(self):
+		self.writeKstat("tank/db", 10)
+		kstat = gmetric_disk.ZfsObjsetKstat(self.path, ["writes", "nwritten"])
+		self.assertEqual(kstat.sample(), ("tank/db", [10, 40960]))
+		self.writeKstat("tank/db_old", 11)
+		self.assertEqual(kstat.sample(), ("tank/db_old", [11, 45056]))
+
+
+class DepartedDeviceTest(unittest.TestCase):
+
+	def setUp(self):
+		self.workdir = tempfile.mkdtemp(prefix="test_gmetric_disk.")
+		self.savedNetDev = gmetric_disk.fnNetDev
+		gmetric_disk.fnNetDev = os.path.join(self.workdir, "dev")
+
+	def tearDown(self):
+		gmetric_disk.fnNetDev = self.savedNetDev
+		shutil.rmtree(self.workdir, True)
+
+	def writeNetDev(self, interfaces, count):
+		f = open(gmetric_disk.fnNetDev, "w")
+		f.write("Inter-|   Receive\n face |bytes\n")
+		for interface in interfaces:
+			f.write("%s: %s\n" % (interface, " ".join([str(count)] * 16)))
+		f.close()
+
+	def test_emitter_forgets_departed_interface(self):
+		self.writeNetDev(["eth0", "veth1"], 0)
+		collector = gmetric_disk.NetDevCollector(15, gmetric_disk.Registry())
+		emitter = gmetric_disk.XdrEmitter("127.0.0.1", 8649)
+		for count in (100, 200, 300):
+			self.writeNetDev(["eth0", "veth1"], count)
+			for metric in collector.collect():
+				emitter.add(metric[0], metric[1], metric[2], metric[3], count, metric[4], metric[5], "network")
+			emitter.forget(collector.departed())
+		self.assert_("net_rxbytes_veth1" in emitter.policy.last)
+		self.assert_("net_rxbytes_veth1" in emitter.metrics)
+		self.writeNetDev(["eth0"], 400)
+		collector.collect()
+		departed = collector.departed()
+		self.assertEqual(sorted(departed), sorted(gmetric_disk.tableNames(gmetric_disk.netDevMetrics, ["veth1"])))
+		emitter.forget(departed)
+		self.assertEqual(sorted(emitter.policy.last), sorted(gmetric_disk.tableNames(gmetric_disk.netDevMetrics, ["eth0"])))
+		self.assertEqual(sorted(emitter.metrics), sorted(emitter.policy.last))
+		self.assertEqual(collector.departed(), [])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,169 +1,1374 @@
-#!/usr/bin/python
-####################################################################
-# FILENAME: mysql_snapback.py
-# PROJECT: Miscellaneous Tools
-# DESCRIPTION: Quiesces a MySQL server and uses ZFS to pull a backup
-#       by snapshotting both the database and log filesystems during
-#       the quiesced state. SnapBack is InnoDB aware/safe (sets 
-#       AUTOCOMMIT=0 before beginning). Also, it will record the 
-#       current master replication log file name and position in the
-#       ZFS snapshot name. 
-#
-#
-# $Id: mysql_snapback.py 1524 2008-01-16 19:08:14Z  $
-########################################################################################
-# (C)2009 DigiTar, All Rights Reserved
-# Distributed under the BSD License
-# 
-# Redistribution and use in source and binary forms, with or without modification, 
-#    are permitted provided that the following conditions are met:
-#
-#        * Redistributions of source code must retain the above copyright notice, 
-#          this list of conditions and the following disclaimer.
-#        * Redistributions in binary form must reproduce the above copyright notice, 
-#          this list of conditions and the following disclaimer in the documentation 
-#          and/or other materials provided with the distribution.
-#        * Neither the name of DigiTar nor the names of its contributors may be
-#          used to endorse or promote products derived from this software without 
-#          specific prior written permission.
-#
-# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY 
-# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES 
-# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT 
-# SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, 
-# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED 
-# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR 
-# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
-# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN 
-# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
-# DAMAGE.
-#
-########################################################################################
-
-import ConfigParser
-import MySQLdb
-from optparse import OptionParser
-import sys,os,time,commands,re
-
-### Globals & Constants
-_txt_program_revision = "1.1"
-_txt_program_name = "DigiTar SnapBack (MySQL)"
-
-### Find the configuration file
-
-_args_parser = OptionParser(usage="%prog --filename snapback.cfg", version=_txt_program_name + " " + _txt_program_revision)
-_args_parser.add_option("-f", "--filename", dest="FN_CONFIG",help="Configuration file containing MySQL and ZFS settings to use for backup run.")
-
-_arg_program_options, _arg_leftover = _args_parser.parse_args()
-
-if _arg_program_options.FN_CONFIG==None:
-    print "\nMust supply a configuration filename. Please use --help for syntax."
-    sys.exit(-1)
-
-### Load in configuration settings
-_config_parser = ConfigParser.SafeConfigParser()
-try:
-    _f_config = open(_arg_program_options.FN_CONFIG)
-except IOError, e:
-    print "\nCannot find " + _arg_program_options.FN_CONFIG + ". Please check the argument and try again."
-    sys.exit(-2)
-
-_config_parser.readfp(_f_config)
-
-# Validate individual required options
-try:
-    _mysql_server = _config_parser.get("MySQL","server")
-    _mysql_user = _config_parser.get("MySQL","user")
-    _mysql_pass = _config_parser.get("MySQL","password")
-
-    _fn_zfs_cmd = _config_parser.get("ZFS","zfs_command")
-    _fn_zfs_db_fs = _config_parser.get("ZFS","db_fs_name")
-    _bool_master_naming = _config_parser.getboolean("ZFS","masterinfo_naming")
-except ConfigParser.NoOptionError, e:
-    print "\n" + repr(e)
-    print "Please make sure all required sections and options are supplied and try again."
-    _f_config.close()
-    sys.exit(-3)
-
-# Treat log_fs_name option separately as it is optional. If not present, we will
-# set it to the same as db_fs_name.
-try:
-    _fn_zfs_log_fs = _config_parser.get("ZFS","log_fs_name")
-except ConfigParser.NoOptionError:
-    _fn_zfs_log_fs = _fn_zfs_db_fs
-    pass
-_f_config.close()
-
-
-### Verify ZFS FS are present
-_zfs_list_status,_zfs_list_output  = commands.getstatusoutput(_fn_zfs_cmd + " list")
-if not re.compile(_fn_zfs_db_fs).search(_zfs_list_output, 1):
-    print "\nNo ZFS DB filesystem named " + _fn_zfs_db_fs + " exists. Please check your configuration and try again."
-    sys.exit(-4)
-if _fn_zfs_db_fs != _fn_zfs_log_fs:
-    if not re.compile(_fn_zfs_log_fs).search(_zfs_list_output, 1):
-        print "No ZFS Log filesystem named " + _fn_zfs_log_fs + " exists. Please check your configuration and try again."
-        sys.exit(-4)
-print "\nAll specified ZFS filesystems are present."
-
-### Connect to MySQL
-print "\n\nSnapBack is connecting to MySQL:"
-try:
-    _db_backup = MySQLdb.connect(host=_mysql_server, user=_mysql_user, passwd=_mysql_pass)
-except MySQLdb.OperationalError:
-    print "Unable to connect to MySQL server " + _mysql_server + ". Please check the configuration file and try again."
-    sys.exit(-5)
-print "\tConnected to " + _mysql_server + "."
-_cu_backup = _db_backup.cursor()
-
-_time_snapshot = time.strftime("%Y%m%d%H%M%S")
-
-# Make operation InnoDB safe/consistent.
-_cu_backup.execute("SET AUTOCOMMIT=0;")
-print "\tPrepared MySQL to ensure InnoDB consistency."
-
-### Pull ZFS snapshots.
-
-print "\n\nSnapBack is commencing snapshot run:"
-print "\tLocking tables (if this is taking awhile please check the MySQL process list)."
-_cu_backup.execute("FLUSH TABLES WITH READ LOCK;")
-print "\tTables locked."
-_cu_backup.execute("SHOW MASTER STATUS;")
-_rows_master_status = _cu_backup.fetchone()
-# Notate current master log file and position if master_naming is on
-if _bool_master_naming == True:
-    _txt_master_status = "_" + str(_rows_master_status[0]) + "_" + str(_rows_master_status[1])
-else:
-    _txt_master_status = ""
-print "\tMaster status retrieved."
-
-try:
-    # Snapshot DB
-    print "\tSnapping ZFS DB filesystem."
-    _zfs_dbsnap_status,_zfs_dbsnap_output = commands.getstatusoutput(_fn_zfs_cmd + " snapshot " + _fn_zfs_db_fs + "@" + _time_snapshot + _txt_master_status)
-    if str(_zfs_dbsnap_status) != "0":
-        print "An error occurred while executing the ZFS snapshot on " + _fn_zfs_db_fs + ". Unlocking tables and quitting."
-        _cu_backup.execute("UNLOCK TABLES;")
-        sys.exit(-7)
-    # Snapshot Logs (if specified)
-    if _fn_zfs_db_fs != _fn_zfs_log_fs:
-        print "\tSnapping ZFS Log filesystem."
-        _zfs_logsnap_status,_zfs_logsnap_output = commands.getstatusoutput(_fn_zfs_cmd + " snapshot " + _fn_zfs_log_fs + "@" + _time_snapshot + _txt_master_status)
-        if str(_zfs_logsnap_status) != "0":
-            print "An error occurred while executing the ZFS snapshot on " + _fn_zfs_log_fs + ". Unlocking tables and quitting."
-            _cu_backup.execute("UNLOCK TABLES;")
-            sys.exit(-7)
-except:
-    _cu_backup.execute("UNLOCK TABLES;")
-    print "\tAn unrecoverable error occurred while trying to pull the snapshots. We have unlocked the tables. Please check your system logs for details as to the ZFS error."
-    sys.exit(-7)
-
-print "\tUnlocking tables."
-_cu_backup.execute("UNLOCK TABLES;")
-print "\tTables unlocked."
-print "SnapBack snapshot run completed."
-
-print "\n\nSnapshots created:"
-print "\t" + _fn_zfs_db_fs + "@" + _time_snapshot + _txt_master_status
-if _fn_zfs_db_fs != _fn_zfs_log_fs:
-    print "\t" + _fn_zfs_log_fs + "@" + _time_snapshot + _txt_master_status
+#!/usr/bin/python
+####################################################################
+# FILENAME: mysql_snapback.py
+# PROJECT: Miscellaneous Tools
+# DESCRIPTION: Quiesces a MySQL server and uses ZFS to pull a backup
+#       by snapshotting both the database and log filesystems during
+#       the quiesced state. SnapBack is InnoDB aware/safe (sets 
+#       AUTOCOMMIT=0 before beginning). Also, it will record the 
+#       current master replication log file name and position in the
+#       ZFS snapshot name. The database and log filesystems are snapped
+#       in one atomic zfs snapshot call, and everything that can be
+#       prepared before the lock is, to keep the read lock short.
+#       Before locking, long-running queries are waited out (or the run
+#       aborted), tables are pre-flushed, and FLUSH TABLES WITH READ
+#       LOCK is bounded by lock_wait_timeout and retried, so a busy
+#       master's writes are never stalled for long.
+#
+#       The catalog subcommand reads SnapBack snapshots back: it lists
+#       them, finds the nearest snapshot at or before a binlog position
+#       or time, and prunes them with grandfather-father-son retention.
+#       With a [Replication] section, each run then ships the new snapshots
+#       offsite as incremental zfs send streams, piped through a compressor
+#       and a bounded buffer to a directory, a file or a zfs receive command.
+#       One configuration can hold many [instance:<name>] servers; they are
+#       backed up in parallel, with lock phases on a shared zpool taken in turn.
+#       Every phase is timed and can be written as JSON lines or sent to
+#       statsd or Ganglia.
+#       With a [Verify] section, each new snapshot is read back into a
+#       sorted checksum manifest, hashing only the files zfs diff reports
+#       changed since the last verified snapshot.
+#
+#
+# $Id: mysql_snapback.py 1524 2008-01-16 19:08:14Z  $
+########################################################################################
+# (C)2009 DigiTar, All Rights Reserved
+# Distributed under the BSD License
+# 
+# Redistribution and use in source and binary forms, with or without modification, 
+#    are permitted provided that the following conditions are met:
+#
+#        * Redistributions of source code must retain the above copyright notice, 
+#          this list of conditions and the following disclaimer.
+#        * Redistributions in binary form must reproduce the above copyright notice, 
+#          this list of conditions and the following disclaimer in the documentation 
+#          and/or other materials provided with the distribution.
+#        * Neither the name of DigiTar nor the names of its contributors may be
+#          used to endorse or promote products derived from this software without 
+#          specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY 
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES 
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT 
+# SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, 
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED 
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR 
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN 
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+#
+########################################################################################
+
+import ConfigParser
+import MySQLdb
+from optparse import OptionParser
+import sys,os,time,commands,re,bisect,shlex,signal,subprocess,tempfile,threading,Queue,fcntl,socket,json,atexit
+import hashlib,mmap,multiprocessing
+
+### Globals & Constants
+_txt_program_revision = "1.1"
+_txt_program_name = "DigiTar SnapBack (MySQL)"
+
+### Monotonic clock for phase timings (immune to NTP steps; time.monotonic() only exists on Python 3.3+)
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    try:
+        import ctypes, ctypes.util
+        
+        class _timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+        
+        _clock_gettime = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"),
+                                     use_errno=True).clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        
+        def _monotonic():
+            """Seconds from CLOCK_MONOTONIC (1 on Linux)."""
+            _ts = _timespec()
+            if _clock_gettime(1, ctypes.byref(_ts)) != 0:
+                raise OSError(ctypes.get_errno(), "clock_gettime(CLOCK_MONOTONIC) failed")
+            return _ts.tv_sec + _ts.tv_nsec * 1e-9
+    except (ImportError, OSError, AttributeError, TypeError):
+        _monotonic = time.time
+
+### Find the configuration file
+
+_args_parser = OptionParser(usage="%prog --filename snapback.cfg [--instance name]\n"
+                                   "       %prog --filename snapback.cfg catalog list\n"
+                                   "       %prog --filename snapback.cfg catalog find binlog <file>:<position>\n"
+                                   "       %prog --filename snapback.cfg catalog find time <YYYYmmddHHMMSS>\n"
+                                   "       %prog --filename snapback.cfg [--dry-run] catalog prune\n"
+                                   "       %prog --filename snapback.cfg catalog replicate\n"
+                                   "       %prog --filename snapback.cfg catalog verify\n"
+                                   "       %prog --filename snapback.cfg catalog checksum <snapshot> <path>\n\n"
+                                   "Catalog commands take --instance when the configuration has [instance:<name>] sections.",
+                            version=_txt_program_name + " " + _txt_program_revision)
+_args_parser.add_option("-f", "--filename", dest="FN_CONFIG",help="Configuration file containing MySQL and ZFS settings to use for backup run.")
+_args_parser.add_option("-i", "--instance", dest="INSTANCE",
+                        help="Back up only this [instance:<name>] of a multi-instance configuration.")
+_args_parser.add_option("-n", "--dry-run", action="store_true", dest="DRY_RUN", default=False,
+                        help="catalog prune: only show which snapshots would be destroyed.")
+
+_arg_program_options, _arg_leftover = _args_parser.parse_args()
+
+if _arg_program_options.FN_CONFIG==None:
+    print "\nMust supply a configuration filename. Please use --help for syntax."
+    sys.exit(-1)
+if _arg_leftover and not (_arg_leftover[0] == "catalog" and \
+                          (_arg_leftover[1:] in (["list"], ["prune"], ["replicate"], ["verify"]) or \
+                           (len(_arg_leftover) == 4 and _arg_leftover[1] == "find" and _arg_leftover[2] in ("binlog", "time")) or \
+                           (len(_arg_leftover) == 4 and _arg_leftover[1] == "checksum"))):
+    print "\nUnknown command " + " ".join(_arg_leftover) + ". Please use --help for syntax."
+    sys.exit(-1)
+
+### Load in configuration settings
+_config_parser = ConfigParser.SafeConfigParser()
+try:
+    _f_config = open(_arg_program_options.FN_CONFIG)
+except IOError, e:
+    print "\nCannot find " + _arg_program_options.FN_CONFIG + ". Please check the argument and try again."
+    sys.exit(-2)
+
+_config_parser.readfp(_f_config)
+
+# Multi-instance configurations have an [instance:<name>] section per MySQL server,
+# holding its [MySQL] and [ZFS] options. The plain [MySQL]/[ZFS] sections, if present,
+# supply shared defaults, and %(instance)s interpolates to the instance name.
+_list_instances = [_section.split(":", 1)[1] for _section in _config_parser.sections() if _section.startswith("instance:")]
+_set_mysql_options = set(["server", "user", "password", "preflush", "long_query_limit", "long_query_action",
+                          "long_query_wait", "lock_wait_timeout", "lock_retries"])
+_set_zfs_options = set(["zfs_command", "db_fs_name", "log_fs_name", "masterinfo_naming"])
+def _instance_options(_instance):
+    return [_option for _option in _config_parser.options("instance:" + _instance) if _option not in _config_parser.defaults()]
+for _instance in _list_instances:
+    for _option in _instance_options(_instance):
+        if _option not in _set_mysql_options and _option not in _set_zfs_options:
+            print "\nInvalid setting in [instance:" + _instance + "]: unknown option " + _option
+            print "Please correct the configuration file and try again."
+            _f_config.close()
+            sys.exit(-3)
+if _arg_program_options.INSTANCE != None:
+    if _arg_program_options.INSTANCE not in _list_instances:
+        print "\nNo [instance:" + _arg_program_options.INSTANCE + "] section in " + _arg_program_options.FN_CONFIG + "."
+        _f_config.close()
+        sys.exit(-3)
+    _config_parser.defaults()["instance"] = _arg_program_options.INSTANCE
+    for _option in _instance_options(_arg_program_options.INSTANCE):
+        _section = _option in _set_mysql_options and "MySQL" or "ZFS"
+        if not _config_parser.has_section(_section):
+            _config_parser.add_section(_section)
+        _config_parser.set(_section, _option, _config_parser.get("instance:" + _arg_program_options.INSTANCE, _option, True))
+elif _list_instances and _arg_leftover:
+    print "\nCatalog commands need --instance with a multi-instance configuration. Please use --help for syntax."
+    _f_config.close()
+    sys.exit(-1)
+
+# Optional [Scheduler] settings for multi-instance runs.
+#   concurrency: instances backed up at the same time.
+#   lock_dir: where the per-zpool lock files that stagger the FTWRL phases live.
+try:
+    _int_concurrency = 4
+    if _config_parser.has_option("Scheduler","concurrency"):
+        _int_concurrency = _config_parser.getint("Scheduler","concurrency")
+    _fn_lock_dir = tempfile.gettempdir()
+    if _config_parser.has_option("Scheduler","lock_dir"):
+        _fn_lock_dir = _config_parser.get("Scheduler","lock_dir")
+    if _int_concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    if not os.path.isdir(_fn_lock_dir):
+        raise ValueError("lock_dir " + _fn_lock_dir + " does not exist")
+except ValueError, e:
+    print "\nInvalid setting in [Scheduler]: " + str(e)
+    print "Please correct the configuration file and try again."
+    _f_config.close()
+    sys.exit(-3)
+
+### Back up every instance
+def _instance_option(_instance, _section, _option):
+    """Returns an instance's option (or the shared default), with %(instance)s expanded."""
+    if _config_parser.has_option("instance:" + _instance, _option):
+        return _config_parser.get("instance:" + _instance, _option, False, {"instance": _instance})
+    if _config_parser.has_option(_section, _option):
+        return _config_parser.get(_section, _option, False, {"instance": _instance})
+    return None
+
+def _run_instances():
+    """Runs this script once per instance, at most concurrency at a time.
+    
+    Instances are started round-robin across zpools so the ones running together are
+    spread over different pools; the per-pool lock files then only serialize the lock
+    phases of instances sharing a pool. Returns True if every instance succeeded.
+    """
+    _dict_outcomes = {-2: "config missing", -3: "config invalid", -4: "zfs filesystem missing",
+                      -5: "mysql connect failed", -6: "lock not taken", -7: "snapshot failed",
+                      -10: "replication failed", -12: "verification failed"}
+    _dict_by_pool = {}
+    for _instance in _list_instances:
+        _fs = _instance_option(_instance, "ZFS", "db_fs_name") or ""
+        _dict_by_pool.setdefault(_fs.split("/")[0], []).append(_instance)
+    _list_pending = []
+    while _dict_by_pool:
+        for _pool in sorted(_dict_by_pool.keys()):
+            _list_pending.append(_dict_by_pool[_pool].pop(0))
+            if not _dict_by_pool[_pool]:
+                del _dict_by_pool[_pool]
+    
+    print "\n\nSnapBack is backing up %d instances, %d at a time:" % (len(_list_pending), _int_concurrency)
+    _dict_running = {}	# instance -> (process, output file, start time)
+    _list_results = []
+    while _list_pending or _dict_running:
+        while _list_pending and len(_dict_running) < _int_concurrency:
+            _instance = _list_pending.pop(0)
+            _f_output = tempfile.TemporaryFile()
+            _dict_running[_instance] = (subprocess.Popen([sys.executable, os.path.abspath(sys.argv[0]),
+                                                          "--filename", _arg_program_options.FN_CONFIG,
+                                                          "--instance", _instance],
+                                                         stdout=_f_output, stderr=subprocess.STDOUT),
+                                        _f_output, _monotonic())
+            print "\tStarted " + _instance + "."
+        time.sleep(0.1)
+        for _instance, (_process, _f_output, _secs_start) in _dict_running.items():
+            if _process.poll() == None:
+                continue
+            del _dict_running[_instance]
+            _f_output.seek(0)
+            _txt_output = _f_output.read()
+            _f_output.close()
+            _match_hold = re.search(r"Read lock held for ([\d.]+)s", _txt_output)
+            _match_wait = re.search(r"Waited ([\d.]+)s for the zpool lock", _txt_output)
+            _list_results.append((_instance, _process.returncode,
+                                  _match_hold and float(_match_hold.group(1)) or None,
+                                  _match_wait and float(_match_wait.group(1)) or 0.0,
+                                  _monotonic() - _secs_start))
+            print "\n==== " + _instance + " (exit %d) ====" % _process.returncode
+            print _txt_output.strip()
+            print
+    
+    print "\n\nSummary:"
+    print "\t%-20s %-28s %10s %10s %10s" % ("instance", "outcome", "lock held", "pool wait", "elapsed")
+    for _instance, _int_status, _secs_hold, _secs_wait, _secs_elapsed in sorted(_list_results):
+        if _int_status == 0:
+            _txt_outcome = "ok"
+        else:
+            _int_status = _int_status > 0 and _int_status - 256 or _int_status	# Back to sys.exit()'s -N
+            _txt_outcome = _dict_outcomes.get(_int_status, "failed") + " (%d)" % _int_status
+        print "\t%-20s %-28s %10s %9.3fs %9.1fs" % (_instance, _txt_outcome,
+                                                    _secs_hold != None and "%.3fs" % _secs_hold or "-",
+                                                    _secs_wait, _secs_elapsed)
+    _int_failed = len([_result for _result in _list_results if _result[1] != 0])
+    print "%d of %d instances backed up." % (len(_list_results) - _int_failed, len(_list_results))
+    return _int_failed == 0
+
+if _list_instances and _arg_program_options.INSTANCE == None:
+    _f_config.close()
+    if not _run_instances():
+        sys.exit(-11)
+    sys.exit(0)
+
+# Validate individual required options
+try:
+    _mysql_server = _config_parser.get("MySQL","server")
+    _mysql_user = _config_parser.get("MySQL","user")
+    _mysql_pass = _config_parser.get("MySQL","password")
+
+    _fn_zfs_cmd = _config_parser.get("ZFS","zfs_command")
+    _fn_zfs_db_fs = _config_parser.get("ZFS","db_fs_name")
+    _bool_master_naming = _config_parser.getboolean("ZFS","masterinfo_naming")
+except ConfigParser.NoOptionError, e:
+    print "\n" + repr(e)
+    print "Please make sure all required sections and options are supplied and try again."
+    _f_config.close()
+    sys.exit(-3)
+
+# Treat log_fs_name option separately as it is optional. If not present, we will
+# set it to the same as db_fs_name.
+try:
+    _fn_zfs_log_fs = _config_parser.get("ZFS","log_fs_name")
+except ConfigParser.NoOptionError:
+    _fn_zfs_log_fs = _fn_zfs_db_fs
+    pass
+
+# Optional lock tuning, see the README.
+#   preflush: run a plain FLUSH TABLES before locking, so FTWRL has little left to flush.
+#   long_query_limit: queries running at least this many secs would hold up the lock.
+#   long_query_action: "wait" for them (with backoff, up to long_query_wait secs) or "abort".
+#   lock_wait_timeout: secs FLUSH TABLES / FTWRL may wait (and stall writes) before giving up.
+#   lock_retries: FTWRL attempts after the first that timed out.
+try:
+    _bool_preflush = True
+    if _config_parser.has_option("MySQL","preflush"):
+        _bool_preflush = _config_parser.getboolean("MySQL","preflush")
+    _secs_long_query_limit = 60
+    if _config_parser.has_option("MySQL","long_query_limit"):
+        _secs_long_query_limit = _config_parser.getint("MySQL","long_query_limit")
+    _txt_long_query_action = "wait"
+    if _config_parser.has_option("MySQL","long_query_action"):
+        _txt_long_query_action = _config_parser.get("MySQL","long_query_action")
+    _secs_long_query_wait = 300
+    if _config_parser.has_option("MySQL","long_query_wait"):
+        _secs_long_query_wait = _config_parser.getint("MySQL","long_query_wait")
+    _secs_lock_wait_timeout = 10
+    if _config_parser.has_option("MySQL","lock_wait_timeout"):
+        _secs_lock_wait_timeout = _config_parser.getint("MySQL","lock_wait_timeout")
+    _int_lock_retries = 3
+    if _config_parser.has_option("MySQL","lock_retries"):
+        _int_lock_retries = _config_parser.getint("MySQL","lock_retries")
+    if _txt_long_query_action not in ("wait", "abort"):
+        raise ValueError("long_query_action must be 'wait' or 'abort'")
+    if _secs_long_query_limit < 1 or _secs_long_query_wait < 0 or _secs_lock_wait_timeout < 1 or _int_lock_retries < 0:
+        raise ValueError("long_query_limit and lock_wait_timeout must be at least 1, long_query_wait and lock_retries not negative")
+except ValueError, e:
+    print "\nInvalid lock setting in [MySQL]: " + str(e)
+    print "Please correct the configuration file and try again."
+    _f_config.close()
+    sys.exit(-3)
+
+# Optional offsite replication, see the README.
+#   target: dir:<directory>, file:<path template> or receive:<command template>, the
+#     templates taking %(fs)s, %(fs_name)s, %(snapshot)s, %(base)s and %(instance)s
+#   compress: none, gzip, pigz, lz4, zstd or xz
+#   buffer_mb: megabytes buffered between the compressor and the target
+#   state_file: record of the last snapshot shipped per dataset
+#   allow_full: send a full stream when there is no incremental base
+_dict_replication = None
+if _config_parser.has_section("Replication"):
+    _dict_compressors = {"none": (None, ""),
+                         "gzip": ("gzip -c", ".gz"),
+                         "pigz": ("pigz -c", ".gz"),
+                         "lz4": ("lz4 -c", ".lz4"),
+                         "zstd": ("zstd -c -q", ".zst"),
+                         "xz": ("xz -c", ".xz")}
+    try:
+        _txt_target = _config_parser.get("Replication","target", True)
+        _fn_replication_state = _config_parser.get("Replication","state_file")
+        _txt_compress = "none"
+        if _config_parser.has_option("Replication","compress"):
+            _txt_compress = _config_parser.get("Replication","compress")
+        _int_buffer_mb = 64
+        if _config_parser.has_option("Replication","buffer_mb"):
+            _int_buffer_mb = _config_parser.getint("Replication","buffer_mb")
+        _bool_allow_full = False
+        if _config_parser.has_option("Replication","allow_full"):
+            _bool_allow_full = _config_parser.getboolean("Replication","allow_full")
+        if ":" not in _txt_target or _txt_target.split(":", 1)[0] not in ("dir", "file", "receive"):
+            raise ValueError("target must be dir:<directory>, file:<path> or receive:<command>")
+        if _txt_target.startswith("dir:") and not os.path.isdir(_txt_target[4:]):
+            raise ValueError("target directory " + _txt_target[4:] + " does not exist")
+        if not _txt_target.startswith("dir:"):
+            try:
+                _txt_target.split(":", 1)[1] % {"fs": "tank_db", "fs_name": "db", "snapshot": "snapshot",
+                                                "base": "base", "instance": "instance"}
+            except (KeyError, ValueError, TypeError), e:
+                raise ValueError("target " + _txt_target + " is not a valid template (%s: %s)" %
+                                 (e.__class__.__name__, str(e)))
+        if _txt_compress not in _dict_compressors:
+            raise ValueError("compress must be one of " + ", ".join(sorted(_dict_compressors.keys())))
+        if _int_buffer_mb < 1:
+            raise ValueError("buffer_mb must be at least 1")
+    except ConfigParser.NoOptionError, e:
+        print "\n" + repr(e)
+        print "Please make sure all required sections and options are supplied and try again."
+        _f_config.close()
+        sys.exit(-3)
+    except ValueError, e:
+        print "\nInvalid setting in [Replication]: " + str(e)
+        print "Please correct the configuration file and try again."
+        _f_config.close()
+        sys.exit(-3)
+    _dict_replication = {"type": _txt_target.split(":", 1)[0],
+                         "target": _txt_target.split(":", 1)[1],
+                         "compress": _dict_compressors[_txt_compress][0],
+                         "extension": _dict_compressors[_txt_compress][1],
+                         "buffer_bytes": _int_buffer_mb * 1024 * 1024,
+                         "state_file": _fn_replication_state,
+                         "allow_full": _bool_allow_full,
+                         "instance": _arg_program_options.INSTANCE or ""}
+
+# Optional snapshot verification, see the README.
+#   manifest_dir: where each verified snapshot's checksum manifest is kept.
+#   workers: processes hashing changed files (default: one per CPU).
+_dict_verify = None
+if _config_parser.has_section("Verify"):
+    try:
+        _fn_manifest_dir = _config_parser.get("Verify","manifest_dir")
+        _int_verify_workers = multiprocessing.cpu_count()
+        if _config_parser.has_option("Verify","workers"):
+            _int_verify_workers = _config_parser.getint("Verify","workers")
+        if not os.path.isdir(_fn_manifest_dir):
+            raise ValueError("manifest_dir " + _fn_manifest_dir + " does not exist")
+        if _int_verify_workers < 1:
+            raise ValueError("workers must be at least 1")
+    except ConfigParser.NoOptionError, e:
+        print "\n" + repr(e)
+        print "Please make sure all required sections and options are supplied and try again."
+        _f_config.close()
+        sys.exit(-3)
+    except ValueError, e:
+        print "\nInvalid setting in [Verify]: " + str(e)
+        print "Please correct the configuration file and try again."
+        _f_config.close()
+        sys.exit(-3)
+    _dict_verify = {"manifest_dir": _fn_manifest_dir, "workers": _int_verify_workers}
+
+# Optional phase timing output, see the README.
+#   json_file: append one JSON line per timed phase ("-" for stdout).
+#   statsd: host:port to send "<prefix>.<phase>:<ms>|ms" timers to over UDP.
+#   gmetric_command: gmetric binary to publish each phase's time to Ganglia with.
+#   prefix: metric name prefix, followed by the instance name in multi-instance runs.
+try:
+    _fn_metrics_json = None
+    if _config_parser.has_option("Metrics","json_file"):
+        _fn_metrics_json = _config_parser.get("Metrics","json_file")
+    _addr_statsd = None
+    if _config_parser.has_option("Metrics","statsd"):
+        _txt_statsd = _config_parser.get("Metrics","statsd")
+        if ":" not in _txt_statsd or not _txt_statsd.split(":")[1].isdigit():
+            raise ValueError("statsd must be host:port")
+        _addr_statsd = (_txt_statsd.split(":")[0], int(_txt_statsd.split(":")[1]))
+    _fn_gmetric_cmd = None
+    if _config_parser.has_option("Metrics","gmetric_command"):
+        _fn_gmetric_cmd = _config_parser.get("Metrics","gmetric_command")
+    _txt_metrics_prefix = "snapback"
+    if _config_parser.has_option("Metrics","prefix"):
+        _txt_metrics_prefix = _config_parser.get("Metrics","prefix")
+    if _arg_program_options.INSTANCE != None:
+        _txt_metrics_prefix = _txt_metrics_prefix + "." + _arg_program_options.INSTANCE
+except ValueError, e:
+    print "\nInvalid setting in [Metrics]: " + str(e)
+    print "Please correct the configuration file and try again."
+    _f_config.close()
+    sys.exit(-3)
+_f_config.close()
+
+### Phase timings
+_txt_run_id = "%d-%d" % (time.time(), os.getpid())
+_list_timings = []	# (phase, secs, {extra fields})
+
+def _timed(_phase, _secs_start, _secs_end=None, **_extra):
+    """Records a phase that ran from _secs_start to _secs_end (default now) on the monotonic clock."""
+    if _secs_end == None:
+        _secs_end = _monotonic()
+    _list_timings.append((_phase, _secs_end - _secs_start, _extra))
+    return _secs_end
+
+def _emit_timings():
+    """Writes the recorded phases out to the [Metrics] targets. Runs at exit, so failed runs report too."""
+    if not _list_timings:
+        return
+    if _fn_metrics_json != None:
+        _list_lines = []
+        for _phase, _secs, _extra in _list_timings:
+            _dict_record = {"run": _txt_run_id, "server": _mysql_server, "instance": _arg_program_options.INSTANCE,
+                            "phase": _phase, "ms": round(_secs * 1000.0, 3)}
+            _dict_record.update(_extra)
+            _list_lines.append(json.dumps(_dict_record, sort_keys=True) + "\n")
+        try:
+            if _fn_metrics_json == "-":
+                sys.stdout.write("".join(_list_lines))
+            else:
+                _f_metrics = open(_fn_metrics_json, "a")
+                _f_metrics.write("".join(_list_lines))
+                _f_metrics.close()
+        except IOError, e:
+            print "\tCould not write phase timings to " + _fn_metrics_json + ": " + str(e)
+    if _addr_statsd != None:
+        try:
+            _sock_statsd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            _sock_statsd.sendto("\n".join(["%s.%s:%.3f|ms" % (_txt_metrics_prefix, _phase, _secs * 1000.0)
+                                           for _phase, _secs, _extra in _list_timings]), _addr_statsd)
+            _sock_statsd.close()
+        except socket.error, e:
+            print "\tCould not send phase timings to statsd: " + str(e)
+    if _fn_gmetric_cmd != None:
+        # Ganglia keeps one value per metric, so repeated phases (retries, snapshot groups) are summed
+        _dict_totals = {}
+        for _phase, _secs, _extra in _list_timings:
+            _dict_totals[_phase] = _dict_totals.get(_phase, 0.0) + _secs
+        for _phase, _secs in sorted(_dict_totals.items()):
+            _gmetric_status, _gmetric_output = commands.getstatusoutput(
+                "%s --name=%s --value=%.3f --type=double --units=ms --group=snapback" % \
+                (_fn_gmetric_cmd, (_txt_metrics_prefix + "_" + _phase).replace(".", "_"), _secs * 1000.0))
+            if _gmetric_status != 0:
+                print "\tgmetric failed for " + _phase + ": " + _gmetric_output
+                break
+atexit.register(_emit_timings)
+
+
+### Verify ZFS FS are present
+_zfs_list_status,_zfs_list_output  = commands.getstatusoutput(_fn_zfs_cmd + " list -H -o name")
+_list_zfs_fs = _zfs_list_output.splitlines()
+if _fn_zfs_db_fs not in _list_zfs_fs:
+    print "\nNo ZFS DB filesystem named " + _fn_zfs_db_fs + " exists. Please check your configuration and try again."
+    sys.exit(-4)
+if _fn_zfs_db_fs != _fn_zfs_log_fs:
+    if _fn_zfs_log_fs not in _list_zfs_fs:
+        print "No ZFS Log filesystem named " + _fn_zfs_log_fs + " exists. Please check your configuration and try again."
+        sys.exit(-4)
+print "\nAll specified ZFS filesystems are present."
+
+# Everything the locked section runs is built here, so the lock only covers
+# SHOW MASTER STATUS and the snapshot itself. zfs snapshots several datasets
+# atomically in one call, but only within one pool.
+if _fn_zfs_db_fs != _fn_zfs_log_fs:
+    _list_snap_fs = [_fn_zfs_db_fs, _fn_zfs_log_fs]
+else:
+    _list_snap_fs = [_fn_zfs_db_fs]
+if len(set([_fs.split("/")[0] for _fs in _list_snap_fs])) == 1:
+    _list_snap_groups = [_list_snap_fs]
+else:
+    print "\tDB and Log filesystems are in different pools and will be snapped one after the other."
+    _list_snap_groups = [[_fs] for _fs in _list_snap_fs]
+
+### Catalog
+class SnapshotCatalog:
+    """Sorted index of the SnapBack snapshots of one or more datasets.
+    
+    Snapshots are named <fs>@<YYYYmmddHHMMSS>[_<binlog file>_<position>]; a snapshot name
+    is indexed once with the datasets holding it. `times` and `binlogs` are sorted keys
+    for bisect lookups. Each dataset's full snapshot order (createtxg, foreign snapshots
+    included) is kept for building destroy ranges.
+    """
+    
+    re_name = re.compile(r"^(?P<time>\d{14})(?:_(?P<binlog>.+?)_(?P<pos>\d+))?$")
+    
+    def __init__(self, zfs_cmd, datasets):
+        self.zfs_cmd = zfs_cmd
+        self.datasets = datasets
+        self.entries = {}	# snapshot name -> [time, binlog key or None, set of datasets]
+        self.times = []		# sorted (time, snapshot name)
+        self.binlogs = []	# sorted ((binlog base, binlog seq, pos), snapshot name)
+        self.order = {}		# dataset -> [snapshot name] in creation order
+    
+    def binlog_key(self, binlog, pos):
+        """Sort key for a binlog coordinate: file base name, file sequence, position."""
+        match = re.match(r"^(.*)\.(\d+)$", binlog)
+        if match:
+            return (match.group(1), int(match.group(2)), int(pos))
+        return (binlog, 0, int(pos))
+    
+    def refresh(self):
+        """Lists each dataset's snapshots (one level, no descendants) and updates the index in place.
+        
+        Only snapshots not yet indexed are parsed and inserted; vanished ones are dropped.
+        """
+        seen = {}
+        for fs in self.datasets:
+            status, output = commands.getstatusoutput(self.zfs_cmd + " list -H -t snapshot -o name,creation -d 1 " + fs)
+            if status != 0:
+                raise OSError("zfs list of " + fs + " snapshots failed: " + output)
+            self.order[fs] = []
+            for line in output.splitlines():
+                name = line.split("\t")[0]
+                if "@" not in name:
+                    continue
+                snapshot = name.split("@", 1)[1]
+                self.order[fs].append(snapshot)
+                if self.re_name.match(snapshot):
+                    seen.setdefault(snapshot, set()).add(fs)
+        for snapshot in self.entries.keys():
+            if snapshot not in seen:
+                self.remove(snapshot)
+        for snapshot, datasets in seen.items():
+            if snapshot in self.entries:
+                self.entries[snapshot][2] = datasets
+            else:
+                self.add(snapshot, datasets)
+    
+    def add(self, snapshot, datasets):
+        match = self.re_name.match(snapshot)
+        key = None
+        if match.group("binlog"):
+            key = self.binlog_key(match.group("binlog"), match.group("pos"))
+            bisect.insort(self.binlogs, (key, snapshot))
+        bisect.insort(self.times, (match.group("time"), snapshot))
+        self.entries[snapshot] = [match.group("time"), key, set(datasets)]
+    
+    def remove(self, snapshot):
+        snap_time, key, datasets = self.entries.pop(snapshot)
+        del self.times[bisect.bisect_left(self.times, (snap_time, snapshot))]
+        if key != None:
+            del self.binlogs[bisect.bisect_left(self.binlogs, (key, snapshot))]
+    
+    def at_or_before_time(self, snap_time):
+        """Newest snapshot taken at or before YYYYmmddHHMMSS (shorter prefixes are zero padded)."""
+        index = bisect.bisect_right(self.times, (snap_time.ljust(14, "0"), "\xff"))
+        return index and self.times[index - 1][1] or None
+    
+    def at_or_before_binlog(self, binlog, pos):
+        """Newest snapshot whose master position is at or before binlog file/position."""
+        index = bisect.bisect_right(self.binlogs, (self.binlog_key(binlog, pos), "\xff"))
+        return index and self.binlogs[index - 1][1] or None
+    
+    def expired(self, policy, protect=()):
+        """Snapshots a grandfather-father-son policy does not keep, oldest first.
+        
+        policy maps "hourly", "daily", "weekly", "monthly" to how many of the most recent
+        periods keep their newest snapshot. The newest snapshot and those in protect are
+        always kept.
+        """
+        periods = {"hourly": lambda t: t[:10],
+                   "daily": lambda t: t[:8],
+                   "weekly": lambda t: time.strftime("%Y%W", time.strptime(t[:8], "%Y%m%d")),
+                   "monthly": lambda t: t[:6]}
+        newest_first = [snapshot for snap_time, snapshot in reversed(self.times)]
+        keep = set(newest_first[:1]) | set(protect)
+        for period, count in policy.items():
+            buckets = []
+            for snapshot in newest_first:
+                bucket = periods[period](self.entries[snapshot][0])
+                if bucket not in buckets:
+                    if len(buckets) == count:
+                        break
+                    buckets.append(bucket)
+                    keep.add(snapshot)
+        return [snapshot for snap_time, snapshot in self.times if snapshot not in keep]
+    
+    def destroy_ranges(self, fs, snapshots):
+        """Collapses snapshots into 'a%b' ranges over runs that are adjacent in fs' creation order.
+        
+        A range destroys everything between its ends, so runs never span a snapshot
+        (SnapBack's or foreign) that is being kept.
+        """
+        doomed = set(snapshots)
+        ranges = []
+        run = []
+        for snapshot in self.order.get(fs, []) + [None]:
+            if snapshot != None and snapshot in doomed:
+                run.append(snapshot)
+                continue
+            if len(run) == 1:
+                ranges.append(run[0])
+            elif run:
+                ranges.append(run[0] + "%" + run[-1])
+            run = []
+        return ranges
+
+### Replication
+class ReplicationStream(threading.Thread):
+    """Ships one snapshot of one dataset: zfs send [-i base] | compressor -> bounded buffer -> target.
+    
+    zfs send and the compressor run as a pipeline of their own. A reader thread moves
+    the compressed stream into a Queue of at most buffer_bytes, which this thread drains
+    into the target, so bursts on either side don't stall the other. Dataset streams run
+    concurrently, one thread each. On success `done`, `bytes` and `secs` are set,
+    otherwise `error`.
+    """
+    
+    chunk = 1024 * 1024
+    
+    def __init__(self, zfs_cmd, fs, base, snapshot, replication):
+        threading.Thread.__init__(self)
+        self.zfs_cmd = zfs_cmd
+        self.fs = fs
+        self.base = base
+        self.snapshot = snapshot
+        self.replication = replication
+        self.bytes = 0
+        self.secs = 0.0
+        self.error = None
+        self.done = False
+    
+    def target_names(self):
+        """Values for the %(...)s fields of the file: and receive: target templates."""
+        return {"fs": self.fs, "fs_name": self.fs.split("/")[-1], "snapshot": self.snapshot,
+                "base": self.base or "", "instance": self.replication["instance"]}
+    
+    def target_path(self):
+        names = self.target_names()
+        names["fs"] = self.fs.replace("/", "_")
+        if self.replication["type"] == "file":
+            return self.replication["target"] % names
+        if self.base:
+            name = "%(fs)s@%(snapshot)s.from-%(base)s.zfs" % names
+        else:
+            name = "%(fs)s@%(snapshot)s.full.zfs" % names
+        return os.path.join(self.replication["target"], name + self.replication["extension"])
+    
+    def run(self):
+        try:
+            self.transfer()
+        except (OSError, IOError), e:
+            self.error = str(e)
+        except Exception, e:
+            self.error = "%s: %s" % (e.__class__.__name__, str(e))
+    
+    def transfer(self):
+        started = _monotonic()
+        if self.replication["type"] == "receive":
+            receive_command, path = self.replication["target"] % self.target_names(), None
+        else:
+            path = self.target_path()
+        errors = tempfile.TemporaryFile()
+        command = shlex.split(self.zfs_cmd) + ["send"]
+        if self.base:
+            command = command + ["-i", "@" + self.base]
+        # Python ignores SIGPIPE and children inherit that; restore it so a dead reader stops the pipeline
+        default_sigpipe = lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+        processes = [subprocess.Popen(command + [self.fs + "@" + self.snapshot], stdout=subprocess.PIPE, stderr=errors,
+                                      preexec_fn=default_sigpipe)]
+        names = ["zfs send"]
+        if self.replication["compress"]:
+            processes.append(subprocess.Popen(shlex.split(self.replication["compress"]), stdin=processes[0].stdout,
+                                              stdout=subprocess.PIPE, stderr=errors, preexec_fn=default_sigpipe))
+            names.append(self.replication["compress"].split()[0])
+            processes[0].stdout.close()
+        if self.replication["type"] == "receive":
+            receiver = subprocess.Popen(receive_command, shell=True, stdin=subprocess.PIPE, stdout=errors,
+                                        stderr=errors, preexec_fn=default_sigpipe)
+            sink = receiver.stdin
+        else:
+            receiver = None
+            sink = open(path + ".part", "wb")	# Renamed into place once the stream completes
+        
+        buffer = Queue.Queue(max(1, self.replication["buffer_bytes"] / self.chunk))
+        source = processes[-1].stdout
+        def read():
+            while True:
+                data = source.read(self.chunk)
+                buffer.put(data)
+                if not data:
+                    break
+        reader = threading.Thread(target=read)
+        reader.setDaemon(True)
+        reader.start()
+        
+        failure = None
+        try:
+            while True:
+                data = buffer.get()
+                if not data:
+                    break
+                sink.write(data)
+                self.bytes = self.bytes + len(data)
+            sink.close()
+        except IOError, e:
+            failure = "writing to the target failed: " + str(e)
+            for process in processes:
+                if process.poll() == None:
+                    process.kill()
+            while buffer.get():	# Unblock the reader until it sees EOF
+                pass
+        finally:
+            if receiver == None and not sink.closed:
+                try:
+                    sink.close()
+                except IOError, e:
+                    pass
+        reader.join()
+        for x in range(len(processes)):
+            if processes[x].wait() != 0 and failure == None:
+                failure = "%s exited with status %d" % (names[x], processes[x].returncode)
+        if receiver != None:
+            try:
+                sink.close()
+            except IOError, e:
+                pass
+            if receiver.wait() != 0 and failure == None:
+                failure = "receive command exited with status %d" % receiver.returncode
+        if failure != None:
+            errors.seek(0)
+            if path != None and os.path.exists(path + ".part"):
+                os.unlink(path + ".part")
+            stderr = errors.read()[-2000:].strip()
+            raise OSError(stderr and failure + "\n" + stderr or failure)
+        if path != None:
+            os.rename(path + ".part", path)
+        self.secs = _monotonic() - started
+        self.done = True
+
+def _read_replication_state(_fn_state):
+    """Returns {dataset: last shipped snapshot} from the replication state file."""
+    _dict_state = {}
+    if os.path.exists(_fn_state):
+        for _line in open(_fn_state).read().splitlines():
+            _list_fields = _line.split("\t")
+            if len(_list_fields) >= 2:
+                _dict_state[_list_fields[0]] = _list_fields[1]
+    return _dict_state
+
+def _write_replication_state(_fn_state, _dict_state):
+    """Replaces the replication state file atomically."""
+    _fd_state, _fn_temp = tempfile.mkstemp(prefix=".snapback_state.", dir=os.path.dirname(os.path.abspath(_fn_state)))
+    _f_state = os.fdopen(_fd_state, "w")
+    for _fs in sorted(_dict_state.keys()):
+        _f_state.write(_fs + "\t" + _dict_state[_fs] + "\t" + str(int(time.time())) + "\n")
+    _f_state.close()
+    os.rename(_fn_temp, _fn_state)
+
+def _update_replication_state(_fn_state, _dict_shipped):
+    """Records newly shipped snapshots, keeping what other runs recorded meanwhile.
+    
+    Instances sharing one state file replicate at the same time, so the file is
+    re-read and rewritten under an exclusive lock on <state_file>.lock.
+    """
+    _f_lock = open(_fn_state + ".lock", "a")
+    try:
+        fcntl.flock(_f_lock.fileno(), fcntl.LOCK_EX)
+        _dict_state = _read_replication_state(_fn_state)
+        _dict_state.update(_dict_shipped)
+        _write_replication_state(_fn_state, _dict_state)
+    finally:
+        _f_lock.close()
+
+def _replicate(_catalog):
+    """Ships each dataset's newest SnapBack snapshot, incrementally from the last one shipped.
+    
+    Returns False if any dataset failed; the state file only advances for those that
+    were shipped, so the next run resumes from there.
+    """
+    print "\n\nSnapBack is replicating snapshots:"
+    _dict_state = _read_replication_state(_dict_replication["state_file"])
+    _list_streams = []
+    for _fs in _list_snap_fs:
+        _list_snapbacks = [_snapshot for _snapshot in _catalog.order.get(_fs, []) if _snapshot in _catalog.entries]
+        if not _list_snapbacks:
+            print "\tNo SnapBack snapshots of " + _fs + " to replicate."
+            continue
+        _txt_base = _dict_state.get(_fs)
+        if _txt_base == _list_snapbacks[-1]:
+            print "\t" + _fs + "@" + _txt_base + " is already replicated."
+            continue
+        if _txt_base != None and _txt_base not in _catalog.order[_fs]:
+            print "\tLast replicated snapshot " + _fs + "@" + _txt_base + " no longer exists."
+            _txt_base = None
+        if _txt_base == None and not _dict_replication["allow_full"]:
+            print "\tNo incremental base for " + _fs + " and allow_full is off. Skipping it."
+            continue
+        _list_streams.append(ReplicationStream(_fn_zfs_cmd, _fs, _txt_base, _list_snapbacks[-1], _dict_replication))
+    for _stream in _list_streams:
+        _stream.start()
+    _bool_ok = True
+    _dict_shipped = {}
+    for _stream in _list_streams:
+        _stream.join()
+        if _stream.error != None or not _stream.done:
+            print "\tReplicating " + _stream.fs + "@" + _stream.snapshot + " failed: " + \
+                  (_stream.error or "the stream did not complete")
+            _bool_ok = False
+            continue
+        _dict_shipped[_stream.fs] = _stream.snapshot
+        _list_timings.append(("replicate", _stream.secs, {"dataset": _stream.fs, "bytes": _stream.bytes}))
+        print "\tReplicated %s@%s (%s): %.1fMB in %.1fs, %.1fMB/s." % \
+              (_stream.fs, _stream.snapshot, _stream.base and "incremental from " + _stream.base or "full",
+               _stream.bytes / 1048576.0, _stream.secs, _stream.bytes / 1048576.0 / max(_stream.secs, 0.001))
+    if _dict_shipped:
+        _update_replication_state(_dict_replication["state_file"], _dict_shipped)
+    return _bool_ok
+
+### Verification
+def _escape_path(_path):
+    return _path.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+def _unescape_path(_path):
+    return re.sub(r"\\(.)", lambda _match: {"t": "\t", "n": "\n"}.get(_match.group(1), _match.group(1)), _path)
+
+def _hash_file(_fn_path):
+    """Pool worker: SHA-256 of one file, read through mmap. Returns (path, digest, size) or (path, None, error)."""
+    try:
+        _f_data = open(_fn_path, "rb")
+        try:
+            _int_size = os.fstat(_f_data.fileno()).st_size
+            _hash = hashlib.sha256()
+            if _int_size:	# Empty files can't be mapped
+                _mmap_data = mmap.mmap(_f_data.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for _int_offset in xrange(0, _int_size, 1048576):
+                        _hash.update(buffer(_mmap_data, _int_offset, 1048576))
+                finally:
+                    _mmap_data.close()
+        finally:
+            _f_data.close()
+        return (_fn_path, _hash.hexdigest(), _int_size)
+    except EnvironmentError, e:
+        return (_fn_path, None, str(e))
+
+class SnapshotManifest:
+    """Checksum manifest of the regular files in one snapshot.
+    
+    One "<path>\\t<sha256>\\t<size>" line per file, relative to the dataset's mountpoint and
+    sorted by path (tab, newline and backslash escaped), so lookup() can binary search
+    the file by offset without reading all of it.
+    """
+    
+    def __init__(self, directory, fs, snapshot):
+        self.path = os.path.join(directory, fs.replace("/", "_") + "@" + snapshot + ".manifest")
+    
+    def exists(self):
+        return os.path.exists(self.path)
+    
+    def load(self):
+        """Returns {escaped path: (digest, size)}."""
+        entries = {}
+        f = open(self.path)
+        for line in f:
+            path, digest, size = line.rstrip("\n").split("\t")
+            entries[path] = (digest, int(size))
+        f.close()
+        return entries
+    
+    def write(self, entries):
+        """Writes {escaped path: (digest, size)} sorted, replacing any manifest atomically."""
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".manifest.")
+        f = os.fdopen(fd, "w")
+        for path in sorted(entries.keys()):
+            f.write("%s\t%s\t%d\n" % (path, entries[path][0], entries[path][1]))
+        f.close()
+        os.rename(temp_path, self.path)
+    
+    def lookup(self, path):
+        """(digest, size) of a file by its path relative to the mountpoint, or None."""
+        key = _escape_path(path)
+        f = open(self.path)
+        try:
+            lo = 0
+            hi = os.fstat(f.fileno()).st_size
+            # Smallest offset whose next whole line sorts at or after key
+            while lo < hi:
+                mid = (lo + hi) / 2
+                f.seek(mid)
+                if mid:
+                    f.readline()
+                line = f.readline()
+                if line and line.split("\t", 1)[0] < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            f.seek(lo)
+            if lo:
+                f.readline()
+            fields = f.readline().rstrip("\n").split("\t")
+            if fields[0] == key and len(fields) == 3:
+                return (fields[1], int(fields[2]))
+            return None
+        finally:
+            f.close()
+
+def _apply_zfs_diff(_dict_entries, _txt_diff, _fn_mountpoint):
+    """Applies "zfs diff -FH" output to a previous snapshot's manifest entries in place.
+    
+    Removed and renamed-away paths are dropped (with everything under them for
+    directories); returns the set of escaped paths of regular files to hash.
+    """
+    def _relative(_path):
+        _path = re.sub(r"\\0([0-7]{3})", lambda _match: chr(int(_match.group(1), 8)), _path)
+        return _escape_path(_path[len(_fn_mountpoint):].lstrip("/"))
+    
+    _set_changed = set()
+    for _line in _txt_diff.splitlines():
+        _fields = _line.split("\t")
+        if len(_fields) < 3:
+            continue
+        _txt_change, _txt_type, _path = _fields[0], _fields[1], _relative(_fields[2])
+        if _txt_change in ("-", "R"):
+            _dict_entries.pop(_path, None)
+            _set_changed.discard(_path)
+            if _txt_type == "/":
+                for _entry in [_entry for _entry in _dict_entries.keys() if _entry.startswith(_path + "/")]:
+                    _digest_size = _dict_entries.pop(_entry)
+                    if _txt_change == "R":	# Files under a renamed directory keep their checksums
+                        _dict_entries[_relative(_fields[3]) + _entry[len(_path):]] = _digest_size
+        if _txt_change == "R":
+            _path = _relative(_fields[3])
+        if _txt_change in ("+", "M", "R") and _txt_type == "F":
+            _set_changed.add(_path)
+    return _set_changed
+
+def _verify(_catalog):
+    """Checksums each dataset's newest SnapBack snapshot into a manifest.
+    
+    The manifest is derived from the newest older snapshot that has one, hashing only
+    the files zfs diff reports changed since; the first snapshot of a dataset is hashed
+    in full. Returns False if any dataset could not be verified.
+    """
+    print "\n\nSnapBack is verifying snapshots:"
+    _pool_hash = None
+    _bool_ok = True
+    try:
+        for _fs in _list_snap_fs:
+            _list_snapbacks = [_snapshot for _snapshot in _catalog.order.get(_fs, []) if _snapshot in _catalog.entries]
+            if not _list_snapbacks:
+                print "\tNo SnapBack snapshots of " + _fs + " to verify."
+                continue
+            _txt_snapshot = _list_snapbacks[-1]
+            _manifest = SnapshotManifest(_dict_verify["manifest_dir"], _fs, _txt_snapshot)
+            if _manifest.exists():
+                print "\t" + _fs + "@" + _txt_snapshot + " is already verified."
+                continue
+            _secs_verify_start = _monotonic()
+            _zfs_get_status,_fn_mountpoint = commands.getstatusoutput(_fn_zfs_cmd + " get -H -o value mountpoint " + _fs)
+            if _zfs_get_status != 0 or not _fn_mountpoint.startswith("/"):
+                print "\tCannot verify " + _fs + ": no usable mountpoint (" + _fn_mountpoint + ")."
+                _bool_ok = False
+                continue
+            _fn_snap_root = os.path.join(_fn_mountpoint, ".zfs", "snapshot", _txt_snapshot)
+            
+            _txt_base = None
+            for _snapshot in reversed(_list_snapbacks[:-1]):
+                if SnapshotManifest(_dict_verify["manifest_dir"], _fs, _snapshot).exists():
+                    _txt_base = _snapshot
+                    break
+            if _txt_base != None:
+                _dict_entries = SnapshotManifest(_dict_verify["manifest_dir"], _fs, _txt_base).load()
+                _zfs_diff_status,_zfs_diff_output = commands.getstatusoutput(_fn_zfs_cmd + " diff -FH " + _fs + "@" + \
+                                                                             _txt_base + " " + _fs + "@" + _txt_snapshot)
+                if _zfs_diff_status != 0:
+                    print "\tzfs diff of " + _fs + "@" + _txt_base + " and @" + _txt_snapshot + " failed.\n" + _zfs_diff_output
+                    _bool_ok = False
+                    continue
+                _set_changed = _apply_zfs_diff(_dict_entries, _zfs_diff_output, _fn_mountpoint)
+            else:
+                _dict_entries = {}
+                _set_changed = set()
+                for _fn_dir, _list_dirs, _list_files in os.walk(_fn_snap_root):
+                    for _fn_file in _list_files:
+                        _fn_path = os.path.join(_fn_dir, _fn_file)
+                        if os.path.isfile(_fn_path) and not os.path.islink(_fn_path):
+                            _set_changed.add(_escape_path(_fn_path[len(_fn_snap_root) + 1:]))
+            
+            # Manifest paths are escaped; hash through the real snapshot paths
+            _dict_paths = {}
+            for _path in _set_changed:
+                _dict_paths[os.path.join(_fn_snap_root, _unescape_path(_path))] = _path
+            if _pool_hash == None and _dict_paths:
+                _pool_hash = multiprocessing.Pool(_dict_verify["workers"])
+            _int_bytes = 0
+            _list_errors = []
+            if _dict_paths:
+                for _fn_path, _digest, _size in _pool_hash.imap_unordered(_hash_file, _dict_paths.keys(), 16):
+                    if _digest == None:
+                        _list_errors.append(_dict_paths[_fn_path] + ": " + _size)
+                        continue
+                    _dict_entries[_dict_paths[_fn_path]] = (_digest, _size)
+                    _int_bytes = _int_bytes + _size
+            if _list_errors:
+                print "\tVerifying " + _fs + "@" + _txt_snapshot + " failed, %d files unreadable:" % len(_list_errors)
+                for _error in sorted(_list_errors)[:10]:
+                    print "\t\t" + _error
+                _bool_ok = False
+                continue
+            _manifest.write(_dict_entries)
+            _secs_verify = _timed("verify", _secs_verify_start, dataset=_fs, files=len(_dict_paths), bytes=_int_bytes) - \
+                           _secs_verify_start
+            print "\tVerified %s@%s (%s): %d of %d files hashed, %.1fMB in %.1fs, %.1fMB/s." % \
+                  (_fs, _txt_snapshot, _txt_base and "incremental from " + _txt_base or "full", len(_dict_paths),
+                   len(_dict_entries), _int_bytes / 1048576.0, _secs_verify,
+                   _int_bytes / 1048576.0 / max(_secs_verify, 0.001))
+    finally:
+        if _pool_hash != None:
+            _pool_hash.close()
+            _pool_hash.join()
+    return _bool_ok
+
+def _format_snapshot(_catalog, _snapshot):
+    _snap_time, _key, _set_fs = _catalog.entries[_snapshot]
+    _match = _catalog.re_name.match(_snapshot)
+    if _match.group("binlog"):
+        _txt_position = _match.group("binlog") + ":" + _match.group("pos")
+    else:
+        _txt_position = "-"
+    return "%s  %s-%s-%s %s:%s:%s  %-28s %s" % \
+           (_snapshot.ljust(40), _snap_time[:4], _snap_time[4:6], _snap_time[6:8], _snap_time[8:10],
+            _snap_time[10:12], _snap_time[12:14], _txt_position, ", ".join(sorted(_set_fs)))
+
+if _arg_leftover:
+    _catalog = SnapshotCatalog(_fn_zfs_cmd, _list_snap_fs)
+    try:
+        _catalog.refresh()
+    except OSError, e:
+        print "\n" + str(e)
+        sys.exit(-4)
+    
+    if _arg_leftover[1] == "list":
+        for _snap_time, _snapshot in _catalog.times:
+            print _format_snapshot(_catalog, _snapshot)
+        print "\n%d SnapBack snapshots." % len(_catalog.times)
+        sys.exit(0)
+    
+    if _arg_leftover[1] == "find":
+        if _arg_leftover[2] == "binlog":
+            if ":" not in _arg_leftover[3] or not _arg_leftover[3].rsplit(":", 1)[1].isdigit():
+                print "\nBinlog positions must be given as <file>:<position>, e.g. mysql-bin.000042:1234."
+                sys.exit(-1)
+            _snapshot = _catalog.at_or_before_binlog(*_arg_leftover[3].rsplit(":", 1))
+        else:
+            if not re.match(r"^\d{8,14}$", _arg_leftover[3]):
+                print "\nTimes must be given as YYYYmmdd[HH[MM[SS]]]."
+                sys.exit(-1)
+            _snapshot = _catalog.at_or_before_time(_arg_leftover[3])
+        if _snapshot == None:
+            print "\nNo SnapBack snapshot at or before " + _arg_leftover[3] + "."
+            sys.exit(-8)
+        print _format_snapshot(_catalog, _snapshot)
+        sys.exit(0)
+    
+    if _arg_leftover[1] == "replicate":
+        if _dict_replication == None:
+            print "\nNo [Replication] section in the configuration file."
+            sys.exit(-3)
+        if not _replicate(_catalog):
+            sys.exit(-10)
+        sys.exit(0)
+    
+    if _arg_leftover[1] in ("verify", "checksum") and _dict_verify == None:
+        print "\nNo [Verify] section in the configuration file."
+        sys.exit(-3)
+    if _arg_leftover[1] == "verify":
+        if not _verify(_catalog):
+            sys.exit(-12)
+        sys.exit(0)
+    
+    # catalog checksum <snapshot> <path>: the manifest entry of a file, path relative
+    # to its dataset's mountpoint
+    if _arg_leftover[1] == "checksum":
+        _bool_found = False
+        for _fs in _list_snap_fs:
+            _manifest = SnapshotManifest(_dict_verify["manifest_dir"], _fs, _arg_leftover[2])
+            if not _manifest.exists():
+                continue
+            _entry = _manifest.lookup(_arg_leftover[3].lstrip("/"))
+            if _entry != None:
+                print "%s  %d  %s@%s:%s" % (_entry[0], _entry[1], _fs, _arg_leftover[2], _arg_leftover[3].lstrip("/"))
+                _bool_found = True
+        if not _bool_found:
+            print "\nNo manifest of " + _arg_leftover[2] + " lists " + _arg_leftover[3] + "."
+            sys.exit(-8)
+        sys.exit(0)
+    
+    # catalog prune: [Retention] hourly/daily/weekly/monthly, each the number of most
+    # recent periods whose newest snapshot is kept
+    _dict_policy = {}
+    for _period in ("hourly", "daily", "weekly", "monthly"):
+        if _config_parser.has_option("Retention", _period):
+            try:
+                _dict_policy[_period] = _config_parser.getint("Retention", _period)
+            except ValueError, e:
+                _dict_policy[_period] = -1
+            if _dict_policy[_period] < 0:
+                print "\n[Retention] " + _period + " must be a positive number of periods."
+                sys.exit(-3)
+    if not _dict_policy:
+        print "\nNo retention policy. Please add a [Retention] section with hourly, daily, weekly and/or monthly counts."
+        sys.exit(-3)
+    _set_protect = set()
+    if _dict_replication != None:
+        _set_protect = set(_read_replication_state(_dict_replication["state_file"]).values())	# Next incremental bases
+    if _dict_verify != None:
+        for _fs in _list_snap_fs:	# Newest verified snapshot, the next manifest's base
+            for _snapshot in reversed(_catalog.order.get(_fs, [])):
+                if _snapshot in _catalog.entries and \
+                   SnapshotManifest(_dict_verify["manifest_dir"], _fs, _snapshot).exists():
+                    _set_protect.add(_snapshot)
+                    break
+    _list_expired = _catalog.expired(_dict_policy, _set_protect)
+    print "\nKeeping %d and destroying %d of %d SnapBack snapshots." % \
+          (len(_catalog.times) - len(_list_expired), len(_list_expired), len(_catalog.times))
+    for _snapshot in _list_expired:
+        print "\t" + (_arg_program_options.DRY_RUN and "Would destroy " or "Destroying ") + _snapshot
+    if _arg_program_options.DRY_RUN or not _list_expired:
+        sys.exit(0)
+    for _fs in _list_snap_fs:
+        _list_ranges = _catalog.destroy_ranges(_fs, _list_expired)
+        if not _list_ranges:
+            continue
+        # Bounded batches keep the command line short on datasets with thousands of snapshots
+        for _int_batch in range(0, len(_list_ranges), 100):
+            _zfs_destroy_status,_zfs_destroy_output = commands.getstatusoutput(_fn_zfs_cmd + " destroy " + _fs + "@" + \
+                                                                               ",".join(_list_ranges[_int_batch:_int_batch + 100]))
+            if _zfs_destroy_status != 0:
+                print "An error occurred while destroying snapshots of " + _fs + ".\n" + _zfs_destroy_output
+                sys.exit(-9)
+        print "\tDestroyed expired snapshots of " + _fs + " in %d zfs call(s)." % ((len(_list_ranges) + 99) / 100)
+        if _dict_verify != None:
+            for _snapshot in _list_expired:
+                _manifest = SnapshotManifest(_dict_verify["manifest_dir"], _fs, _snapshot)
+                if _manifest.exists():
+                    os.unlink(_manifest.path)
+    sys.exit(0)
+
+### Connect to MySQL
+print "\n\nSnapBack is connecting to MySQL:"
+_secs_connect_start = _monotonic()
+try:
+    _db_backup = MySQLdb.connect(host=_mysql_server, user=_mysql_user, passwd=_mysql_pass)
+except MySQLdb.OperationalError:
+    _timed("connect", _secs_connect_start, ok=False)
+    print "Unable to connect to MySQL server " + _mysql_server + ". Please check the configuration file and try again."
+    sys.exit(-5)
+_timed("connect", _secs_connect_start, ok=True)
+print "\tConnected to " + _mysql_server + "."
+_cu_backup = _db_backup.cursor()
+
+_time_snapshot = time.strftime("%Y%m%d%H%M%S")
+
+# Make operation InnoDB safe/consistent.
+_cu_backup.execute("SET AUTOCOMMIT=0;")
+print "\tPrepared MySQL to ensure InnoDB consistency."
+
+# Bound how long FLUSH TABLES and FTWRL may queue (and stall writes) behind other
+# statements. lock_wait_timeout only applies to them from MySQL 5.5 on.
+try:
+    _cu_backup.execute("SET SESSION lock_wait_timeout = %d;" % _secs_lock_wait_timeout)
+    print "\tLock waits limited to %ds." % _secs_lock_wait_timeout
+except MySQLdb.Error, e:
+    print "\tThis MySQL server has no lock_wait_timeout, so locking waits are unbounded."
+
+def _long_queries():
+    """Statements running at least long_query_limit secs, as [(id, user, secs, statement)]."""
+    try:
+        _cu_backup.execute("SELECT ID, USER, TIME, LEFT(INFO, 80) FROM information_schema.PROCESSLIST "
+                           "WHERE ID != CONNECTION_ID() AND INFO IS NOT NULL AND TIME >= %s "
+                           "AND COMMAND NOT IN ('Sleep', 'Binlog Dump', 'Daemon') "
+                           "AND USER != 'system user';", (_secs_long_query_limit,))
+        return list(_cu_backup.fetchall())
+    except MySQLdb.Error, e:
+        # No information_schema.PROCESSLIST before 5.1.7
+        _cu_backup.execute("SHOW FULL PROCESSLIST;")
+        return [(_row[0], _row[1], _row[5], (_row[7] or "")[:80]) for _row in _cu_backup.fetchall()
+                if _row[7] and _row[5] >= _secs_long_query_limit and _row[1] != "system user" and \
+                   _row[4] not in ("Sleep", "Binlog Dump", "Daemon")]
+
+# Instances sharing a zpool take turns at the lock phase, so their FTWRLs and
+# snapshots don't all land at once. Pools are locked in sorted order, and the
+# locks go away with the process whichever way it exits.
+_list_pool_locks = []
+def _lock_pools():
+    if _arg_program_options.INSTANCE == None or _list_pool_locks:
+        return
+    _secs_wait_start = _monotonic()
+    for _pool in sorted(set([_fs.split("/")[0] for _fs in _list_snap_fs])):
+        _f_lock = open(os.path.join(_fn_lock_dir, "snapback." + _pool + ".lock"), "a")
+        fcntl.flock(_f_lock.fileno(), fcntl.LOCK_EX)
+        _list_pool_locks.append(_f_lock)
+    print "\tWaited %.3fs for the zpool lock." % (_timed("zpool_wait", _secs_wait_start) - _secs_wait_start)
+
+def _unlock_pools():
+    while _list_pool_locks:
+        _f_lock = _list_pool_locks.pop()
+        fcntl.flock(_f_lock.fileno(), fcntl.LOCK_UN)
+        _f_lock.close()
+
+### Pull ZFS snapshots.
+
+print "\n\nSnapBack is commencing snapshot run:"
+_secs_prelock_start = _monotonic()
+_int_lock_attempt = 0
+while True:
+    # Wait out (or abort on) queries FTWRL would have to queue behind
+    _secs_backoff = 1
+    _secs_guard_start = _monotonic()
+    while True:
+        _list_long_queries = _long_queries()
+        if not _list_long_queries:
+            break
+        print "\t%d queries have been running for over %ds:" % (len(_list_long_queries), _secs_long_query_limit)
+        for _row in _list_long_queries:
+            print "\t\tid %s, user %s, %ss: %s" % (_row[0], _row[1], _row[2], _row[3])
+        if _txt_long_query_action == "abort":
+            _timed("long_query_guard", _secs_guard_start, ok=False)
+            print "Not locking tables while long queries run (long_query_action = abort). Quitting."
+            sys.exit(-6)
+        if _monotonic() - _secs_guard_start + _secs_backoff > _secs_long_query_wait:
+            _timed("long_query_guard", _secs_guard_start, ok=False)
+            print "Long queries still running after %ds (long_query_wait). Quitting." % _secs_long_query_wait
+            sys.exit(-6)
+        print "\tWaiting %ds for them to finish." % _secs_backoff
+        time.sleep(_secs_backoff)
+        _secs_backoff = min(_secs_backoff * 2, 30)
+    _timed("long_query_guard", _secs_guard_start, ok=True)
+    
+    _secs_lock_start = None
+    try:
+        if _bool_preflush:
+            print "\tPre-flushing tables."
+            _secs_preflush_start = _monotonic()
+            _cu_backup.execute("FLUSH TABLES;")
+            _timed("preflush", _secs_preflush_start)
+        _lock_pools()
+        print "\tLocking tables."
+        _secs_lock_start = _monotonic()
+        _cu_backup.execute("FLUSH TABLES WITH READ LOCK;")
+        _secs_locked = _timed("ftwrl_acquire", _secs_lock_start, ok=True, attempt=_int_lock_attempt + 1)
+        break
+    except MySQLdb.OperationalError, e:
+        if e.args[0] != 1205:	# ER_LOCK_WAIT_TIMEOUT
+            raise
+        _timed(_secs_lock_start != None and "ftwrl_acquire" or "preflush", _secs_lock_start or _secs_preflush_start,
+               ok=False, attempt=_int_lock_attempt + 1)
+        _int_lock_attempt = _int_lock_attempt + 1
+        if _int_lock_attempt > _int_lock_retries:
+            print "Could not lock tables within lock_wait_timeout after %d attempts. Quitting." % _int_lock_attempt
+            sys.exit(-6)
+        print "\tLock wait timed out after %ds, retrying (%d of %d)." % \
+              (_secs_lock_wait_timeout, _int_lock_attempt, _int_lock_retries)
+        _unlock_pools()
+        time.sleep(min(2 ** _int_lock_attempt, 30))
+_secs_master_start = _monotonic()
+_cu_backup.execute("SHOW MASTER STATUS;")
+_rows_master_status = _cu_backup.fetchone()
+_timed("master_status", _secs_master_start)
+# Notate current master log file and position if master_naming is on
+if _bool_master_naming == True:
+    _txt_master_status = "_" + str(_rows_master_status[0]) + "_" + str(_rows_master_status[1])
+else:
+    _txt_master_status = ""
+_txt_snap_name = "@" + _time_snapshot + _txt_master_status
+
+try:
+    for _list_group in _list_snap_groups:
+        _secs_snap_start = _monotonic()
+        _zfs_snap_status,_zfs_snap_output = commands.getstatusoutput(_fn_zfs_cmd + " snapshot " + \
+                                                                     " ".join([_fs + _txt_snap_name for _fs in _list_group]))
+        _timed("snapshot", _secs_snap_start, ok=_zfs_snap_status == 0, datasets=_list_group)
+        if str(_zfs_snap_status) != "0":
+            _cu_backup.execute("UNLOCK TABLES;")
+            _timed("lock_hold", _secs_locked, ok=False)
+            print "An error occurred while executing the ZFS snapshot on " + ", ".join(_list_group) + \
+                  ". Tables unlocked, quitting.\n" + _zfs_snap_output
+            sys.exit(-7)
+except SystemExit:
+    raise
+except:
+    _cu_backup.execute("UNLOCK TABLES;")
+    _timed("lock_hold", _secs_locked, ok=False)
+    print "\tAn unrecoverable error occurred while trying to pull the snapshots. We have unlocked the tables. Please check your system logs for details as to the ZFS error."
+    sys.exit(-7)
+
+_secs_unlock_start = _monotonic()
+_cu_backup.execute("UNLOCK TABLES;")
+_secs_unlocked = _timed("unlock", _secs_unlock_start)
+_timed("lock_hold", _secs_locked, _secs_unlocked, snapshot=_txt_snap_name[1:])
+_unlock_pools()
+# Report after unlocking so the prints aren't part of the hold time
+print "\tTables locked in %.3fs (%.3fs including pre-lock checks and retries), master status retrieved." % \
+      (_secs_locked - _secs_lock_start, _secs_locked - _secs_prelock_start)
+print "\tSnapped " + " and ".join(_list_snap_fs) + " in %d zfs call(s)." % len(_list_snap_groups)
+print "\tTables unlocked. Read lock held for %.3fs." % (_secs_unlocked - _secs_locked)
+print "SnapBack snapshot run completed."
+
+print "\n\nSnapshots created:"
+for _fs in _list_snap_fs:
+    print "\t" + _fs + _txt_snap_name
+
+### Replicate
+if _dict_replication != None:
+    _catalog = SnapshotCatalog(_fn_zfs_cmd, _list_snap_fs)
+    try:
+        _catalog.refresh()
+    except OSError, e:
+        print "\n" + str(e)
+        sys.exit(-10)
+    if not _replicate(_catalog):
+        sys.exit(-10)
+
+### Verify
+if _dict_verify != None:
+    _catalog = SnapshotCatalog(_fn_zfs_cmd, _list_snap_fs)
+    try:
+        _catalog.refresh()
+    except OSError, e:
+        print "\n" + str(e)
+        sys.exit(-12)
+    if not _verify(_catalog):
+        sys.exit(-12)
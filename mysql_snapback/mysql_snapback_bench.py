@@ -0,0 +1,221 @@
+#!/usr/bin/python
+####################################################################
+# FILENAME: mysql_snapback_bench.py
+# PROJECT: Miscellaneous Tools
+# DESCRIPTION: Drives complete SnapBack runs against a stub MySQLdb
+#       module and a fake zfs command, each with injectable latencies,
+#       and reports the phase timings SnapBack emits (connect, FTWRL
+#       acquire, master status, snapshot, unlock and lock hold). The
+#       lock hold time less the injected work is SnapBack's own
+#       overhead while writes are frozen; --save and --baseline keep
+#       it from regressing unnoticed.
+#
+########################################################################################
+# (C)2009 DigiTar, All Rights Reserved
+# Distributed under the BSD License
+# 
+# Redistribution and use in source and binary forms, with or without modification, 
+#    are permitted provided that the following conditions are met:
+#
+#        * Redistributions of source code must retain the above copyright notice, 
+#          this list of conditions and the following disclaimer.
+#        * Redistributions in binary form must reproduce the above copyright notice, 
+#          this list of conditions and the following disclaimer in the documentation 
+#          and/or other materials provided with the distribution.
+#        * Neither the name of DigiTar nor the names of its contributors may be
+#          used to endorse or promote products derived from this software without 
+#          specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY 
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES 
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT 
+# SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, 
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED 
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR 
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN 
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+#
+########################################################################################
+import os, sys, json, shutil, tempfile, subprocess
+from optparse import OptionParser
+
+
+### Commandline Arguments
+opt_parser = OptionParser(usage="%prog [--runs 20] [--ftwrl-ms 20] [--snapshot-ms 50] [--save FILE | --baseline FILE]")
+
+opt_parser.add_option("-r", "--runs", dest="runs", type="int", default=20,
+                      help="SnapBack runs to time. (Default: 20)")
+opt_parser.add_option("-p", "--python", dest="python", default=sys.executable,
+                      help="Interpreter SnapBack is run with. (Default: this one)")
+opt_parser.add_option("-d", "--datasets", dest="datasets", default="tank/db,tank/logs",
+                      help="DB and (optional) log dataset. Different pools mean one snapshot call each. (Default: tank/db,tank/logs)")
+opt_parser.add_option("--connect-ms", dest="connect_ms", type="float", default=1.0,
+                      help="Stub MySQL connect latency. (Default: 1)")
+opt_parser.add_option("--flush-ms", dest="flush_ms", type="float", default=5.0,
+                      help="Stub FLUSH TABLES latency. (Default: 5)")
+opt_parser.add_option("--ftwrl-ms", dest="ftwrl_ms", type="float", default=20.0,
+                      help="Stub FLUSH TABLES WITH READ LOCK latency. (Default: 20)")
+opt_parser.add_option("--master-ms", dest="master_ms", type="float", default=1.0,
+                      help="Stub SHOW MASTER STATUS latency. (Default: 1)")
+opt_parser.add_option("--unlock-ms", dest="unlock_ms", type="float", default=1.0,
+                      help="Stub UNLOCK TABLES latency. (Default: 1)")
+opt_parser.add_option("--snapshot-ms", dest="snapshot_ms", type="float", default=50.0,
+                      help="Fake zfs snapshot latency. (Default: 50)")
+opt_parser.add_option("--save", dest="save",
+                      help="Write the median phase timings to this file, as a baseline.")
+opt_parser.add_option("--baseline", dest="baseline",
+                      help="Compare against a --save file and exit 1 if the lock overhead regressed.")
+opt_parser.add_option("--tolerance", dest="tolerance", type="float", default=20.0,
+                      help="Percent (plus 1ms) the lock overhead may grow over the baseline. (Default: 20)")
+
+PHASES = ["connect", "long_query_guard", "preflush", "ftwrl_acquire", "master_status",
+          "snapshot", "unlock", "lock_hold", "lock_overhead"]
+
+# Stand-in for MySQLdb: answers the statements SnapBack issues after the configured delays.
+STUB_MYSQLDB = '''import os, time
+class Error(Exception): pass
+class OperationalError(Error): pass
+def _delay(name):
+    time.sleep(float(os.environ.get("SNAPBACK_BENCH_" + name + "_MS", "0")) / 1000.0)
+class Cursor:
+    def __init__(self):
+        self.rows = ()
+    def execute(self, query, args=None):
+        self.rows = ()
+        if query.startswith("FLUSH TABLES WITH READ LOCK"):
+            _delay("FTWRL")
+        elif query.startswith("FLUSH TABLES"):
+            _delay("FLUSH")
+        elif query.startswith("SHOW MASTER STATUS"):
+            _delay("MASTER")
+            self.rows = (("mysql-bin.000001", 4),)
+        elif query.startswith("UNLOCK TABLES"):
+            _delay("UNLOCK")
+        return 0
+    def fetchone(self):
+        return self.rows and self.rows[0] or None
+    def fetchall(self):
+        return self.rows
+class Connection:
+    def cursor(self):
+        return Cursor()
+def connect(**kwargs):
+    _delay("CONNECT")
+    return Connection()
+'''
+
+# Stand-in for zfs: lists the configured datasets and sleeps through snapshots.
+FAKE_ZFS = '''import os, sys, time
+if sys.argv[1] == "list" and "snapshot" not in sys.argv:
+    print "\\n".join(os.environ["SNAPBACK_BENCH_DATASETS"].split(","))
+elif sys.argv[1] == "snapshot":
+    time.sleep(float(os.environ.get("SNAPBACK_BENCH_SNAPSHOT_MS", "0")) / 1000.0)
+'''
+
+
+## Fixtures
+def write_fixtures(workdir, python, datasets):
+    """Writes the stub MySQLdb, the fake zfs command and a SnapBack configuration. Returns the config path."""
+    f = open(os.path.join(workdir, "MySQLdb.py"), "w")
+    f.write(STUB_MYSQLDB)
+    f.close()
+    zfs = os.path.join(workdir, "zfs")
+    f = open(zfs, "w")
+    f.write("#!" + python + "\n" + FAKE_ZFS)
+    f.close()
+    os.chmod(zfs, 0755)
+    config = os.path.join(workdir, "snapback.cfg")
+    f = open(config, "w")
+    f.write("[MySQL]\nserver = bench\nuser = bench\npassword = bench\n\n"
+            "[ZFS]\nzfs_command = %s\ndb_fs_name = %s\nlog_fs_name = %s\nmasterinfo_naming = true\n\n"
+            "[Metrics]\njson_file = %s\n" % (zfs, datasets[0], datasets[-1], os.path.join(workdir, "phases.json")))
+    f.close()
+    return config
+
+
+## Benchmark
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def bench(args, datasets, workdir):
+    """Runs SnapBack args.runs times. Returns {phase: [ms per run]}."""
+    config = write_fixtures(workdir, args.python, datasets)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = workdir + (env.get("PYTHONPATH") and os.pathsep + env["PYTHONPATH"] or "")
+    env["SNAPBACK_BENCH_DATASETS"] = ",".join(datasets)
+    for name in ("connect", "flush", "ftwrl", "master", "unlock", "snapshot"):
+        env["SNAPBACK_BENCH_%s_MS" % name.upper()] = str(getattr(args, name + "_ms"))
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mysql_snapback.py")
+    for x in range(args.runs):
+        proc = subprocess.Popen([args.python, script, "--filename", config], env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise OSError("SnapBack run %d exited with %d:\n%s" % (x + 1, proc.returncode, output))
+    
+    # Sum repeated phases (one snapshot call per pool) per run
+    runs = {}
+    for line in open(os.path.join(workdir, "phases.json")):
+        record = json.loads(line)
+        phases = runs.setdefault(record["run"], {})
+        phases[record["phase"]] = phases.get(record["phase"], 0.0) + record["ms"]
+    timings = dict([(phase, []) for phase in PHASES])
+    injected = args.master_ms + args.unlock_ms + args.snapshot_ms * (len(set([fs.split("/")[0] for fs in datasets])))
+    for phases in runs.values():
+        phases["lock_overhead"] = phases["lock_hold"] - injected
+        for phase in PHASES:
+            if phase in phases:
+                timings[phase].append(phases[phase])
+    return timings
+
+
+## Main
+if __name__ == "__main__":
+    args = opt_parser.parse_args()[0]
+    datasets = [fs for fs in args.datasets.split(",") if fs]
+    if len(datasets) not in (1, 2):
+        print "Datasets (--datasets) must be a DB dataset and optionally a log dataset. Please see --help for more details."
+        sys.exit(-1)
+    if args.runs < 1:
+        print "Run count (--runs) must be at least 1. Please see --help for more details."
+        sys.exit(-1)
+    
+    workdir = tempfile.mkdtemp(prefix="mysql_snapback_bench.")
+    try:
+        try:
+            timings = bench(args, datasets, workdir)
+        except OSError, e:
+            print str(e)
+            sys.exit(-1)
+    finally:
+        shutil.rmtree(workdir, True)
+    
+    print "%-18s %9s %9s %9s %9s" % ("phase", "min_ms", "median_ms", "p95_ms", "max_ms")
+    medians = {}
+    for phase in PHASES:
+        if not timings[phase]:
+            continue
+        medians[phase] = percentile(timings[phase], 0.5)
+        print "%-18s %9.3f %9.3f %9.3f %9.3f" % (phase, min(timings[phase]), medians[phase],
+                                                  percentile(timings[phase], 0.95), max(timings[phase]))
+    print "\nlock_overhead = lock_hold less the injected master status, snapshot and unlock latencies"
+    print "(it includes starting the fake zfs command, as it would starting the real one)."
+    
+    if args.save:
+        f = open(args.save, "w")
+        json.dump(medians, f, indent=1, sort_keys=True)
+        f.close()
+        print "Saved the medians to %s." % args.save
+    if args.baseline:
+        f = open(args.baseline)
+        baseline = json.load(f)
+        f.close()
+        limit = baseline["lock_overhead"] * (1 + args.tolerance / 100.0) + 1.0
+        print "Lock overhead %.3fms against a baseline of %.3fms (limit %.3fms)." % \
+              (medians["lock_overhead"], baseline["lock_overhead"], limit)
+        if medians["lock_overhead"] > limit:
+            print "Lock overhead regressed."
+            sys.exit(1)
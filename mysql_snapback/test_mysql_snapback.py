@@ -0,0 +1,304 @@
+#!/usr/bin/python
+####################################################################
+# FILENAME: test_mysql_snapback.py
+# PROJECT: Miscellaneous Tools
+# DESCRIPTION: Runs SnapBack against mysql_snapback_bench.py's stub
+#       MySQLdb and fake zfs commands to test multi-instance
+#       configurations, replication, the snapshot catalog and
+#       verification. No MySQL server or ZFS is needed:
+#
+#       python -m unittest discover -s mysql_snapback -p "test_*.py"
+#
+########################################################################################
+import os, sys, shutil, tempfile, subprocess, hashlib, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mysql_snapback_bench
+
+# Stand-in for zfs that keeps its snapshots (in creation order) in a file, logs
+# destroy calls, can fail zfs send part way, mounts tank/db on <workdir>/mnt and
+# answers zfs diff with the contents of <workdir>/diff.
+FAKE_ZFS = '''import os, sys
+workdir = os.path.dirname(os.path.abspath(sys.argv[0]))
+state = os.path.join(workdir, "snapshots")
+snapshots = os.path.exists(state) and open(state).read().split() or []
+if sys.argv[1] == "list" and "snapshot" in sys.argv:
+    for snapshot in snapshots:
+        if snapshot.split("@")[0] == sys.argv[-1]:
+            print snapshot + "\\t-"
+elif sys.argv[1] == "list":
+    print "tank/db"
+elif sys.argv[1] == "snapshot":
+    open(state, "a").write("\\n".join(sys.argv[2:]) + "\\n")
+elif sys.argv[1] == "send":
+    sys.stdout.write("stream " * 100000)
+    sys.exit(int(os.environ.get("TEST_ZFS_SEND_STATUS", "0")))
+elif sys.argv[1] == "destroy":
+    open(os.path.join(workdir, "destroyed"), "a").write(" ".join(sys.argv[2:]) + "\\n")
+elif sys.argv[1] == "get":
+    print os.path.join(workdir, "mnt")
+elif sys.argv[1] == "diff":
+    sys.stdout.write(open(os.path.join(workdir, "diff")).read())
+'''
+
+
+def write_fake_zfs(workdir):
+    """Writes the stub MySQLdb, the snapshot keeping fake zfs and a configuration for tank/db."""
+    mysql_snapback_bench.write_fixtures(workdir, sys.executable, ["tank/db"])
+    f = open(os.path.join(workdir, "zfs"), "w")
+    f.write("#!" + sys.executable + "\n" + FAKE_ZFS)
+    f.close()
+
+def run_snapback(workdir, args=[], env={}):
+    """Runs SnapBack on workdir's snapback.cfg. Returns (exit status as sys.exit()'s -N, output)."""
+    env = dict(os.environ, **env)
+    env["PYTHONPATH"] = workdir + (env.get("PYTHONPATH") and os.pathsep + env["PYTHONPATH"] or "")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mysql_snapback.py")
+    proc = subprocess.Popen([sys.executable, script, "--filename", os.path.join(workdir, "snapback.cfg")] + args,
+                            env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    return proc.returncode > 0 and proc.returncode - 256 or proc.returncode, output
+
+
+class MultiInstanceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="test_mysql_snapback.")
+        mysql_snapback_bench.write_fixtures(self.workdir, sys.executable, ["tank/db"])
+        self.zfs = os.path.join(self.workdir, "zfs")
+        self.config = os.path.join(self.workdir, "multi.cfg")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, True)
+
+    def write_config(self, text):
+        f = open(self.config, "w")
+        f.write(text % {"zfs": self.zfs, "workdir": self.workdir})
+        f.close()
+
+    def run_snapback(self, args=[]):
+        """Returns (exit status as sys.exit()'s -N, output)."""
+        env = dict(os.environ)
+        env["PYTHONPATH"] = self.workdir + (env.get("PYTHONPATH") and os.pathsep + env["PYTHONPATH"] or "")
+        env["SNAPBACK_BENCH_DATASETS"] = "tank/shard01/db,tank/shard02/db"
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mysql_snapback.py")
+        proc = subprocess.Popen([sys.executable, script, "--filename", self.config] + args, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        return proc.returncode > 0 and proc.returncode - 256 or proc.returncode, output
+
+    def test_templated_shared_default(self):
+        self.write_config("[MySQL]\nserver = db\nuser = snapback\npassword = secret\n\n"
+                          "[ZFS]\nzfs_command = %(zfs)s\ndb_fs_name = tank/%%(instance)s/db\n"
+                          "log_fs_name = tank/%%(instance)s/db\nmasterinfo_naming = true\n\n"
+                          "[Scheduler]\nlock_dir = %(workdir)s\n\n"
+                          "[instance:shard01]\nserver = shard01\n\n"
+                          "[instance:shard02]\nserver = shard02\n")
+        status, output = self.run_snapback()
+        self.assertEqual(status, 0, output)
+        self.assert_("2 of 2 instances backed up." in output, output)
+        self.assert_("tank/shard02/db@" in output, output)
+
+    def test_unknown_instance_option(self):
+        self.write_config("[MySQL]\nserver = db\nuser = snapback\npassword = secret\n\n"
+                          "[ZFS]\nzfs_command = %(zfs)s\nmasterinfo_naming = true\n\n"
+                          "[instance:shard01]\ndb_fs_name = tank/shard01/db\nlog_fs_name = tank/shard01/db\n"
+                          "state_file = /var/db/shard01.replication\n")
+        for args in ([], ["--instance", "shard01"]):
+            status, output = self.run_snapback(args)
+            self.assertEqual(status, -3, output)
+            self.assert_("unknown option state_file" in output, output)
+
+
+class ReplicationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="test_mysql_snapback.")
+        write_fake_zfs(self.workdir)
+        self.target = os.path.join(self.workdir, "target")
+        os.mkdir(self.target)
+        self.config = open(os.path.join(self.workdir, "snapback.cfg")).read()
+        self.write_replication("file:" + self.target + "/%(fs)s@%(snapshot)s.zfs")
+
+    def write_replication(self, target):
+        f = open(os.path.join(self.workdir, "snapback.cfg"), "w")
+        f.write(self.config + "\n[Replication]\ntarget = %s\nstate_file = %s\nallow_full = true\n" %
+                (target, os.path.join(self.workdir, "replication")))
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, True)
+
+    def run_snapback(self, send_status=0):
+        return run_snapback(self.workdir, env={"TEST_ZFS_SEND_STATUS": str(send_status)})
+
+    def test_failed_stream_leaves_no_output(self):
+        status, output = self.run_snapback(1)
+        self.assertEqual(status, -10, output)
+        self.assertEqual(os.listdir(self.target), [])
+
+    def test_stream_is_renamed_into_place(self):
+        status, output = self.run_snapback(0)
+        self.assertEqual(status, 0, output)
+        files = os.listdir(self.target)
+        self.assertEqual(len(files), 1)
+        self.assert_(files[0].startswith("tank_db@") and files[0].endswith(".zfs"), files)
+        self.assertEqual(os.path.getsize(os.path.join(self.target, files[0])), len("stream ") * 100000)
+
+    def test_bad_target_template(self):
+        for target in ("file:" + self.target + "/%(dataset)s.zfs", "receive:zfs receive %(fs_name)"):
+            self.write_replication(target)
+            status, output = self.run_snapback()
+            self.assertEqual(status, -3, output)
+            self.assert_("is not a valid template" in output, output)
+            self.failIf(os.path.exists(os.path.join(self.workdir, "replication")), output)
+
+
+
+class CatalogTest(unittest.TestCase):
+
+    snapshots = ["20260130120000_mysql-bin.000009_500",
+                 "20260131120000_mysql-bin.000009_9000",
+                 "20260201060000_mysql-bin.000010_4",
+                 "manual",
+                 "20260201120000_mysql-bin.000010_700",
+                 "20260202120000_mysql-bin.000010_1500"]
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="test_mysql_snapback.")
+        write_fake_zfs(self.workdir)
+        f = open(os.path.join(self.workdir, "snapshots"), "w")
+        f.write("".join(["tank/db@" + snapshot + "\n" for snapshot in self.snapshots]))
+        f.close()
+        f = open(os.path.join(self.workdir, "snapback.cfg"), "a")
+        f.write("\n[Retention]\ndaily = 1\n")
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, True)
+
+    def find(self, kind, where):
+        status, output = run_snapback(self.workdir, ["catalog", "find", kind, where])
+        self.assertEqual(status, 0, output)
+        return output.splitlines()[-1].split()[0]
+
+    def test_find_binlog_across_rollover(self):
+        self.assertEqual(self.find("binlog", "mysql-bin.000010:100"), "20260201060000_mysql-bin.000010_4")
+        self.assertEqual(self.find("binlog", "mysql-bin.000009:99999"), "20260131120000_mysql-bin.000009_9000")
+        self.assertEqual(self.find("binlog", "mysql-bin.000010:1000"), "20260201120000_mysql-bin.000010_700")
+        status, output = run_snapback(self.workdir, ["catalog", "find", "binlog", "mysql-bin.000009:499"])
+        self.assertEqual(status, -8, output)
+
+    def test_find_time_prefix(self):
+        self.assertEqual(self.find("time", "20260201"), "20260131120000_mysql-bin.000009_9000")
+        self.assertEqual(self.find("time", "2026020106"), "20260201060000_mysql-bin.000010_4")
+        self.assertEqual(self.find("time", "20260301"), "20260202120000_mysql-bin.000010_1500")
+
+    def test_prune_dry_run(self):
+        status, output = run_snapback(self.workdir, ["--dry-run", "catalog", "prune"])
+        self.assertEqual(status, 0, output)
+        self.assert_("Keeping 1 and destroying 4 of 5 SnapBack snapshots." in output, output)
+        self.assertEqual([line.split()[-1] for line in output.splitlines() if "Would destroy" in line],
+                         self.snapshots[:3] + self.snapshots[4:5])
+        self.failIf(os.path.exists(os.path.join(self.workdir, "destroyed")), output)
+
+    def test_prune_ranges_skip_foreign_snapshot(self):
+        status, output = run_snapback(self.workdir, ["catalog", "prune"])
+        self.assertEqual(status, 0, output)
+        self.assertEqual(open(os.path.join(self.workdir, "destroyed")).read(),
+                         "tank/db@20260130120000_mysql-bin.000009_500%20260201060000_mysql-bin.000010_4,"
+                         "20260201120000_mysql-bin.000010_700\n")
+
+
+
+class VerifyTest(unittest.TestCase):
+
+    full = "20260201120000_mysql-bin.000010_700"
+    incremental = "20260202120000_mysql-bin.000010_1500"
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="test_mysql_snapback.")
+        write_fake_zfs(self.workdir)
+        self.mountpoint = os.path.join(self.workdir, "mnt")
+        self.manifests = os.path.join(self.workdir, "manifests")
+        os.mkdir(self.manifests)
+        f = open(os.path.join(self.workdir, "snapback.cfg"), "a")
+        f.write("\n[Verify]\nmanifest_dir = %s\nworkers = 2\n" % self.manifests)
+        f.close()
+        files = {"logs/old/a.log": "a", "logs/old/b.log": "b", "tmp/x": "x",
+                 "data/t2.ibd": "two", "tab\tname": "tab"}
+        for x in range(200):
+            files["data/f%03d" % x] = "table %d" % x
+        self.write_snapshot(self.full, files)
+        files.update({"logs/archived/a.log": "a", "logs/archived/b.log": "b",
+                      "data/t2.ibd": "TWO", "tab\tname": "TAB", "new file": "new"})
+        for path in ("logs/old/a.log", "logs/old/b.log", "tmp/x"):
+            del files[path]
+        self.files = files
+        self.write_snapshot(self.incremental, files)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, True)
+
+    def write_snapshot(self, snapshot, files):
+        root = os.path.join(self.mountpoint, ".zfs", "snapshot", snapshot)
+        for path, data in files.items():
+            if not os.path.isdir(os.path.dirname(os.path.join(root, path))):
+                os.makedirs(os.path.dirname(os.path.join(root, path)))
+            f = open(os.path.join(root, path), "w")
+            f.write(data)
+            f.close()
+        f = open(os.path.join(self.workdir, "snapshots"), "a")
+        f.write("tank/db@" + snapshot + "\n")
+        f.close()
+
+    def verify(self):
+        status, output = run_snapback(self.workdir, ["catalog", "verify"])
+        self.assertEqual(status, 0, output)
+        return output
+
+    def checksum(self, path):
+        status, output = run_snapback(self.workdir, ["catalog", "checksum", self.incremental, path])
+        return status, output.splitlines()[-1]
+
+    def test_full_then_incremental(self):
+        # Only the older snapshot is listed at first, and is hashed in full
+        f = open(os.path.join(self.workdir, "snapshots"), "w")
+        f.write("tank/db@" + self.full + "\n")
+        f.close()
+        self.assert_("(full): 205 of 205 files hashed" in self.verify())
+        
+        f = open(os.path.join(self.workdir, "snapshots"), "a")
+        f.write("tank/db@" + self.incremental + "\n")
+        f.close()
+        f = open(os.path.join(self.workdir, "diff"), "w")
+        f.write("".join([line.replace("<mnt>", self.mountpoint) + "\n" for line in
+                         ["M\t/\t<mnt>/data",
+                          "M\tF\t<mnt>/data/t2.ibd",
+                          "R\t/\t<mnt>/logs/old\t<mnt>/logs/archived",
+                          "-\t/\t<mnt>/tmp",	# Drops tmp/x with it
+                          "+\tF\t<mnt>/new\\0040file",
+                          "M\tF\t<mnt>/tab\\0011name"]]))
+        f.close()
+        self.assert_("(incremental from %s): 3 of 205 files hashed" % self.full in self.verify())
+        
+        # The derived manifest matches hashing the snapshot in full
+        expected = []
+        for path, data in self.files.items():
+            expected.append("%s\t%s\t%d\n" % (path.replace("\t", "\\t"), hashlib.sha256(data).hexdigest(), len(data)))
+        manifest = open(os.path.join(self.manifests, "tank_db@" + self.incremental + ".manifest")).read()
+        self.assertEqual(manifest, "".join(sorted(expected)))
+        
+        # catalog checksum binary searches the manifest by offset
+        for path in ("data/f000", "data/f137", "data/f199", "data/t2.ibd", "logs/archived/b.log", "new file", "tab\tname"):
+            status, line = self.checksum(path)
+            self.assertEqual(status, 0, line)
+            self.assertEqual(line, "%s  %d  tank/db@%s:%s" % (hashlib.sha256(self.files[path]).hexdigest(),
+                                                              len(self.files[path]), self.incremental, path))
+        for path in ("data/f", "data/f0500", "logs/old/a.log", "tmp/x", "zzz"):
+            status, line = self.checksum(path)
+            self.assertEqual(status, -8, line)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,6 +5,15 @@
 # DESCRIPTION: Nagios healthcheck. Verifies that the configured 
 #   queue on the specified AMQP server exists and that the queue's
 #   count of unacknowledged messages is below a particular threshold.
+#   Batch mode checks many queues (each with its own thresholds) over
+#   one connection and channel, reporting one aggregated status.
+#   With a state file, a short depth history per queue is kept to
+#   alarm on growth rate and estimated time-to-drain as well. Queues
+#   holding messages with nobody consuming them can alarm too, and
+#   every queue's depth, consumers and rate are reported as perfdata.
+#   run_check() runs the check in-process for passive_check_runner.
+#   amqplib is only imported once the server is contacted, so --help
+#   and argument errors start fast.
 # 
 #   Requires:
 #       * py-amqplib >= 0.5 (http://barryp.org/software/py-amqplib/)
@@ -37,17 +46,21 @@
 # DAMAGE.
 #
 ########################################################################################
-import sys, os, socket, struct
-from amqplib import client_0_8 as amqp
+import sys, os, struct, fnmatch, time, fcntl, hashlib
 from optparse import OptionParser
+amqp = None	# Imported by load_amqplib() on first use, with socket
+AMQPWriter = None
+socket = None
 
 
 ### Constants
 EXIT_NAGIOS_OK = 0
 EXIT_NAGIOS_WARN = 1
 EXIT_NAGIOS_CRITICAL = 2
+LIMIT_NAMES = ["warn", "critical", "rate_warn", "rate_critical", "ttd_warn", "ttd_critical",
+               "noconsumer_warn", "noconsumer_critical"]
 
-### Validate Commandline Arguments
+### Commandline Arguments
 opt_parser = OptionParser()
 
 opt_parser.add_option("-s", "--server", dest="server",
@@ -59,7 +72,17 @@ opt_parser.add_option("-u", "--user", dest="user",
 opt_parser.add_option("-p", "--password", dest="password",
                       help="Password to use when authenticating with server.")
 opt_parser.add_option("-q", "--queue", dest="queue_name",
-                      help="Queue name to check.")
+                      help="Queue name to check. Separate several names with commas for batch mode.")
+opt_parser.add_option("-f", "--queues-file", dest="queues_file",
+                      help="Batch mode: file listing one queue per line as "
+                           "'<queue> [<warn> <critical>] [rate_warn=N] [rate_critical=N] [ttd_warn=N] [ttd_critical=N] "
+                           "[noconsumer_warn=N] [noconsumer_critical=N]'. "
+                           "Lines whose queue is a glob pattern (e.g. 'jobs.*') only set the thresholds "
+                           "of listed queues they match; a queue's own line wins over patterns, and of several "
+                           "matching patterns the first one in the file applies, so list 'jobs.*' before '*'. "
+                           "Missing thresholds come from the command line.")
+opt_parser.add_option("-W", "--window", dest="window", type="int", default=50,
+                      help="Batch mode: passive declares kept in flight at once. (Default: 50)")
 opt_parser.add_option("-d", "--durable", action="store_true", dest="durable",
                       default="False", help="Declare queue as durable. (Default: False)")
 opt_parser.add_option("-a", "--auto-delete", action="store_true", dest="auto_delete",
@@ -68,84 +91,491 @@ opt_parser.add_option("-w", "--warn", dest="warn_threshold",
                       help="Number of unacknowledged messages that triggers a warning status.")
 opt_parser.add_option("-c", "--critical", dest="critical_threshold",
                       help="Number of unacknowledged messages that triggers a critical status.")
+opt_parser.add_option("-S", "--state-file", dest="state_file",
+                      help="File keeping a short depth history per queue. Enables growth rate and "
+                           "time-to-drain evaluation.")
+opt_parser.add_option("-H", "--history", dest="history", type="int", default=16,
+                      help="Depth samples kept per queue in the state file. (Default: 16)")
+opt_parser.add_option("--state-expire", dest="state_expire", type="int", default=7 * 86400,
+                      help="Seconds after which an unchecked queue's history may be reused. (Default: 604800)")
+opt_parser.add_option("--rate-warn", dest="rate_warn",
+                      help="Queue growth (messages/sec) that triggers a warning status.")
+opt_parser.add_option("--rate-critical", dest="rate_critical",
+                      help="Queue growth (messages/sec) that triggers a critical status.")
+opt_parser.add_option("--ttd-warn", dest="ttd_warn",
+                      help="Estimated time-to-drain (secs) of a draining queue that triggers a warning "
+                           "status. Steady and growing queues are judged by --rate-warn/--rate-critical.")
+opt_parser.add_option("--ttd-critical", dest="ttd_critical",
+                      help="Estimated time-to-drain (secs) that triggers a critical status.")
+opt_parser.add_option("--no-consumers-warn", dest="noconsumer_warn",
+                      help="Triggers a warning status when a queue has no consumers and holds more "
+                           "than this many messages.")
+opt_parser.add_option("--no-consumers-critical", dest="noconsumer_critical",
+                      help="Triggers a critical status when a queue has no consumers and holds more "
+                           "than this many messages.")
 
 
-args = opt_parser.parse_args()[0]
-
-if args.server == None:
-    print "An AMQP server (--server) must be supplied. Please see --help for more details."
-    sys.exit(-1)
-if args.vhost == None:
-    print "A virtual host (--vhost) must be supplied. Please see --help for more details."
-    sys.exit(-1)
-if args.user == None:
-    print "A username (--user) to use when authenticating with AMQP server must be supplied. " \
-          "Please see --help for more details."
-    sys.exit(-1)
-if args.password == None:
-    print "A password (--password) to use when authenticating with AMQP server must be supplied. " \
-          "Please see --help for more details."
-    sys.exit(-1)
-if args.queue_name == None:
-    print "A queue name (--queue) must be supplied. Please see --help for more details."
-    sys.exit(-1)
-if args.warn_threshold == None:
-    print "A warning threshold (--warn) must be supplied. Please see --help for more details."
-    sys.exit(-1)
-try:
-    warn_threshold = int(args.warn_threshold)
-    if warn_threshold < 0:
-        raise ValueError
-except ValueError, e:
-    print "Warning threshold (--warn) must be a positive integer. Please see --help for more details."
-    sys.exit(-1)
-if args.critical_threshold == None:
-    print "A critical threshold (--critical) must be supplied. Please see --help for more details."
-    sys.exit(-1)
-try:
-    critical_threshold = int(args.critical_threshold)
-    if critical_threshold < 0:
-        raise ValueError
-except ValueError, e:
-    print "Critical threshold (--critical) must be a positive integer. Please see --help for more details."
-    sys.exit(-1)
-
-
-### Check Queue Count
-try:
-    mq_conn = amqp.Connection(host=args.server, 
-                              userid=args.user, 
-                              password=args.password,
-                              virtual_host=args.vhost,
-                              connect_timeout=5)
+## Service functions
+class UsageError(Exception):
+    """Bad arguments or check configuration. main() prints it and exits with -1."""
+
+def parse_threshold(value, option, description, convert=int):
+    """Validates a threshold argument and returns it converted (raises UsageError on bad input)."""
+    try:
+        threshold = convert(value)
+        if threshold < 0:
+            raise ValueError
+    except ValueError, e:
+        raise UsageError("%s threshold (%s) must be a positive number. Please see --help for more details." % \
+                         (description, option))
+    return threshold
+
+def parse_limit(name, value, where):
+    """Validates one named threshold (see LIMIT_NAMES)."""
+    if name in ("warn", "critical", "noconsumer_warn", "noconsumer_critical"):
+        return parse_threshold(value, where, name.capitalize(), int)
+    return parse_threshold(value, where, name.replace("_", " ").capitalize(), float)
+
+def load_queue_specs(path):
+    """Reads a queues file. Returns ([queue names], [(queue or pattern, {limit name: value})]) in file order."""
+    try:
+        f = open(path, "r")
+    except IOError, e:
+        raise UsageError("Cannot open queues file '%s'. (%s)" % (path, str(e)))
+    queues = []
+    thresholds = []
+    lines = f.readlines()
+    f.close()
+    for line_no, line in enumerate(lines):
+        fields = line.split("#", 1)[0].split()
+        if not fields:
+            continue
+        where = "%s line %d" % (path, line_no + 1)
+        counts = [field for field in fields[1:] if "=" not in field]
+        if len(counts) not in (0, 2):
+            raise UsageError("Queues file %s must be '<queue> [<warn> <critical>] [name=value ...]'." % where)
+        limits = {}
+        if counts:
+            limits["warn"] = parse_limit("warn", counts[0], where)
+            limits["critical"] = parse_limit("critical", counts[1], where)
+        for field in fields[1:]:
+            if "=" in field:
+                name, value = field.split("=", 1)
+                if name not in LIMIT_NAMES:
+                    raise UsageError("Unknown threshold '%s' in queues file %s." % (name, where))
+                limits[name] = parse_limit(name, value, where)
+        if limits:
+            thresholds.append((fields[0], limits))
+        if not [c for c in "*?[" if c in fields[0]]:
+            queues.append(fields[0])
+    return queues, thresholds
+
+def queue_thresholds(queue, thresholds, default):
+    """Thresholds for a queue: its own line, over the first matching pattern in file order, over the defaults."""
+    limits = dict(default)
+    for pattern, pattern_limits in thresholds:
+        if pattern != queue and fnmatch.fnmatchcase(queue, pattern):
+            limits.update(pattern_limits)
+            break
+    for name, name_limits in thresholds:
+        if name == queue:
+            limits.update(name_limits)
+    return limits
+
+def load_amqplib():
+    """Imports amqplib on first use."""
+    global amqp, AMQPWriter, socket
+    if amqp == None:
+        import socket
+        from amqplib import client_0_8 as amqp
+        from amqplib.client_0_8.serialization import AMQPWriter
+
+def send_passive_declare(chan, queue, durable, auto_delete):
+    """Writes a passive Queue.Declare without waiting for its Declare-Ok (mirrors Channel.queue_declare)."""
+    args = AMQPWriter()
+    args.write_short(chan.default_ticket)
+    args.write_shortstr(queue)
+    args.write_bit(True)            # passive
+    args.write_bit(durable)
+    args.write_bit(False)           # exclusive
+    args.write_bit(auto_delete)
+    args.write_bit(False)           # nowait
+    args.write_table({})
+    chan._send_method((50, 10), args)
+
+def declare_queues(mq_conn, queues, window, durable, auto_delete):
+    """Passively declares every queue over one channel with up to `window` declares in flight.
+    
+    Returns {queue: (message_count, consumer_count)}, or an error string for queues that could
+    not be declared. The broker closes the channel on the first failing declare (404 when the
+    queue is missing) and drops the declares behind it, so the channel is re-opened and those
+    are re-sent instead of failing the whole batch.
+    """
+    results = {}
+    pending = list(queues)
     mq_chan = mq_conn.channel()
-    queue_stats = mq_chan.queue_declare(queue=args.queue_name,
-                                        durable=args.durable,
-                                        auto_delete=args.auto_delete,
-                                        passive=True)
-except (socket.error,
-      amqp.AMQPConnectionException,
-      amqp.AMQPChannelException), e:
-    print "CRITICAL: Problem establishing MQ connection to server %s: %s " \
-          % (str(args.server), str(repr(e)))
-    sys.exit(EXIT_NAGIOS_CRITICAL)
-except struct.error, e:
-    print "CRITICAL: Authentication error connecting to vhost '%s' on server '%s'." % \
-          (str(args.vhost), str(args.server))
-    sys.exit(EXIT_NAGIOS_CRITICAL)
-
-mq_chan.close()
-mq_conn.close()
-
-if int(queue_stats[1]) >= critical_threshold:
-    print "CRITICAL: %s unacknowledged messages in queue '%s' on vhost '%s', server '%s'." % \
-          (str(queue_stats[1]), args.queue_name, str(args.vhost), str(args.server))
-    sys.exit(EXIT_NAGIOS_CRITICAL)
-elif int(queue_stats[1]) >= warn_threshold:
-    print "WARN: %s unacknowledged messages in queue '%s' on vhost '%s', server '%s'." % \
-          (str(queue_stats[1]), args.queue_name, str(args.vhost), str(args.server))
-    sys.exit(EXIT_NAGIOS_WARN)
-else:
-    print "OK: %s unacknowledged messages in queue '%s' on vhost '%s', server '%s'." % \
-          (str(queue_stats[1]), args.queue_name, str(args.vhost), str(args.server))
-    sys.exit(EXIT_NAGIOS_OK)
+    while pending:
+        in_flight = pending[:window]
+        for queue in in_flight:
+            send_passive_declare(mq_chan, queue, durable, auto_delete)
+        try:
+            for queue in in_flight:
+                queue_stats = mq_chan.wait(allowed_methods=[(50, 11)])
+                results[queue] = (int(queue_stats[1]), int(queue_stats[2]))
+                pending.pop(0)
+        except amqp.AMQPChannelException, e:
+            if e.amqp_reply_code == 404:
+                results[pending.pop(0)] = "missing"
+            else:
+                results[pending.pop(0)] = "declare failed (%s %s)" % (e.amqp_reply_code, e.amqp_reply_text)
+            mq_chan = mq_conn.channel()
+    mq_chan.close()
+    return results
+
+
+class QueueStateStore:
+    """Bounded ring of (timestamp, depth) samples per queue, kept in one fixed-record file.
+    
+    The file is a header (magic, ring size, record count) followed by fixed-size records:
+    a 16-byte digest of server/vhost/queue, the ring head and sample count, then the ring of
+    (uint32 time, uint32 depth) samples. The file is locked and read in one go; only the
+    records that changed are written back. Records of queues not checked for `expire`
+    secs are reused, so the file stays bounded by the number of live queues.
+    """
+    
+    MAGIC = "AQS1"
+    HEADER = struct.Struct(">4sHI")
+    RECORD = struct.Struct(">16sHH")
+    SAMPLE = struct.Struct(">II")
+    
+    def __init__(self, path, ring_size, expire):
+        self.ring_size = ring_size
+        self.expire = expire
+        self.record_size = self.RECORD.size + self.SAMPLE.size * ring_size
+        self.f = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0644), "r+b")
+        fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        self.data = bytearray(self.f.read())
+        self.count = 0
+        if len(self.data) >= self.HEADER.size:
+            magic, size, count = self.HEADER.unpack_from(buffer(self.data))
+            if magic == self.MAGIC and size == ring_size and \
+               len(self.data) >= self.HEADER.size + count * self.record_size:
+                self.count = count
+        if self.count == 0:
+            self.data = bytearray(self.HEADER.size)     # New, foreign or resized state file
+            self.f.truncate(0)
+        self.index = {}
+        for record in range(self.count):
+            self.index[str(self.data[self.offset(record):self.offset(record) + 16])] = record
+        self.expired = None
+        self.dirty = set()
+    
+    def offset(self, record):
+        return self.HEADER.size + record * self.record_size
+    
+    def samples(self, record):
+        """Returns the record's samples, oldest first."""
+        offset = self.offset(record)
+        digest, head, count = self.RECORD.unpack_from(buffer(self.data), offset)
+        samples = []
+        for x in range(count):
+            slot = (head - count + x) % self.ring_size
+            samples.append(self.SAMPLE.unpack_from(buffer(self.data), offset + self.RECORD.size + slot * self.SAMPLE.size))
+        return samples
+    
+    def new_record(self, digest, now):
+        """Reuses an expired record or appends a new one."""
+        if self.expired == None:
+            self.expired = []
+            for record in range(self.count):
+                samples = self.samples(record)
+                if not samples or samples[-1][0] < now - self.expire:
+                    self.expired.append(record)
+        # The list is built once per run; skip candidates sampled since (reused or refreshed)
+        record = None
+        while self.expired and record == None:
+            candidate = self.expired.pop()
+            samples = self.samples(candidate)
+            if candidate not in self.dirty and (not samples or samples[-1][0] < now - self.expire):
+                record = candidate
+        if record != None:
+            del self.index[str(self.data[self.offset(record):self.offset(record) + 16])]
+        else:
+            record = self.count
+            self.count = self.count + 1
+            self.data.extend(bytearray(self.record_size))
+        self.RECORD.pack_into(self.data, self.offset(record), digest, 0, 0)
+        self.index[digest] = record
+        return record
+    
+    def add(self, key, now, depth):
+        """Records a depth sample for key and returns the key's samples, oldest first."""
+        digest = hashlib.md5(key).digest()
+        record = self.index.get(digest)
+        if record == None:
+            record = self.new_record(digest, now)
+        offset = self.offset(record)
+        digest, head, count = self.RECORD.unpack_from(buffer(self.data), offset)
+        if count and self.samples(record)[-1][0] >= now:
+            head = (head - 1) % self.ring_size     # Same second as the last check: replace it
+            count = count - 1
+        self.SAMPLE.pack_into(self.data, offset + self.RECORD.size + head * self.SAMPLE.size,
+                              now, min(depth, 0xFFFFFFFF))
+        self.RECORD.pack_into(self.data, offset, digest, (head + 1) % self.ring_size,
+                              min(count + 1, self.ring_size))
+        self.dirty.add(record)
+        return self.samples(record)
+    
+    def close(self):
+        """Writes the changed records and header back, then releases the lock."""
+        self.HEADER.pack_into(self.data, 0, self.MAGIC, self.ring_size, self.count)
+        self.f.seek(0)
+        self.f.write(self.data[:self.HEADER.size])
+        for record in sorted(self.dirty):
+            self.f.seek(self.offset(record))
+            self.f.write(self.data[self.offset(record):self.offset(record) + self.record_size])
+        self.f.flush()
+        fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        self.f.close()
+
+
+def queue_trend(samples):
+    """Least-squares growth rate (messages/sec) over the samples and the resulting time-to-drain.
+    
+    Returns (None, None) until two samples at different times exist. Time-to-drain is 0 for
+    an empty queue and infinite for a queue holding messages that is not draining.
+    """
+    if len(samples) < 2 or samples[0][0] == samples[-1][0]:
+        return None, None
+    mean_time = float(sum([sample[0] for sample in samples])) / len(samples)
+    mean_depth = float(sum([sample[1] for sample in samples])) / len(samples)
+    variance = sum([(sample[0] - mean_time) ** 2 for sample in samples])
+    covariance = sum([(sample[0] - mean_time) * (sample[1] - mean_depth) for sample in samples])
+    rate = covariance / variance
+    depth = samples[-1][1]
+    if depth == 0:
+        return rate, 0.0
+    elif rate < 0:
+        return rate, depth / -rate
+    return rate, float("inf")
+
+def format_duration(seconds):
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= size:
+            return "%.1f%s" % (seconds / size, unit)
+    return "%ds" % seconds
+
+def evaluate_queue(message_count, consumer_count, trend, limits):
+    """Returns the Nagios exit code for a queue's depth, consumers and trend against its limits."""
+    rate, time_to_drain = trend
+    for level, exit_code in (("critical", EXIT_NAGIOS_CRITICAL), ("warn", EXIT_NAGIOS_WARN)):
+        if message_count >= limits[level]:
+            return exit_code
+        if consumer_count == 0 and limits.get("noconsumer_" + level) != None and \
+           message_count > limits["noconsumer_" + level]:
+            return exit_code
+        if rate != None and limits.get("rate_" + level) != None and rate >= limits["rate_" + level]:
+            return exit_code
+        # Only a draining queue has a time-to-drain worth judging; steady or growing ones are
+        # left to the rate thresholds, or a steady queue with consumers would never be OK
+        if rate != None and rate < 0 and limits.get("ttd_" + level) != None and \
+           time_to_drain >= limits["ttd_" + level]:
+            return exit_code
+    return EXIT_NAGIOS_OK
+
+def queue_perfdata(labels, message_count, consumer_count, trend, limits):
+    """Perfdata for one queue: depth (with thresholds), consumers and, once known, messages/sec.
+    
+    labels names the (messages, consumers, rate) values. The rate is the net growth rate
+    from the state file history.
+    """
+    labels = ["'%s'" % label.replace("'", "''") for label in labels]
+    perfdata = ["%s=%d;%d;%d;0;" % (labels[0], message_count, limits["warn"], limits["critical"]),
+                "%s=%d;;;0;" % (labels[1], consumer_count)]
+    if trend[0] != None:
+        perfdata.append("%s=%.3f;%s;%s;;" % (labels[2], trend[0], limits.get("rate_warn", ""),
+                                              limits.get("rate_critical", "")))
+    return perfdata
+
+def format_trend(trend):
+    if trend[0] == None:
+        return "trend pending"
+    elif trend[1] == float("inf"):
+        return "%+.1f/s, not draining" % trend[0]
+    return "%+.1f/s, drains in %s" % (trend[0], format_duration(trend[1]))
+
+
+## Check
+def run_check(argv):
+    """Runs the check for a command line (without the program name).
+    
+    Returns (exit code, status message, perfdata) and raises UsageError on bad arguments.
+    """
+    ### Validate Commandline Arguments
+    args = opt_parser.parse_args(argv)[0]
+    
+    if args.server == None:
+        raise UsageError("An AMQP server (--server) must be supplied. Please see --help for more details.")
+    if args.vhost == None:
+        raise UsageError("A virtual host (--vhost) must be supplied. Please see --help for more details.")
+    if args.user == None:
+        raise UsageError("A username (--user) to use when authenticating with AMQP server must be supplied. " \
+                         "Please see --help for more details.")
+    if args.password == None:
+        raise UsageError("A password (--password) to use when authenticating with AMQP server must be supplied. " \
+                         "Please see --help for more details.")
+    if args.queue_name == None and args.queues_file == None:
+        raise UsageError("A queue name (--queue) or queues file (--queues-file) must be supplied. "
+                         "Please see --help for more details.")
+    if args.window < 1:
+        raise UsageError("The declare window (--window) must be at least 1. Please see --help for more details.")
+    if args.history < 2 or args.history > 65535:
+        raise UsageError("The history length (--history) must be between 2 and 65535. Please see --help for more details.")
+    
+    queues = []
+    thresholds = []
+    if args.queue_name != None:
+        queues = [queue for queue in args.queue_name.split(",") if queue]
+    if args.queues_file != None:
+        file_queues, thresholds = load_queue_specs(args.queues_file)
+        queues = queues + [queue for queue in file_queues if queue not in queues]
+    if not queues:
+        raise UsageError("No queues to check were found. Please see --help for more details.")
+    batch_mode = args.queues_file != None or len(queues) > 1
+    
+    default_thresholds = {}
+    for name, option in (("rate_warn", "--rate-warn"), ("rate_critical", "--rate-critical"),
+                         ("ttd_warn", "--ttd-warn"), ("ttd_critical", "--ttd-critical"),
+                         ("noconsumer_warn", "--no-consumers-warn"), ("noconsumer_critical", "--no-consumers-critical")):
+        if getattr(args, name) != None:
+            default_thresholds[name] = parse_limit(name, getattr(args, name), option)
+    # --warn/--critical are only required for queues without their own thresholds
+    if args.warn_threshold != None:
+        default_thresholds["warn"] = parse_threshold(args.warn_threshold, "--warn", "Warning")
+    if args.critical_threshold != None:
+        default_thresholds["critical"] = parse_threshold(args.critical_threshold, "--critical", "Critical")
+    for queue in queues:
+        limits = queue_thresholds(queue, thresholds, default_thresholds)
+        if "warn" not in limits:
+            raise UsageError("A warning threshold (--warn) must be supplied. Please see --help for more details.")
+        if "critical" not in limits:
+            raise UsageError("A critical threshold (--critical) must be supplied. Please see --help for more details.")
+    
+    ### Check Queue Counts
+    load_amqplib()
+    mq_conn = None
+    try:
+        try:
+            mq_conn = amqp.Connection(host=args.server, 
+                                      userid=args.user, 
+                                      password=args.password,
+                                      virtual_host=args.vhost,
+                                      connect_timeout=5)
+            if batch_mode:
+                queue_results = declare_queues(mq_conn, queues, args.window, args.durable, args.auto_delete)
+            else:
+                mq_chan = mq_conn.channel()
+                queue_stats = mq_chan.queue_declare(queue=queues[0],
+                                                    durable=args.durable,
+                                                    auto_delete=args.auto_delete,
+                                                    passive=True)
+                queue_results = {queues[0]: (int(queue_stats[1]), int(queue_stats[2]))}
+                mq_chan.close()
+        except (socket.error,
+              amqp.AMQPConnectionException,
+              amqp.AMQPChannelException), e:
+            return (EXIT_NAGIOS_CRITICAL, "CRITICAL: Problem establishing MQ connection to server %s: %s " \
+                    % (str(args.server), str(repr(e))), "")
+        except struct.error, e:
+            return (EXIT_NAGIOS_CRITICAL, "CRITICAL: Authentication error connecting to vhost '%s' on server '%s'." % \
+                    (str(args.vhost), str(args.server)), "")
+    finally:
+        if mq_conn != None:
+            try:
+                mq_conn.close()
+            except (socket.error, amqp.AMQPException), e:
+                pass	# Already broken; the check result above stands
+    
+    ### Update Depth History
+    trends = {}
+    if args.state_file != None:
+        try:
+            state = QueueStateStore(args.state_file, args.history, args.state_expire)
+            now = int(time.time())
+            for queue in queues:
+                if isinstance(queue_results[queue], tuple):
+                    trends[queue] = queue_trend(state.add("%s\0%s\0%s" % (args.server, args.vhost, queue),
+                                                          now, queue_results[queue][0]))
+            state.close()
+        except (IOError, OSError), e:
+            return (EXIT_NAGIOS_CRITICAL, "CRITICAL: Cannot update state file '%s'. (%s)" % (args.state_file, str(e)), "")
+    
+    if not batch_mode:
+        message_count, consumer_count = queue_results[queues[0]]
+        trend = trends.get(queues[0], (None, None))
+        limits = queue_thresholds(queues[0], thresholds, default_thresholds)
+        exit_code = evaluate_queue(message_count, consumer_count, trend, limits)
+        status = {EXIT_NAGIOS_CRITICAL: "CRITICAL", EXIT_NAGIOS_WARN: "WARN", EXIT_NAGIOS_OK: "OK"}[exit_code]
+        if args.state_file != None:
+            trend_text = " Trend: %s." % format_trend(trend)
+        else:
+            trend_text = ""
+        return (exit_code,
+                "%s: %s unacknowledged messages and %d consumers in queue '%s' on vhost '%s', server '%s'.%s" % \
+                (status, str(message_count), consumer_count, queues[0], str(args.vhost), str(args.server), trend_text),
+                " ".join(queue_perfdata(("messages", "consumers", "rate"), message_count, consumer_count, trend, limits)))
+    
+    ### Aggregate Batch Results
+    critical = []
+    warn = []
+    perfdata = []
+    for queue in queues:
+        limits = queue_thresholds(queue, thresholds, default_thresholds)
+        if not isinstance(queue_results[queue], tuple):
+            critical.append("%s (%s)" % (queue, queue_results[queue]))
+            continue
+        message_count, consumer_count = queue_results[queue]
+        trend = trends.get(queue, (None, None))
+        exit_code = evaluate_queue(message_count, consumer_count, trend, limits)
+        if args.state_file != None:
+            text = "%s (%d, %d consumers, %s)" % (queue, message_count, consumer_count, format_trend(trend))
+        else:
+            text = "%s (%d, %d consumers)" % (queue, message_count, consumer_count)
+        if exit_code == EXIT_NAGIOS_CRITICAL:
+            critical.append(text)
+        elif exit_code == EXIT_NAGIOS_WARN:
+            warn.append(text)
+        perfdata.extend(queue_perfdata((queue, queue + "_consumers", queue + "_rate"),
+                                       message_count, consumer_count, trend, limits))
+    
+    if critical:
+        status, exit_code = "CRITICAL", EXIT_NAGIOS_CRITICAL
+    elif warn:
+        status, exit_code = "WARN", EXIT_NAGIOS_WARN
+    else:
+        status, exit_code = "OK", EXIT_NAGIOS_OK
+    details = ""
+    if critical:
+        details = details + " Critical: %s." % ", ".join(critical)
+    if warn:
+        details = details + " Warn: %s." % ", ".join(warn)
+    return (exit_code,
+            "%s: %d critical, %d warn, %d OK of %d queues on vhost '%s', server '%s'.%s" % \
+            (status, len(critical), len(warn), len(queues) - len(critical) - len(warn), len(queues),
+             str(args.vhost), str(args.server), details),
+            " ".join(perfdata))
+
+def main():
+    try:
+        exit_code, message, perfdata = run_check(sys.argv[1:])
+    except UsageError, e:
+        print str(e)
+        sys.exit(-1)
+    if perfdata:
+        message = message + " | " + perfdata
+    print message
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+####################################################################
+# FILENAME: nagios/check_startup_bench
+# PROJECT: Platar
+# DESCRIPTION: Measures cold-start time of the Nagios checks run as
+#   active checks: --help, an argument error and (for redis_check)
+#   a cached-INFO run, next to bare interpreter startup and the cost
+#   of importing each client library. Also reports how many modules
+#   each run imports and whether the client library was among them,
+#   so startup regressions show up before deployment.
+#
+########################################################################################
+# (C)2011 DigiTar, All Rights Reserved
+# Distributed under the BSD License
+# 
+# Redistribution and use in source and binary forms, with or without modification, 
+#    are permitted provided that the following conditions are met:
+#
+#        * Redistributions of source code must retain the above copyright notice, 
+#          this list of conditions and the following disclaimer.
+#        * Redistributions in binary form must reproduce the above copyright notice, 
+#          this list of conditions and the following disclaimer in the documentation 
+#          and/or other materials provided with the distribution.
+#        * Neither the name of DigiTar nor the names of its contributors may be
+#          used to endorse or promote products derived from this software without 
+#          specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY 
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES 
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT 
+# SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, 
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED 
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR 
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN 
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+#
+########################################################################################
+import os, sys, re, time, json, shutil, tempfile, subprocess
+from optparse import OptionParser
+
+
+### Commandline Arguments
+opt_parser = OptionParser(usage="%prog [--runs 20] [--python /usr/bin/python]")
+
+opt_parser.add_option("-r", "--runs", dest="runs", type="int", default=20,
+                      help="Timed runs per scenario. (Default: 20)")
+opt_parser.add_option("-p", "--python", dest="python", default=sys.executable,
+                      help="Interpreter the checks are started with. (Default: this one)")
+opt_parser.add_option("-c", "--checks", dest="checks", default="redis_check,amqp_queue_check",
+                      help="Comma separated checks to benchmark. (Default: redis_check,amqp_queue_check)")
+
+CLIENT_LIBRARIES = {"redis_check": "redis", "amqp_queue_check": "amqplib"}
+
+
+## Scenarios
+def write_redis_snapshot(cache_dir):
+    """Writes a fresh INFO snapshot so redis_check answers from its cache."""
+    f = open(os.path.join(cache_dir, "redis_bench_6379.json"), "w")
+    json.dump({"fetched": time.time(),
+               "info": {"used_memory": 64 * 1024 * 1024, "uptime_in_days": 1, "connected_clients": 1,
+                        "redis_version": "bench", "multiplexing_api": "epoll", "db0": {"keys": 1}}}, f)
+    f.close()
+
+def scenarios(checks, cache_dir):
+    """Returns [(name, argv after the interpreter)]."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs = [("python -c pass", ["-c", "pass"])]
+    for check in checks:
+        script = os.path.join(here, check + ".py")
+        library = CLIENT_LIBRARIES[check]
+        runs.append(("import %s" % library, ["-c", "import %s" % library]))
+        runs.append(("%s --help" % check, [script, "--help"]))
+        runs.append(("%s bad args" % check, [script, "--server", "bench"]))
+        if check == "redis_check":
+            runs.append(("%s cached" % check, [script, "-s", "bench", "-p", "6379", "-w", "100", "-c", "200",
+                                               "-C", cache_dir, "--cache-ttl", "3600",
+                                               "--cache-max-stale", "3600"]))
+    return runs
+
+
+## Benchmark
+def run(python, argv, verbose=False):
+    """Runs the interpreter once. Returns (wall secs, exit code, stderr)."""
+    started = time.time()
+    proc = subprocess.Popen([python] + (verbose and ["-v"] or []) + argv,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr = proc.communicate()[1]
+    return (time.time() - started, proc.returncode, stderr)
+
+def imported_modules(stderr):
+    """Module names from `python -v` output."""
+    modules = set()
+    for line in stderr.splitlines():
+        match = re.match(r"^import (\S+) ", line)
+        if match:
+            modules.add(match.group(1))
+    return modules
+
+def bench(python, argv, runs):
+    """Times runs cold starts. Returns a result dict."""
+    times = []
+    for x in range(runs):
+        elapsed, exit_code, stderr = run(python, argv)
+        times.append(elapsed * 1000.0)
+    times.sort()
+    modules = imported_modules(run(python, argv, True)[2])
+    return {"min_ms": times[0],
+            "median_ms": times[len(times) / 2],
+            "max_ms": times[-1],
+            "exit_code": exit_code,
+            "modules": modules}
+
+
+## Main
+if __name__ == "__main__":
+    args = opt_parser.parse_args()[0]
+    checks = [check for check in args.checks.split(",") if check]
+    for check in checks:
+        if check not in CLIENT_LIBRARIES:
+            print "Unknown check '%s'. Please see --help for more details." % check
+            sys.exit(-1)
+    if args.runs < 1:
+        print "Run count (--runs) must be at least 1. Please see --help for more details."
+        sys.exit(-1)
+    
+    cache_dir = tempfile.mkdtemp(prefix="check_startup_bench.")
+    try:
+        write_redis_snapshot(cache_dir)
+        print "%-28s %9s %9s %9s %5s %8s  %s" % ("scenario", "min_ms", "median_ms", "max_ms", "exit",
+                                                "modules", "client library imported")
+        for name, argv in scenarios(checks, cache_dir):
+            result = bench(args.python, argv, args.runs)
+            libraries = [library for library in CLIENT_LIBRARIES.values() if library in result["modules"]]
+            print "%-28s %9.1f %9.1f %9.1f %5d %8d  %s" % \
+                  (name, result["min_ms"], result["median_ms"], result["max_ms"], result["exit_code"],
+                   len(result["modules"]), ", ".join(libraries) or "-")
+    finally:
+        shutil.rmtree(cache_dir, True)
+    print "\nexit = exit code of the last run. A nonzero exit on an 'import' line means the library is not installed."
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+####################################################################
+# FILENAME: nagios/passive_check_runner
+# PROJECT: Platar
+# DESCRIPTION: Runs many Nagios checks from one long-lived process.
+#   Reads a definitions file of '<host>;<service>;<check> [<args>]'
+#   lines, where <check> is a check script in this directory that
+#   exposes run_check(argv) (amqp_queue_check, redis_check). Checks
+#   run on a pool of worker threads every --interval secs and their
+#   results are submitted as passive results, either through the
+#   Nagios external command file or as check result files dropped
+#   into Nagios' check_result_path spool directory.
+#
+########################################################################################
+# (C)2011 DigiTar, All Rights Reserved
+# Distributed under the BSD License
+# 
+# Redistribution and use in source and binary forms, with or without modification, 
+#    are permitted provided that the following conditions are met:
+#
+#        * Redistributions of source code must retain the above copyright notice, 
+#          this list of conditions and the following disclaimer.
+#        * Redistributions in binary form must reproduce the above copyright notice, 
+#          this list of conditions and the following disclaimer in the documentation 
+#          and/or other materials provided with the distribution.
+#        * Neither the name of DigiTar nor the names of its contributors may be
+#          used to endorse or promote products derived from this software without 
+#          specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY 
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES 
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT 
+# SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, 
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED 
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR 
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN 
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+#
+########################################################################################
+import sys, os, re, time, shlex, tempfile, threading, Queue
+from optparse import OptionParser
+
+
+### Constants
+EXIT_NAGIOS_OK = 0
+EXIT_NAGIOS_UNKNOWN = 3
+
+### Commandline Arguments
+opt_parser = OptionParser(usage="%prog --definitions <file> (--command-file <file> | --spool-dir <dir>) [options]")
+
+opt_parser.add_option("-d", "--definitions", dest="definitions",
+                      help="File listing one check per line as '<host>;<service>;<check> [<args>]'.")
+opt_parser.add_option("-o", "--command-file", dest="command_file",
+                      help="Submit results as PROCESS_SERVICE_CHECK_RESULT commands to this Nagios "
+                           "external command file.")
+opt_parser.add_option("-s", "--spool-dir", dest="spool_dir",
+                      help="Submit results as check result files in this directory (Nagios' check_result_path).")
+opt_parser.add_option("-w", "--workers", dest="workers", type="int", default=8,
+                      help="Checks run concurrently. (Default: 8)")
+opt_parser.add_option("-i", "--interval", dest="interval", type="float", default=60.0,
+                      help="Secs between runs of each check. 0 runs every check once and exits. (Default: 60)")
+
+
+## Service functions
+class CheckDefinition:
+    """One definitions file line, plus its scheduling state."""
+    
+    def __init__(self, host, service, module, argv):
+        self.host = host
+        self.service = service
+        self.module = module
+        self.argv = argv
+        self.next_run = 0
+        self.running = False
+
+def load_definitions(path):
+    """Reads a definitions file, importing each check module once. Returns [CheckDefinition]."""
+    f = open(path, "r")
+    lines = f.readlines()
+    f.close()
+    modules = {}
+    definitions = []
+    for line_no, line in enumerate(lines):
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        where = "%s line %d" % (path, line_no + 1)
+        fields = line.strip().split(";", 2)
+        if len(fields) != 3 or not fields[0] or not fields[1] or not fields[2].strip():
+            raise ValueError("Definitions file %s must be '<host>;<service>;<check> [<args>]'." % where)
+        argv = shlex.split(fields[2])
+        name = os.path.basename(argv[0])
+        if name.endswith(".py"):
+            name = name[:-3]
+        if not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", name):
+            raise ValueError("Check '%s' in definitions file %s is not a check module name." % (argv[0], where))
+        if name not in modules:
+            try:
+                modules[name] = __import__(name)
+            except ImportError, e:
+                raise ValueError("Cannot import check '%s' from definitions file %s. (%s)" % (name, where, str(e)))
+            if not hasattr(modules[name], "run_check") or not hasattr(modules[name], "UsageError"):
+                raise ValueError("Check '%s' in definitions file %s has no run_check()." % (name, where))
+        definitions.append(CheckDefinition(fields[0], fields[1], modules[name], argv[1:]))
+    return definitions
+
+def run_definition(definition):
+    """Runs one check. Returns (exit code, output with perfdata, start time, finish time)."""
+    started = time.time()
+    try:
+        exit_code, message, perfdata = definition.module.run_check(definition.argv)
+    except SystemExit, e:
+        exit_code, message, perfdata = EXIT_NAGIOS_UNKNOWN, "UNKNOWN: Invalid check arguments.", ""	# optparse
+    except definition.module.UsageError, e:
+        exit_code, message, perfdata = EXIT_NAGIOS_UNKNOWN, "UNKNOWN: %s" % str(e), ""
+    except Exception, e:
+        exit_code, message, perfdata = EXIT_NAGIOS_UNKNOWN, "UNKNOWN: Check failed: %s" % repr(e), ""
+    if perfdata:
+        message = message + "|" + perfdata
+    return (exit_code, message, started, time.time())
+
+def worker(pending, results):
+    while True:
+        definition = pending.get()
+        results.put((definition,) + run_definition(definition))
+
+def submit_commands(command_file, results):
+    """Writes the results to the Nagios external command file in one write."""
+    commands = []
+    for definition, exit_code, output, started, finished in results:
+        commands.append("[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n" % \
+                        (int(finished), definition.host, definition.service, exit_code, output.replace("\n", "\\n")))
+    f = open(command_file, "a")
+    f.write("".join(commands))
+    f.close()
+
+def submit_spool(spool_dir, results):
+    """Drops the results into Nagios' check result spool as one file plus its .ok marker."""
+    records = ["### Active Check Result File ###\nfile_time=%d\n" % int(time.time())]
+    for definition, exit_code, output, started, finished in results:
+        records.append("### Nagios Service Check Result ###\n"
+                       "# Time: %s\n"
+                       "host_name=%s\n"
+                       "service_description=%s\n"
+                       "check_type=1\n"
+                       "check_options=0\n"
+                       "scheduled_check=0\n"
+                       "reschedule_check=0\n"
+                       "latency=0.0\n"
+                       "start_time=%.6f\n"
+                       "finish_time=%.6f\n"
+                       "early_timeout=0\n"
+                       "exited_ok=1\n"
+                       "return_code=%d\n"
+                       "output=%s\n" % \
+                       (time.ctime(finished), definition.host, definition.service, started, finished,
+                        exit_code, output.replace("\\", "\\\\").replace("\n", "\\n")))
+    fd, path = tempfile.mkstemp(prefix="c", dir=spool_dir)
+    os.fchmod(fd, 0644)
+    f = os.fdopen(fd, "w")
+    f.write("\n".join(records))
+    f.close()
+    open(path + ".ok", "w").close()	# Nagios only reads result files whose .ok marker exists
+
+
+if __name__ == "__main__":
+    ### Validate Commandline Arguments
+    args = opt_parser.parse_args()[0]
+    
+    if args.definitions == None:
+        print "A definitions file (--definitions) must be supplied. Please see --help for more details."
+        sys.exit(-1)
+    if (args.command_file == None) == (args.spool_dir == None):
+        print "Exactly one of --command-file or --spool-dir must be supplied. Please see --help for more details."
+        sys.exit(-1)
+    if args.spool_dir != None and not os.path.isdir(args.spool_dir):
+        print "Spool directory (--spool-dir) '%s' does not exist." % args.spool_dir
+        sys.exit(-1)
+    if args.workers < 1:
+        print "The worker count (--workers) must be at least 1. Please see --help for more details."
+        sys.exit(-1)
+    if args.interval < 0:
+        print "The interval (--interval) must not be negative. Please see --help for more details."
+        sys.exit(-1)
+    try:
+        definitions = load_definitions(args.definitions)
+    except (IOError, ValueError), e:
+        print str(e)
+        sys.exit(-1)
+    if not definitions:
+        print "No checks were found in definitions file '%s'." % args.definitions
+        sys.exit(-1)
+    
+    pending = Queue.Queue()
+    results = Queue.Queue()
+    for x in range(min(args.workers, len(definitions))):
+        thread = threading.Thread(target=worker, args=(pending, results))
+        thread.setDaemon(True)
+        thread.start()
+    
+    ### Run Checks
+    # First runs are spread over one interval so the checks don't all start at once
+    now = time.time()
+    for x in range(len(definitions)):
+        definitions[x].next_run = now + args.interval * x / len(definitions)
+    outstanding = 0
+    submitted = 0
+    try:
+        while True:
+            now = time.time()
+            for definition in definitions:
+                if definition.next_run != None and definition.next_run <= now and not definition.running:
+                    definition.running = True
+                    outstanding = outstanding + 1
+                    pending.put(definition)
+                    if args.interval:
+                        while definition.next_run <= now:
+                            definition.next_run = definition.next_run + args.interval	# Skip missed runs
+                    else:
+                        definition.next_run = None
+            if not args.interval and not outstanding:
+                break
+            
+            # Wait for results until the next check is due, then submit them all in one go
+            due = [definition.next_run for definition in definitions if definition.next_run != None]
+            wait = due and max(0.01, min(min(due) - time.time(), 1.0)) or 1.0
+            batch = []
+            try:
+                batch.append(results.get(True, wait))
+                while True:
+                    batch.append(results.get_nowait())
+            except Queue.Empty:
+                pass
+            if not batch:
+                continue
+            for result in batch:
+                result[0].running = False
+            outstanding = outstanding - len(batch)
+            try:
+                if args.command_file != None:
+                    submit_commands(args.command_file, batch)
+                else:
+                    submit_spool(args.spool_dir, batch)
+                submitted = submitted + len(batch)
+            except (IOError, OSError), e:
+                sys.stderr.write("Cannot submit %d check results. (%s)\n" % (len(batch), str(e)))
+    except KeyboardInterrupt:
+        pass
+    print "Submitted %d passive check results." % submitted
+    sys.exit(EXIT_NAGIOS_OK)
@@ -4,7 +4,17 @@
 # PROJECT: Misc Scripts
 # DESCRIPTION: Redis RAM healthcheck. Verifies via Redis INFO command
 #              that Redis is available and that it's own count of RAM
-#              usage is below the specified thresholds.
+#              usage is below the specified thresholds. Can check a
+#              list of instances concurrently, reporting one aggregated
+#              status or one Nagios passive check result per instance.
+#              Optionally probes PING round-trip latency with its own
+#              p99 thresholds, and can sample the keyspace with SCAN to
+#              name the key prefixes holding the memory. Checks of the
+#              same instance can share one cached INFO snapshot.
+#              run_check() runs the check in-process for
+#              passive_check_runner. redis is only imported once a
+#              server has to be contacted, so --help, argument errors
+#              and cached INFO start fast.
 #
 # $Id$
 ######################################################################
@@ -36,17 +46,20 @@
 #
 ########################################################################################
 
-import sys, os, socket, struct
-import redis
+import sys, os, re, struct, time, fcntl, json
 from optparse import OptionParser
+redis = None	# Imported by load_redis() on first use
 
 
 ### Constants
 EXIT_NAGIOS_OK = 0
 EXIT_NAGIOS_WARN = 1
 EXIT_NAGIOS_CRITICAL = 2
+STATUS_NAMES = {EXIT_NAGIOS_OK: "OK", EXIT_NAGIOS_WARN: "WARN", EXIT_NAGIOS_CRITICAL: "CRITICAL"}
+INFO_SECTIONS = ["server", "clients", "memory", "keyspace"]	# Everything the check reads from INFO
+CONNECTION_ERRORS = ()	# Set by load_redis(); nothing connects before it runs
 
-### Validate Commandline Arguments
+### Commandline Arguments
 opt_parser = OptionParser()
 
 opt_parser.add_option("-s", "--server", dest="server",
@@ -57,66 +70,568 @@ opt_parser.add_option("-w", "--warn", dest="warn_threshold",
                       help="Memory utlization (in MB) that triggers a warning status.")
 opt_parser.add_option("-c", "--critical", dest="critical_threshold",
                       help="Memory utlization (in MB) that triggers a critical status.")
+opt_parser.add_option("-l", "--latency", dest="pings", type="int", default=0,
+                      help="Latency mode: send this many PINGs and report p50/p99/max round-trip. (Default: 0, off)")
+opt_parser.add_option("--latency-warn", dest="latency_warn", type="float",
+                      help="Latency mode: p99 PING round-trip (in ms) that triggers a warning status.")
+opt_parser.add_option("--latency-critical", dest="latency_critical", type="float",
+                      help="Latency mode: p99 PING round-trip (in ms) that triggers a critical status.")
+opt_parser.add_option("-k", "--sample-keys", dest="sample",
+                      help="Keyspace sampling: 'warn' samples keys with SCAN when memory is over a threshold, "
+                           "'always' samples on every check. Reports the key prefixes using the most memory "
+                           "(needs MEMORY USAGE, Redis 4.0+).")
+opt_parser.add_option("--sample-time", dest="sample_time", type="float", default=1.0,
+                      help="Keyspace sampling: wall time budget in secs. (Default: 1)")
+opt_parser.add_option("--sample-commands", dest="sample_commands", type="int", default=2000,
+                      help="Keyspace sampling: maximum commands sent (SCAN + 2 per key). (Default: 2000)")
+opt_parser.add_option("--sample-count", dest="sample_count", type="int", default=100,
+                      help="Keyspace sampling: SCAN COUNT per batch. (Default: 100)")
+opt_parser.add_option("--sample-pause", dest="sample_pause", type="float", default=10.0,
+                      help="Keyspace sampling: pause between batches in ms. (Default: 10)")
+opt_parser.add_option("--sample-separator", dest="sample_separator", default=":",
+                      help="Keyspace sampling: keys are grouped by the text before the first separator. (Default: ':')")
+opt_parser.add_option("--sample-top", dest="sample_top", type="int", default=5,
+                      help="Keyspace sampling: number of prefixes reported. (Default: 5)")
+opt_parser.add_option("-C", "--cache-dir", dest="cache_dir",
+                      help="Share INFO between checks of the same instance through snapshots kept in this directory.")
+opt_parser.add_option("--cache-ttl", dest="cache_ttl", type="float", default=30.0,
+                      help="INFO cache: secs a snapshot is reused before the next check refreshes it. (Default: 30)")
+opt_parser.add_option("--cache-max-stale", dest="cache_max_stale", type="float", default=120.0,
+                      help="INFO cache: oldest snapshot (in secs) served while another check holds the refresh "
+                           "lock. Older snapshots are never used. (Default: 120)")
+opt_parser.add_option("-i", "--instances", dest="instances",
+                      help="Multi-instance mode: comma separated list of host:port instances to check.")
+opt_parser.add_option("-f", "--instances-file", dest="instances_file",
+                      help="Multi-instance mode: file listing one instance per line as "
+                           "'<host>:<port> [<warn> <critical>]'. Instances without thresholds use "
+                           "--warn/--critical.")
+opt_parser.add_option("-t", "--timeout", dest="timeout", type="float", default=5.0,
+                      help="Per-instance connect/read timeout in secs. (Default: 5)")
+opt_parser.add_option("-W", "--workers", dest="workers", type="int", default=16,
+                      help="Multi-instance mode: instances queried concurrently. (Default: 16)")
+opt_parser.add_option("-o", "--output", dest="output", default="aggregate",
+                      help="Multi-instance mode: 'aggregate' prints one status for all instances, "
+                           "'passive' submits one passive check result per instance. (Default: aggregate)")
+opt_parser.add_option("--command-file", dest="command_file", default="/usr/local/nagios/var/rw/nagios.cmd",
+                      help="Nagios external command file passive results are written to. "
+                           "(Default: /usr/local/nagios/var/rw/nagios.cmd)")
+opt_parser.add_option("--service", dest="service", default="Redis %(port)s",
+                      help="Service description passive results are submitted for; %(host)s and %(port)s "
+                           "are replaced with the instance's. The host name is the instance's host. "
+                           "(Default: 'Redis %(port)s')")
 
 
-args = opt_parser.parse_args()[0]
-
-if args.server == None:
-    print "A Redis server (--server) must be supplied. Please see --help for more details."
-    sys.exit(-1)
-if args.port == None:
-    print "A Redis port number must be supplied. " \
-          "Please see --help for more details."
-    sys.exit(-1)
-if args.warn_threshold == None:
-    print "A warning threshold (--warn) must be supplied. Please see --help for more details."
-    sys.exit(-1)
-try:
-    warn_threshold = int(args.warn_threshold)
-    if warn_threshold < 0:
-        raise ValueError
-except ValueError, e:
-    print "Warning threshold (--warn) must be a positive integer. Please see --help for more details."
-    sys.exit(-1)
-if args.critical_threshold == None:
-    print "A critical threshold (--critical) must be supplied. Please see --help for more details."
-    sys.exit(-1)
-try:
-    critical_threshold = int(args.critical_threshold)
-    if critical_threshold < 0:
-        raise ValueError
-except ValueError, e:
-    print "Critical threshold (--critical) must be a positive integer. Please see --help for more details."
-    sys.exit(-1)
-
-
-### Check Queue Count
-try:
-    redis_conn = redis.Redis(host=args.server, port=int(args.port))
-    redis_stats = redis_conn.info()
-except (socket.error,
-        redis.exceptions.ConnectionError), e:
-    print "CRITICAL: Problem establishing connection to Redis server %s: %s " \
-          % (str(args.server), str(repr(e)))
-    sys.exit(EXIT_NAGIOS_CRITICAL)
-
-
-if redis_stats["used_memory"]/1024/1024 >= critical_threshold:
-    print "CRITICAL: Redis is using %dMB of RAM." % (redis_stats["used_memory"]/1024/1024)
-    sys.exit(EXIT_NAGIOS_CRITICAL)
-elif redis_stats["used_memory"]/1024/1024 >= warn_threshold:
-    print "WARN: Redis is using %dMB of RAM." % (redis_stats["used_memory"]/1024/1024)
-    sys.exit(EXIT_NAGIOS_WARN)
-else:
-    db_key_count = ""
-    for key in redis_stats.keys():
-        if key[:2] == "db":
-            db_key_count = db_key_count + ", DB-%s: %s keys" % (key[2:], redis_stats[key]["keys"])
-    print "OK: Redis is using %dMB of RAM. Days Up: %s, Clients: %s, Version: %s, Polling API: %s%s" % \
-          (redis_stats["used_memory"]/1024/1024, 
-           redis_stats["uptime_in_days"],
-           redis_stats["connected_clients"], 
-           redis_stats["redis_version"],
-           redis_stats["multiplexing_api"],
-           db_key_count)
-    sys.exit(EXIT_NAGIOS_OK)
+## Service functions
+class UsageError(Exception):
+    """Bad arguments or check configuration. main() prints it and exits with -1."""
+
+def parse_threshold(value, option, description):
+    """Validates a threshold argument and returns it as an int (raises UsageError on bad input)."""
+    try:
+        threshold = int(value)
+        if threshold < 0:
+            raise ValueError
+    except ValueError, e:
+        raise UsageError("%s threshold (%s) must be a positive integer. Please see --help for more details." % \
+                             (description, option))
+    return threshold
+
+def parse_instance(value, where):
+    """Splits 'host:port' (raises UsageError on bad input)."""
+    try:
+        host, port = value.rsplit(":", 1)
+        port = int(port)
+        if not host:
+            raise ValueError
+    except ValueError, e:
+        raise UsageError("Instance '%s' (%s) must be given as host:port. Please see --help for more details." % (value, where))
+    return host, port
+
+def load_instances(path, default):
+    """Reads an instances file. Returns [(host, port, warn, critical)]."""
+    try:
+        f = open(path, "r")
+    except IOError, e:
+        raise UsageError("Cannot open instances file '%s'. (%s)" % (path, str(e)))
+    instances = []
+    lines = f.readlines()
+    f.close()
+    for line_no, line in enumerate(lines):
+        fields = line.split("#", 1)[0].split()
+        if not fields:
+            continue
+        where = "%s line %d" % (path, line_no + 1)
+        if len(fields) not in (1, 3):
+            raise UsageError("Instances file %s must be '<host>:<port> [<warn> <critical>]'." % where)
+        host, port = parse_instance(fields[0], where)
+        if len(fields) == 3:
+            thresholds = (parse_threshold(fields[1], where, "Warning"), parse_threshold(fields[2], where, "Critical"))
+        elif default == None:
+            raise UsageError("A warning threshold (--warn) must be supplied. Please see --help for more details.")
+        else:
+            thresholds = default
+        instances.append((host, port) + thresholds)
+    return instances
+
+def load_redis():
+    """Imports redis on first use. Returns the module."""
+    global redis, CONNECTION_ERRORS
+    if redis == None:
+        import socket, redis
+        # redis-py 2.10+ raises TimeoutError (a RedisError, not a ConnectionError) when socket_timeout expires
+        CONNECTION_ERRORS = (socket.error, redis.exceptions.ConnectionError,
+                             getattr(redis.exceptions, "TimeoutError", redis.exceptions.ConnectionError))
+    return redis
+
+def fetch_info(redis_conn, sections):
+    """Fetches only the given INFO sections, pipelined into one round-trip.
+    
+    Servers older than 2.6 (and redis-py releases without sectioned INFO) only know the
+    full INFO reply, so those fall back to it.
+    """
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        for section in sections:
+            pipe.info(section)
+        redis_stats = {}
+        for reply in pipe.execute():
+            redis_stats.update(reply)
+        return redis_stats
+    except (TypeError, redis.exceptions.ResponseError), e:
+        return redis_conn.info()
+
+class InfoSnapshotCache:
+    """TTL cache of INFO replies shared by every check run against the same instance.
+    
+    Each instance has a JSON snapshot file, replaced atomically by rename, and a lock file.
+    A snapshot younger than `ttl` is used as-is. Otherwise one check takes the lock and
+    refreshes it while concurrent checks wait up to `lock_wait` secs for the new snapshot,
+    then fall back to a snapshot no older than `max_stale`, then to querying the server
+    themselves.
+    """
+    
+    def __init__(self, directory, ttl, max_stale, lock_wait):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.lock_wait = lock_wait
+    
+    def path(self, server, port):
+        return os.path.join(self.directory, "redis_%s_%d.json" % (re.sub(r"[^A-Za-z0-9.-]", "_", server), int(port)))
+    
+    def read(self, path):
+        """Returns (fetched, info) from a snapshot file, or None if it is missing or unreadable."""
+        try:
+            f = open(path, "r")
+            try:
+                snapshot = json.load(f)
+            finally:
+                f.close()
+            return (float(snapshot["fetched"]), snapshot["info"])
+        except (IOError, ValueError, KeyError, TypeError), e:
+            return None
+    
+    def write(self, path, info, fetched):
+        import tempfile
+        fd, temp_path = tempfile.mkstemp(prefix=".redis_", dir=self.directory)
+        f = os.fdopen(fd, "w")
+        try:
+            json.dump({"fetched": fetched, "info": info}, f, separators=(",", ":"))
+        finally:
+            f.close()
+        os.rename(temp_path, path)
+    
+    def fetch(self, connect, server, port, sections):
+        """Returns (INFO dict, snapshot age in secs), refreshing the snapshot if it is stale.
+        
+        connect() is only called, to get a connection, when the server has to be queried.
+        """
+        path = self.path(server, port)
+        snapshot = self.read(path)
+        if snapshot and 0 <= time.time() - snapshot[0] < self.ttl:
+            return (snapshot[1], time.time() - snapshot[0])
+        
+        lock = open(path + ".lock", "a")
+        try:
+            deadline = time.time() + self.lock_wait
+            locked = False
+            while not locked:
+                try:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                except IOError, e:
+                    if time.time() >= deadline:
+                        break
+                    time.sleep(0.05)
+            if locked:
+                snapshot = self.read(path)	# Refreshed while we waited?
+                if snapshot and 0 <= time.time() - snapshot[0] < self.ttl:
+                    return (snapshot[1], time.time() - snapshot[0])
+            elif snapshot and 0 <= time.time() - snapshot[0] <= self.max_stale:
+                return (snapshot[1], time.time() - snapshot[0])
+            fetched = time.time()
+            info = fetch_info(connect(), sections)
+            if locked:
+                self.write(path, info, fetched)
+            return (info, 0.0)
+        finally:
+            lock.close()
+
+def measure_latency(redis_conn, pings):
+    """Times pings PING round-trips. Returns the round-trips in ms, sorted."""
+    round_trips = []
+    for x in range(pings):
+        started = time.time()
+        redis_conn.ping()
+        round_trips.append((time.time() - started) * 1000.0)
+    round_trips.sort()
+    return round_trips
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    return values[min(len(values) - 1, max(0, int(len(values) * fraction + 0.5) - 1))]
+
+def format_perfdata(perfdata, prefix=""):
+    """Renders [(label, value, unit, warn, critical)] as Nagios perfdata."""
+    items = []
+    for label, value, unit, warn, critical in perfdata:
+        limits = ["", ""]
+        for x, limit in enumerate((warn, critical)):
+            if limit != None:
+                limits[x] = "%g" % limit
+        items.append("'%s%s'=%.3f%s;%s;%s;0;" % (prefix, label, value, unit, limits[0], limits[1]))
+    return " ".join(items)
+
+def sample_keyspace(redis_conn, budget, max_commands, count, pause, separator):
+    """Walks the keyspace with SCAN, sizing each key with MEMORY USAGE and TYPE.
+    
+    The walk stops at the end of the keyspace, after budget secs or once max_commands have
+    been sent, whichever comes first. Batches are bounded by count and separated by pause
+    secs so the server is never held for long. Returns (prefixes, sampled keys, complete)
+    where prefixes maps prefix -> [bytes, keys, {type: keys}].
+    """
+    deadline = time.time() + budget
+    prefixes = {}
+    sampled = 0
+    commands = 0
+    cursor = 0
+    while True:
+        cursor, keys = redis_conn.execute_command("SCAN", cursor, "COUNT", count)
+        cursor = int(cursor)
+        commands = commands + 1
+        keys = keys[:max(0, (max_commands - commands) / 2)]
+        if keys:
+            pipe = redis_conn.pipeline(transaction=False)
+            for key in keys:
+                pipe.execute_command("MEMORY", "USAGE", key)
+                pipe.type(key)
+            replies = pipe.execute()
+            commands = commands + len(keys) * 2
+            for x in range(len(keys)):
+                usage, key_type = replies[x * 2], replies[x * 2 + 1]
+                if usage == None:
+                    continue	# Expired or deleted since the SCAN
+                if separator in keys[x]:
+                    prefix = keys[x].split(separator, 1)[0]
+                else:
+                    prefix = "(none)"
+                if prefix not in prefixes:
+                    prefixes[prefix] = [0, 0, {}]
+                stats = prefixes[prefix]
+                stats[0] = stats[0] + int(usage)
+                stats[1] = stats[1] + 1
+                stats[2][key_type] = stats[2].get(key_type, 0) + 1
+                sampled = sampled + 1
+        if cursor == 0:
+            return (prefixes, sampled, True)
+        if commands >= max_commands or time.time() + pause >= deadline:
+            return (prefixes, sampled, False)
+        time.sleep(pause)
+
+def format_sample(prefixes, sampled, complete, total_keys, top):
+    """Summarizes sample_keyspace() results as the top prefixes by memory."""
+    if not sampled:
+        return "Keyspace sample found no keys."
+    sampled_bytes = sum([stats[0] for stats in prefixes.values()])
+    scale = float(max(total_keys, sampled)) / sampled
+    ranked = sorted(prefixes.items(), key=lambda item: item[1][0], reverse=True)[:top]
+    summary = []
+    for prefix, stats in ranked:
+        key_type = sorted(stats[2].items(), key=lambda item: item[1], reverse=True)[0][0]
+        summary.append("%s %d%% ~%.1fMB %s" % (prefix, stats[0] * 100 / max(sampled_bytes, 1),
+                                             stats[0] * scale / 1024.0 / 1024.0, key_type))
+    return "Top key prefixes (%d of %d keys sampled%s): %s." % \
+           (sampled, max(total_keys, sampled), not complete and ", estimated" or "", ", ".join(summary))
+
+def check_redis(server, port, warn_threshold, critical_threshold, timeout,
+                pings=0, latency_warn=None, latency_critical=None, sample=None, cache=None):
+    """Checks one Redis instance's RAM usage and, if pings is set, its PING latency.
+    
+    sample is None or a dict of sample_keyspace() settings plus "mode" and "top". cache is
+    None or an InfoSnapshotCache INFO is read through.
+    
+    Returns (exit code, status message, perfdata) where perfdata is a list of
+    (label, value, unit, warn, critical).
+    """
+    connection = []
+    def connect():
+        if not connection:
+            connection.append(load_redis().Redis(host=server, port=int(port), socket_timeout=timeout))
+        return connection[0]
+    
+    try:
+        info_age = 0
+        if cache:
+            redis_stats, info_age = cache.fetch(connect, server, port, INFO_SECTIONS)
+        else:
+            redis_stats = fetch_info(connect(), INFO_SECTIONS)
+        if pings:
+            round_trips = measure_latency(connect(), pings)
+    except CONNECTION_ERRORS, e:
+        return (EXIT_NAGIOS_CRITICAL, "CRITICAL: Problem establishing connection to Redis server %s: %s " \
+                % (str(server), str(repr(e))), [])
+    
+    if redis_stats["used_memory"]/1024/1024 >= critical_threshold:
+        exit_code = EXIT_NAGIOS_CRITICAL
+        message = "Redis is using %dMB of RAM." % (redis_stats["used_memory"]/1024/1024)
+    elif redis_stats["used_memory"]/1024/1024 >= warn_threshold:
+        exit_code = EXIT_NAGIOS_WARN
+        message = "Redis is using %dMB of RAM." % (redis_stats["used_memory"]/1024/1024)
+    else:
+        db_key_count = ""
+        for key in redis_stats.keys():
+            if key[:2] == "db":
+                db_key_count = db_key_count + ", DB-%s: %s keys" % (key[2:], redis_stats[key]["keys"])
+        exit_code = EXIT_NAGIOS_OK
+        message = "Redis is using %dMB of RAM. Days Up: %s, Clients: %s, Version: %s, Polling API: %s%s" % \
+                  (redis_stats["used_memory"]/1024/1024, 
+                   redis_stats["uptime_in_days"],
+                   redis_stats["connected_clients"], 
+                   redis_stats["redis_version"],
+                   redis_stats["multiplexing_api"],
+                   db_key_count)
+    if info_age >= 1:
+        message = message.rstrip(".") + ". INFO snapshot is %ds old." % info_age
+    
+    if sample and (sample["mode"] == "always" or exit_code != EXIT_NAGIOS_OK):
+        try:
+            prefixes, sampled, complete = sample_keyspace(connect(), sample["time"], sample["commands"],
+                                                          sample["count"], sample["pause"], sample["separator"])
+            total_keys = 0
+            if isinstance(redis_stats.get("db0"), dict):
+                total_keys = int(redis_stats["db0"].get("keys", 0))
+            message = message.rstrip(".") + ". " + format_sample(prefixes, sampled, complete,
+                                                                 total_keys, sample["top"])
+        except redis.exceptions.ResponseError, e:
+            message = message.rstrip(".") + ". Keyspace sampling failed (MEMORY USAGE needs Redis 4.0+): %s." % str(e)
+        except CONNECTION_ERRORS, e:
+            message = message.rstrip(".") + ". Keyspace sampling interrupted: %s." % str(repr(e))
+    
+    perfdata = []
+    if pings:
+        p50, p99, worst = percentile(round_trips, 0.50), percentile(round_trips, 0.99), round_trips[-1]
+        if latency_critical != None and p99 >= latency_critical:
+            exit_code = EXIT_NAGIOS_CRITICAL
+            breach = " >= %gms critical" % latency_critical
+        elif latency_warn != None and p99 >= latency_warn:
+            exit_code = max(exit_code, EXIT_NAGIOS_WARN)
+            breach = " >= %gms warn" % latency_warn
+        else:
+            breach = ""
+        message = message.rstrip(".") + ". PING p99 %.2fms%s (p50 %.2fms, max %.2fms over %d PINGs)." % \
+                  (p99, breach, p50, worst, pings)
+        perfdata = [("latency_p50", p50, "ms", None, None),
+                    ("latency_p99", p99, "ms", latency_warn, latency_critical),
+                    ("latency_max", worst, "ms", None, None)]
+    return (exit_code, "%s: %s" % (STATUS_NAMES[exit_code], message), perfdata)
+
+def check_instances(instances, workers, check_args):
+    """Checks every (host, port, warn, critical) instance on a pool of worker threads.
+    
+    Each instance is bounded by its own socket timeout, so the total wall time follows the
+    slowest instance rather than the sum of all of them. check_args are passed to check_redis
+    after the instance. Returns [(exit code, message, perfdata)] in instance order.
+    """
+    import threading, Queue
+    pending = Queue.Queue()
+    for index in range(len(instances)):
+        pending.put(index)
+    results = [None] * len(instances)
+    
+    def worker():
+        while True:
+            try:
+                index = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = check_redis(*(instances[index] + check_args))
+            except Exception, e:
+                results[index] = (EXIT_NAGIOS_CRITICAL, "CRITICAL: Error checking Redis server %s: %s" % \
+                                  (instances[index][0], str(repr(e))), [])
+    
+    threads = [threading.Thread(target=worker) for x in range(min(workers, len(instances)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def service_description(service, host, port):
+    """Expands %(host)s and %(port)s in a --service template (raises UsageError on bad templates)."""
+    try:
+        return service % {"host": host, "port": port}
+    except (KeyError, ValueError, TypeError), e:
+        raise UsageError("Service description (--service) '%s' may only use %%(host)s and %%(port)s. (%s)" % \
+                         (service, str(e)))
+
+def submit_passive_results(command_file, service, instances, results):
+    """Writes one PROCESS_SERVICE_CHECK_RESULT per instance to the Nagios command file."""
+    now = int(time.time())
+    commands = []
+    for index in range(len(instances)):
+        exit_code, message, perfdata = results[index]
+        if perfdata:
+            message = message + " | " + format_perfdata(perfdata)
+        commands.append("[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n" % \
+                        (now, instances[index][0], service_description(service, *instances[index][:2]),
+                         exit_code, message.replace("\n", " ")))
+    f = open(command_file, "a")
+    f.write("".join(commands))
+    f.close()
+
+
+## Check
+def run_check(argv):
+    """Runs the check for a command line (without the program name).
+    
+    Returns (exit code, status message, perfdata) and raises UsageError on bad arguments.
+    """
+    ### Validate Commandline Arguments
+    args = opt_parser.parse_args(argv)[0]
+    multi_mode = args.instances != None or args.instances_file != None
+    
+    if not multi_mode and args.server == None:
+        raise UsageError("A Redis server (--server) must be supplied. Please see --help for more details.")
+    if not multi_mode and args.port == None:
+        raise UsageError("A Redis port number must be supplied. " \
+                         "Please see --help for more details.")
+    default_thresholds = None
+    if not multi_mode or args.warn_threshold != None or args.critical_threshold != None or args.instances != None:
+        if args.warn_threshold == None:
+            raise UsageError("A warning threshold (--warn) must be supplied. Please see --help for more details.")
+        warn_threshold = parse_threshold(args.warn_threshold, "--warn", "Warning")
+        if args.critical_threshold == None:
+            raise UsageError("A critical threshold (--critical) must be supplied. Please see --help for more details.")
+        critical_threshold = parse_threshold(args.critical_threshold, "--critical", "Critical")
+        default_thresholds = (warn_threshold, critical_threshold)
+    if args.timeout <= 0:
+        raise UsageError("The timeout (--timeout) must be greater than zero. Please see --help for more details.")
+    if args.pings < 0:
+        raise UsageError("The PING count (--latency) must be a positive integer. Please see --help for more details.")
+    if (args.latency_warn != None or args.latency_critical != None) and not args.pings:
+        raise UsageError("Latency thresholds require latency mode (--latency). Please see --help for more details.")
+    if args.latency_warn != None and args.latency_critical != None and args.latency_warn > args.latency_critical:
+        raise UsageError("The latency warning threshold must not exceed the critical threshold. "
+                         "Please see --help for more details.")
+    sample = None
+    if args.sample != None:
+        if args.sample not in ("warn", "always"):
+            raise UsageError("Keyspace sampling (--sample-keys) must be 'warn' or 'always'. "
+                             "Please see --help for more details.")
+        if args.sample_time <= 0 or args.sample_commands < 3 or args.sample_count < 1 or args.sample_pause < 0 or \
+           args.sample_top < 1 or not args.sample_separator:
+            raise UsageError("Keyspace sampling budgets must be positive (--sample-commands at least 3). " \
+                             "Please see --help for more details.")
+        sample = {"mode": args.sample,
+                  "time": args.sample_time,
+                  "commands": args.sample_commands,
+                  "count": args.sample_count,
+                  "pause": args.sample_pause / 1000.0,
+                  "separator": args.sample_separator,
+                  "top": args.sample_top}
+    cache = None
+    if args.cache_dir != None:
+        if not os.path.isdir(args.cache_dir) or not os.access(args.cache_dir, os.W_OK):
+            raise UsageError("INFO cache directory (--cache-dir) '%s' must be an existing, writable directory." % \
+                             args.cache_dir)
+        if args.cache_ttl <= 0 or args.cache_max_stale < args.cache_ttl:
+            raise UsageError("The INFO cache TTL (--cache-ttl) must be positive and no larger than --cache-max-stale. " \
+                             "Please see --help for more details.")
+        cache = InfoSnapshotCache(args.cache_dir, args.cache_ttl, args.cache_max_stale, args.timeout + 1)
+    check_args = (args.timeout, args.pings, args.latency_warn, args.latency_critical, sample, cache)
+    
+    ### Check A Single Instance
+    if not multi_mode:
+        exit_code, message, perfdata = check_redis(*((args.server, args.port) + default_thresholds + check_args))
+        return (exit_code, message, format_perfdata(perfdata))
+    
+    ### Check Many Instances Concurrently
+    if args.output not in ("aggregate", "passive"):
+        raise UsageError("Output mode (--output) must be 'aggregate' or 'passive'. Please see --help for more details.")
+    if args.workers < 1:
+        raise UsageError("The worker count (--workers) must be at least 1. Please see --help for more details.")
+    instances = []
+    if args.instances != None:
+        for instance in args.instances.split(","):
+            instances.append(parse_instance(instance, "--instances") + default_thresholds)
+    if args.instances_file != None:
+        instances = instances + load_instances(args.instances_file, default_thresholds)
+    if not instances:
+        raise UsageError("No instances to check were found. Please see --help for more details.")
+    if args.output == "passive":
+        # Nagios keeps one result per host and service, so instances sharing both would overwrite each other
+        services = {}
+        for host, port, warn, critical in instances:
+            key = (host, service_description(args.service, host, port))
+            if key in services:
+                raise UsageError("Instances %s:%d and %s:%d would both submit to service '%s' on host %s. "
+                                 "Please include %%(port)s in --service." % ((host, services[key], host, port) + key[::-1]))
+            services[key] = port
+    
+    started = time.time()
+    results = check_instances(instances, args.workers, check_args)
+    elapsed = time.time() - started
+    
+    if args.output == "passive":
+        try:
+            submit_passive_results(args.command_file, args.service, instances, results)
+        except IOError, e:
+            return (EXIT_NAGIOS_CRITICAL, "CRITICAL: Cannot write passive results to Nagios command file '%s'. (%s)" % \
+                    (args.command_file, str(e)), "")
+        return (EXIT_NAGIOS_OK, "OK: Submitted %d passive Redis results in %.2fs." % (len(instances), elapsed), "")
+    
+    exit_code = max([result[0] for result in results])
+    problems = []
+    for index in range(len(instances)):
+        if results[index][0] != EXIT_NAGIOS_OK:
+            problems.append("%s:%d %s" % (instances[index][0], instances[index][1], results[index][1]))
+    counts = {}
+    for result in results:
+        counts[result[0]] = counts.get(result[0], 0) + 1
+    perfdata = []
+    for index in range(len(instances)):
+        if results[index][2]:
+            perfdata.append(format_perfdata(results[index][2], "%s:%d_" % instances[index][:2]))
+    return (exit_code,
+            "%s: %d critical, %d warn, %d OK of %d Redis instances (%.2fs).%s" % \
+            (STATUS_NAMES[exit_code], counts.get(EXIT_NAGIOS_CRITICAL, 0), counts.get(EXIT_NAGIOS_WARN, 0),
+             counts.get(EXIT_NAGIOS_OK, 0), len(instances), elapsed,
+             problems and " " + " ".join(problems) or ""),
+            " ".join(perfdata))
+
+def main():
+    try:
+        exit_code, message, perfdata = run_check(sys.argv[1:])
+    except UsageError, e:
+        print str(e)
+        sys.exit(-1)
+    if perfdata:
+        message = message + " | " + perfdata
+    print message
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+####################################################################
+# FILENAME: nagios/test_amqp_queue_check
+# PROJECT: Platar
+# DESCRIPTION: Unit tests for amqp_queue_check.py's depth history and
+#   queue evaluation. No AMQP broker or amqplib is needed:
+#
+#       python -m unittest discover -s nagios -p "test_*.py"
+#
+########################################################################################
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import amqp_queue_check
+
+
+class QueueStateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="test_amqp_queue_check.")
+        self.path = os.path.join(self.workdir, "state")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, True)
+
+    def run_store(self, now, queues):
+        """Adds one sample per (key, depth) in one run. Returns {key: samples}."""
+        store = amqp_queue_check.QueueStateStore(self.path, 8, 3600)
+        samples = {}
+        for key, depth in queues:
+            samples[key] = store.add(key, now, depth)
+        store.close()
+        return samples
+
+    def test_refreshed_record_is_not_reused(self):
+        self.run_store(1000000, [("a", 5), ("x", 1)])
+        # Both have expired. "c" takes x's record, then "a" is refreshed before "d" needs one
+        samples = self.run_store(1000000 + 7200, [("c", 2), ("a", 6), ("d", 3)])
+        self.assertEqual(samples["a"], [(1000000, 5), (1007200, 6)])
+        samples = self.run_store(1000000 + 7260, [("a", 8), ("c", 4), ("d", 5)])
+        self.assertEqual(samples["a"], [(1000000, 5), (1007200, 6), (1007260, 8)])
+        self.assertEqual(samples["c"], [(1007200, 2), (1007260, 4)])
+        self.assertEqual(samples["d"], [(1007200, 3), (1007260, 5)])
+
+    def test_expired_record_is_reused(self):
+        self.run_store(1000000, [("a", 5)])
+        self.run_store(1000000 + 7200, [("b", 7)])
+        self.assertEqual(os.path.getsize(self.path),
+                         amqp_queue_check.QueueStateStore.HEADER.size +
+                         amqp_queue_check.QueueStateStore.RECORD.size + 8 * amqp_queue_check.QueueStateStore.SAMPLE.size)
+
+
+class QueueThresholdsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="test_amqp_queue_check.")
+        self.path = os.path.join(self.workdir, "queues")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, True)
+
+    def load(self, text):
+        f = open(self.path, "w")
+        f.write(text)
+        f.close()
+        return amqp_queue_check.load_queue_specs(self.path)
+
+    def test_first_pattern_in_file_order(self):
+        queues, thresholds = self.load("jobs.* 100 200\n* 1 2\njobs.email\nmail.out\n")
+        self.assertEqual(queues, ["jobs.email", "mail.out"])
+        limits = amqp_queue_check.queue_thresholds("jobs.email", thresholds, {})
+        self.assertEqual((limits["warn"], limits["critical"]), (100, 200))
+        limits = amqp_queue_check.queue_thresholds("mail.out", thresholds, {})
+        self.assertEqual((limits["warn"], limits["critical"]), (1, 2))
+        queues, thresholds = self.load("* 1 2\njobs.* 100 200\njobs.email\n")
+        limits = amqp_queue_check.queue_thresholds("jobs.email", thresholds, {})
+        self.assertEqual((limits["warn"], limits["critical"]), (1, 2))
+
+    def test_own_line_over_pattern_over_default(self):
+        queues, thresholds = self.load("jobs.* 100 200 rate_warn=5\njobs.email 10 20\n")
+        limits = amqp_queue_check.queue_thresholds("jobs.email", thresholds, {"warn": 1, "critical": 2, "ttd_warn": 60})
+        self.assertEqual(limits, {"warn": 10, "critical": 20, "rate_warn": 5, "ttd_warn": 60})
+
+
+class EvaluateQueueTest(unittest.TestCase):
+
+    limits = {"warn": 1000, "critical": 2000, "ttd_warn": 60, "ttd_critical": 600}
+
+    def test_steady_queue_is_ok(self):
+        trend = amqp_queue_check.queue_trend([(1000, 10), (1060, 10), (1120, 10)])
+        self.assertEqual(trend, (0.0, float("inf")))
+        self.assertEqual(amqp_queue_check.evaluate_queue(10, 2, trend, self.limits), amqp_queue_check.EXIT_NAGIOS_OK)
+
+    def test_growing_queue_is_left_to_rate(self):
+        trend = amqp_queue_check.queue_trend([(1000, 10), (1060, 20), (1120, 30)])
+        self.assertEqual(amqp_queue_check.evaluate_queue(30, 2, trend, self.limits), amqp_queue_check.EXIT_NAGIOS_OK)
+        limits = dict(self.limits)
+        limits["rate_warn"] = 0.1
+        self.assertEqual(amqp_queue_check.evaluate_queue(30, 2, trend, limits), amqp_queue_check.EXIT_NAGIOS_WARN)
+
+    def test_slow_drain(self):
+        trend = amqp_queue_check.queue_trend([(1000, 900), (1060, 890), (1120, 880)])
+        self.assertEqual(amqp_queue_check.evaluate_queue(880, 2, trend, self.limits),
+                         amqp_queue_check.EXIT_NAGIOS_CRITICAL)
+
+    def test_fast_drain(self):
+        trend = amqp_queue_check.queue_trend([(1000, 900), (1060, 500), (1120, 100)])
+        self.assertEqual(amqp_queue_check.evaluate_queue(100, 2, trend, self.limits), amqp_queue_check.EXIT_NAGIOS_OK)
+
+
+if __name__ == "__main__":
+    unittest.main()
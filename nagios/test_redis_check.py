@@ -0,0 +1,198 @@
+#!/usr/bin/python
+####################################################################
+# FILENAME: nagios/test_redis_check
+# PROJECT: Platar
+# DESCRIPTION: Unit tests for redis_check.py, run against a stub redis
+#   client module so no Redis server or redis-py is needed:
+#
+#       python -m unittest discover -s nagios -p "test_*.py"
+#
+########################################################################################
+import os, sys, types, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import redis_check
+
+
+## Stub client
+class StubRedisError(Exception):
+    pass
+
+class StubConnectionError(StubRedisError):
+    pass
+
+class StubTimeoutError(StubRedisError):
+    """Like redis-py 2.10+: a RedisError, not a ConnectionError."""
+
+class StubResponseError(StubRedisError):
+    pass
+
+class StubRedis:
+    raises = None
+    keyspace = {}		# key -> (type, MEMORY USAGE bytes)
+    memory_usage = True	# False answers MEMORY USAGE like Redis < 4.0
+    commands = []		# Every command sent, pipelined ones included
+
+    def __init__(self, host, port, socket_timeout):
+        pass
+
+    def info(self, section=None):
+        if StubRedis.raises:
+            raise StubRedis.raises("Timeout reading from socket")
+        return {"used_memory": 1024 * 1024, "uptime_in_days": 1, "connected_clients": 1,
+                "redis_version": "stub", "multiplexing_api": "epoll", "db0": {"keys": len(StubRedis.keyspace)}}
+
+    def pipeline(self, transaction=True):
+        return StubPipeline(self)
+
+    def execute_command(self, *args):
+        StubRedis.commands.append(args)
+        if args[0] == "SCAN":
+            keys = sorted(StubRedis.keyspace.keys())
+            cursor, count = int(args[1]), int(args[3])
+            return (cursor + count < len(keys) and cursor + count or 0, keys[cursor:cursor + count])
+        if args[0] == "MEMORY":
+            if not StubRedis.memory_usage:
+                raise StubResponseError("ERR unknown command 'MEMORY'")
+            return StubRedis.keyspace.get(args[2], (None, None))[1]
+        if args[0] == "TYPE":
+            return StubRedis.keyspace.get(args[1], ("none", None))[0]
+        raise StubResponseError("ERR unknown command '%s'" % args[0])
+
+    def type(self, key):
+        return self.execute_command("TYPE", key)
+
+class StubPipeline:
+    def __init__(self, conn):
+        self.conn = conn
+        self.queued = []
+
+    def info(self, section=None):
+        raise TypeError	# Makes fetch_info() fall back to a plain info()
+
+    def execute_command(self, *args):
+        self.queued.append(args)
+
+    def type(self, key):
+        self.queued.append(("TYPE", key))
+
+    def execute(self):
+        queued, self.queued = self.queued, []
+        return [self.conn.execute_command(*args) for args in queued]
+
+def stub_redis_module():
+    module = types.ModuleType("redis")
+    module.exceptions = types.ModuleType("redis.exceptions")
+    module.exceptions.RedisError = StubRedisError
+    module.exceptions.ConnectionError = StubConnectionError
+    module.exceptions.TimeoutError = StubTimeoutError
+    module.exceptions.ResponseError = StubResponseError
+    module.Redis = StubRedis
+    return module
+
+
+class RedisCheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_module = sys.modules.get("redis")
+        sys.modules["redis"] = stub_redis_module()
+        redis_check.redis = None
+        StubRedis.raises = None
+        StubRedis.keyspace = {}
+        StubRedis.memory_usage = True
+        StubRedis.commands = []
+
+    def tearDown(self):
+        if self.saved_module != None:
+            sys.modules["redis"] = self.saved_module
+        else:
+            del sys.modules["redis"]
+        redis_check.redis = None
+        redis_check.CONNECTION_ERRORS = ()
+
+    def test_timeout_is_critical(self):
+        StubRedis.raises = StubTimeoutError
+        exit_code, message, perfdata = redis_check.run_check(["-s", "stub", "-p", "6379", "-w", "10", "-c", "20"])
+        self.assertEqual(exit_code, redis_check.EXIT_NAGIOS_CRITICAL)
+        self.assert_(message.startswith("CRITICAL: Problem establishing connection"), message)
+
+    def test_refused_is_critical(self):
+        StubRedis.raises = StubConnectionError
+        exit_code, message, perfdata = redis_check.run_check(["-s", "stub", "-p", "6379", "-w", "10", "-c", "20"])
+        self.assertEqual(exit_code, redis_check.EXIT_NAGIOS_CRITICAL)
+
+    def test_ok(self):
+        exit_code, message, perfdata = redis_check.run_check(["-s", "stub", "-p", "6379", "-w", "10", "-c", "20"])
+        self.assertEqual(exit_code, redis_check.EXIT_NAGIOS_OK)
+
+    def test_passive_service_per_port(self):
+        fd, command_file = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            exit_code, message, perfdata = redis_check.run_check(["-i", "stub:6379,stub:6380", "-w", "10", "-c", "20",
+                                                                  "-o", "passive", "--command-file", command_file])
+            self.assertEqual(exit_code, redis_check.EXIT_NAGIOS_OK)
+            lines = open(command_file).read().splitlines()
+            self.assertEqual(sorted([line.split(";")[2] for line in lines]), ["Redis 6379", "Redis 6380"])
+        finally:
+            os.unlink(command_file)
+
+    def test_passive_service_collision(self):
+        self.assertRaises(redis_check.UsageError, redis_check.run_check,
+                          ["-i", "stub:6379,stub:6380", "-w", "10", "-c", "20", "-o", "passive",
+                           "--service", "Redis", "--command-file", os.devnull])
+
+
+
+class SampleKeyspaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_module = sys.modules.get("redis")
+        sys.modules["redis"] = stub_redis_module()
+        redis_check.redis = None
+        redis_check.load_redis()
+        StubRedis.raises = None
+        StubRedis.keyspace = dict([("user:%03d" % x, ("string", 104858)) for x in range(100)])
+        StubRedis.memory_usage = True
+        StubRedis.commands = []
+        self.conn = StubRedis("stub", 6379, 1)
+
+    def tearDown(self):
+        if self.saved_module != None:
+            sys.modules["redis"] = self.saved_module
+        else:
+            del sys.modules["redis"]
+        redis_check.redis = None
+        redis_check.CONNECTION_ERRORS = ()
+
+    def test_command_budget(self):
+        prefixes, sampled, complete = redis_check.sample_keyspace(self.conn, 60, 25, 10, 0, ":")
+        self.assertEqual(len(StubRedis.commands), 25)
+        self.assertEqual((sampled, complete), (11, False))
+        self.assertEqual(prefixes["user"][1], 11)
+
+    def test_time_budget_estimates_total(self):
+        prefixes, sampled, complete = redis_check.sample_keyspace(self.conn, 0, 2000, 10, 0, ":")
+        self.assertEqual((sampled, complete), (10, False))
+        self.assertEqual(redis_check.format_sample(prefixes, sampled, complete, 100, 5),
+                         "Top key prefixes (10 of 100 keys sampled, estimated): user 100% ~10.0MB string.")
+
+    def test_complete_walk(self):
+        StubRedis.keyspace["session"] = ("hash", 1048576)
+        prefixes, sampled, complete = redis_check.sample_keyspace(self.conn, 60, 2000, 10, 0, ":")
+        self.assertEqual((sampled, complete), (101, True))
+        self.assertEqual(redis_check.format_sample(prefixes, sampled, complete, 101, 5),
+                         "Top key prefixes (101 of 101 keys sampled): user 90% ~10.0MB string, "
+                         "(none) 9% ~1.0MB hash.")
+
+    def test_memory_usage_unsupported(self):
+        StubRedis.memory_usage = False
+        exit_code, message, perfdata = redis_check.run_check(["-s", "stub", "-p", "6379", "-w", "10", "-c", "20",
+                                                              "-k", "always"])
+        self.assertEqual(exit_code, redis_check.EXIT_NAGIOS_OK, message)
+        self.assert_("Keyspace sampling failed (MEMORY USAGE needs Redis 4.0+): ERR unknown command 'MEMORY'."
+                     in message, message)
+
+
+if __name__ == "__main__":
+    unittest.main()